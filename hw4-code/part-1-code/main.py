@@ -2,7 +2,8 @@ import datasets
 from datasets import load_dataset
 from transformers import AutoTokenizer
 from torch.utils.data import DataLoader
-from transformers import AutoModelForSequenceClassification
+from transformers import AutoModelForSequenceClassification, DataCollatorWithPadding
+from transformers.trainer_pt_utils import LengthGroupedSampler
 from torch.optim import AdamW
 from transformers import get_scheduler
 import torch
@@ -12,6 +13,7 @@ import random
 import argparse
 from utils import *
 import os
+import time
 
 # Set seed
 random.seed(0)
@@ -21,9 +23,34 @@ torch.backends.cudnn.deterministic = True
 torch.backends.cudnn.benchmark = False
 
 
-# Tokenize the input
+# Tokenize the input (padding happens per batch, in the dataloader's collator)
 def tokenize_function(examples):
-    return tokenizer(examples["text"], padding="max_length", truncation=True)
+    return tokenizer(examples["text"], truncation=True)
+
+
+# Pads each batch to its longest review (or to max_length with --pad_to_max_length)
+def create_collator(args):
+    if args.pad_to_max_length:
+        return DataCollatorWithPadding(tokenizer, padding="max_length", max_length=tokenizer.model_max_length)
+    return DataCollatorWithPadding(tokenizer, pad_to_multiple_of=8 if device.type == "cuda" else None)
+
+
+# Shuffled training batches of reviews with similar lengths, so little of each batch is padding
+def create_train_dataloader(args, dataset):
+    if args.pad_to_max_length:
+        return DataLoader(dataset, shuffle=True, batch_size=args.batch_size, collate_fn=create_collator(args))
+    lengths = [len(ids) for ids in dataset["input_ids"]]
+    sampler = LengthGroupedSampler(args.batch_size, lengths=lengths)
+    return DataLoader(dataset, sampler=sampler, batch_size=args.batch_size, collate_fn=create_collator(args))
+
+
+# Evaluation batches in order of length; do_eval writes the predictions back in dataset order
+def create_eval_dataloader(args, dataset):
+    order = list(range(len(dataset)))
+    if not args.pad_to_max_length:
+        lengths = [len(ids) for ids in dataset["input_ids"]]
+        order.sort(key=lambda i: lengths[i])
+    return DataLoader(dataset, sampler=order, batch_size=args.batch_size, collate_fn=create_collator(args))
 
 
 # Core training function
@@ -36,6 +63,8 @@ def do_train(args, model, train_dataloader, save_dir="./out"):
     )
     model.train()
     progress_bar = tqdm(range(num_training_steps))
+    start = time.perf_counter()
+    num_examples, real_tokens, padded_tokens = 0, 0, 0
 
     ################################
     ##### YOUR CODE BEGINGS HERE ###
@@ -47,6 +76,10 @@ def do_train(args, model, train_dataloader, save_dir="./out"):
 
     for epoch in range(num_epochs):
         for batch in train_dataloader:
+            num_examples += len(batch["labels"])
+            real_tokens += batch["attention_mask"].sum().item()
+            padded_tokens += batch["attention_mask"].numel()
+
             # Move batch to device
             batch = {k: v.to(device) for k, v in batch.items()}
 
@@ -67,11 +100,11 @@ def do_train(args, model, train_dataloader, save_dir="./out"):
             # Update progress bar
             progress_bar.update(1)
 
- 
-
     ##### YOUR CODE ENDS HERE ######
 
-    print("Training completed...")
+    secs = time.perf_counter() - start
+    print(f"Training completed in {secs:.1f}s ({num_examples / secs:.1f} examples/s, "
+          f"{100 * (1 - real_tokens / max(padded_tokens, 1)):.1f}% padding tokens)")
     print("Saving Model....")
     model.save_pretrained(save_dir)
 
@@ -85,7 +118,11 @@ def do_eval(eval_dataloader, output_dir, out_file):
     model.eval()
 
     metric = evaluate.load("accuracy")
-    out_file = open(out_file, "w")
+    # Dataset index of each example, in the order the dataloader yields them
+    order = list(eval_dataloader.sampler)
+    lines = [None] * len(order)
+    position = 0
+    start = time.perf_counter()
 
     for batch in tqdm(eval_dataloader):
         batch = {k: v.to(device) for k, v in batch.items()}
@@ -96,11 +133,16 @@ def do_eval(eval_dataloader, output_dir, out_file):
         predictions = torch.argmax(logits, dim=-1)
         metric.add_batch(predictions=predictions, references=batch["labels"])
 
-        # write to output file
         for pred, label in zip(predictions, batch["labels"]):
-                out_file.write(f"{pred.item()}\n")
-                out_file.write(f"{label.item()}\n")
-    out_file.close()
+            lines[order[position]] = f"{pred.item()}\n{label.item()}\n"
+            position += 1
+
+    secs = time.perf_counter() - start
+    print(f"Evaluation took {secs:.1f}s ({len(order) / secs:.1f} examples/s)")
+
+    # write to output file, in dataset order
+    with open(out_file, "w") as f:
+        f.writelines(lines)
     score = metric.compute()
 
     return score
@@ -137,7 +179,7 @@ def create_augmented_dataloader(args, dataset):
     augmented_tokenized_dataset.set_format("torch")
 
     # 6. Create the DataLoader
-    train_dataloader = DataLoader(augmented_tokenized_dataset, shuffle=True, batch_size=args.batch_size)
+    train_dataloader = create_train_dataloader(args, augmented_tokenized_dataset)
 
 
     ##### YOUR CODE ENDS HERE ######
@@ -168,7 +210,7 @@ def create_transformed_dataloader(args, dataset, debug_transformation):
     transformed_tokenized_dataset.set_format("torch")
 
     transformed_val_dataset = transformed_tokenized_dataset
-    eval_dataloader = DataLoader(transformed_val_dataset, batch_size=args.batch_size)
+    eval_dataloader = create_eval_dataloader(args, transformed_val_dataset)
 
     return eval_dataloader
 
@@ -190,6 +232,8 @@ if __name__ == "__main__":
     parser.add_argument("--learning_rate", type=float, default=5e-5)
     parser.add_argument("--num_epochs", type=int, default=3)
     parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--pad_to_max_length", action="store_true",
+                        help="pad every review to 512 tokens in dataset order (the original, slower batching)")
 
     args = parser.parse_args()
 
@@ -216,14 +260,14 @@ if __name__ == "__main__":
 
     # Create dataloaders for iterating over the dataset
     if args.debug_train:
-        train_dataloader = DataLoader(small_train_dataset, shuffle=True, batch_size=args.batch_size)
-        eval_dataloader = DataLoader(small_eval_dataset, batch_size=args.batch_size)
+        train_dataloader = create_train_dataloader(args, small_train_dataset)
+        eval_dataloader = create_eval_dataloader(args, small_eval_dataset)
         print(f"Debug training...")
         print(f"len(train_dataloader): {len(train_dataloader)}")
         print(f"len(eval_dataloader): {len(eval_dataloader)}")
     else:
-        train_dataloader = DataLoader(tokenized_dataset["train"], shuffle=True, batch_size=args.batch_size)
-        eval_dataloader = DataLoader(tokenized_dataset["test"], batch_size=args.batch_size)
+        train_dataloader = create_train_dataloader(args, tokenized_dataset["train"])
+        eval_dataloader = create_eval_dataloader(args, tokenized_dataset["test"])
         print(f"Actual training...")
         print(f"len(train_dataloader): {len(train_dataloader)}")
         print(f"len(eval_dataloader): {len(eval_dataloader)}")
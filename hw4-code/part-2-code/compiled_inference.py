@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import argparse
+from tqdm import tqdm
+
+import torch
+from transformers import T5TokenizerFast
+
+from load_data import get_dataloader, PAD_IDX
+from t5_utils import greedy_decode, generate_ids, t5_decoder_step, load_pretrained_fast
+from sql_tokenizer import load_target_tokenizer
+
+DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+MAX_NEW_TOKENS = 256
+DEFAULT_LENGTH_BUCKETS = (16, 32, 64, 128, 256)
+COMPILE_CACHE_DIR = "cache/compiled_t5"
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Shape-bucketed torch.compile inference for T5')
+    parser.add_argument('--experiment_name', type=str, default='ft_experiment',
+                        help="Loads the checkpoint from checkpoints/<experiment_name>")
+    parser.add_argument('--splits', nargs='+', default=["dev", "test"], choices=["dev", "test"])
+    parser.add_argument('--test_batch_size', type=int, default=16)
+    parser.add_argument('--length_buckets', type=int, nargs='+', default=list(DEFAULT_LENGTH_BUCKETS),
+                        help="Padded encoder lengths to compile for")
+    parser.add_argument('--compile_backend', type=str, default="inductor",
+                        help="torch.compile backend")
+    parser.add_argument('--benchmark', action='store_true',
+                        help="Also time eager generation and compare outputs")
+    return parser.parse_args()
+
+
+def enable_compile_cache(cache_dir=COMPILE_CACHE_DIR):
+    '''
+    Persist inductor's compiled graphs on disk so that warm-up in a new
+    process reuses the kernels produced by an earlier run.
+    '''
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(os.path.join(cache_dir, "inductor")))
+    import torch._inductor.config
+    torch._inductor.config.fx_graph_cache = True
+
+
+class BucketedT5Generator:
+    '''
+    Greedy T5 decoding with a compiled encoder and a compiled single-step
+    decoder. Every batch is padded up to a fixed (batch_size, length) bucket so
+    the compiled encoder only ever sees a handful of static shapes.
+    '''
+
+    def __init__(self, model, batch_size, length_buckets=DEFAULT_LENGTH_BUCKETS,
+                 backend="inductor", cache_dir=COMPILE_CACHE_DIR):
+        self.model = model.eval()
+        self.batch_size = batch_size
+        self.length_buckets = sorted(length_buckets)
+        self.cache_dir = cache_dir
+        self.backend = backend
+
+        # One static graph per encoder bucket, plus the decoder graphs
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit,
+                                                    2 * len(self.length_buckets) + 8)
+        self.encode = torch.compile(self._encode, backend=backend, dynamic=False)
+        self.step = torch.compile(self._step, backend=backend, dynamic=True)
+
+    def _encode(self, enc_in, enc_mask):
+        return self.model.encoder(input_ids=enc_in, attention_mask=enc_mask).last_hidden_state
+
+    def _step(self, decoder_input_ids, encoder_hidden, enc_mask, past_key_values):
+        return t5_decoder_step(self.model, decoder_input_ids, encoder_hidden, enc_mask, past_key_values)
+
+    def bucket_for(self, length):
+        for bucket in self.length_buckets:
+            if length <= bucket:
+                return bucket
+        raise ValueError(f"Input length {length} exceeds the largest bucket {self.length_buckets[-1]}")
+
+    def pad_to_bucket(self, enc_in, enc_mask):
+        '''
+        Right-pad a batch to its length bucket and fill missing rows with fully
+        masked padding. Returns the padded tensors and the number of real rows.
+        '''
+        n_rows = enc_in.size(0)
+        if n_rows > self.batch_size:
+            raise ValueError(f"Batch of {n_rows} exceeds the compiled batch size {self.batch_size}")
+        length = int(enc_mask.sum(dim=1).max())
+        bucket = self.bucket_for(length)
+
+        padded_in = torch.full((self.batch_size, bucket), PAD_IDX, dtype=enc_in.dtype, device=enc_in.device)
+        padded_mask = torch.zeros((self.batch_size, bucket), dtype=enc_mask.dtype, device=enc_mask.device)
+        padded_in[:n_rows, :length] = enc_in[:, :length]
+        padded_mask[:n_rows, :length] = enc_mask[:, :length]
+        # Dummy rows attend to a single token so their softmax stays well defined
+        padded_mask[n_rows:, 0] = 1
+        return padded_in, padded_mask, n_rows
+
+    def generate(self, enc_in, enc_mask, max_new_tokens=MAX_NEW_TOKENS):
+        padded_in, padded_mask, n_rows = self.pad_to_bucket(enc_in, enc_mask)
+        # Dummy rows start out finished, so only the real rows decide when decoding stops
+        finished = torch.arange(self.batch_size, device=padded_in.device) >= n_rows
+        with torch.no_grad():
+            dec = greedy_decode(self.model, padded_in, padded_mask, max_new_tokens,
+                                encode_fn=self.encode, step_fn=self.step, finished=finished)
+        return dec[:n_rows]
+
+    def _warmup_key(self, bucket):
+        # Compiled kernels depend on the backend, the model shape and the padded input shape
+        config = self.model.config
+        return (self.backend, config.d_model, config.num_layers, config.vocab_size, self.batch_size, bucket)
+
+    def warmup(self, max_new_tokens=4):
+        '''
+        Trigger compilation for every bucket. Dynamo traces again in every new
+        process, but buckets listed in the warmup.json manifest (written next
+        to the inductor cache by an earlier run) should get their kernels from
+        that cache. Returns {bucket: (secs, warmed by an earlier run)}, so the
+        caller can tell cold compiles from cache hits.
+        '''
+        manifest_path = os.path.join(self.cache_dir, "warmup.json")
+        warmed = set()
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                warmed = {tuple(x) for x in json.load(f)}
+
+        timings = {}
+        for bucket in self.length_buckets:
+            dummy_in = torch.full((1, bucket), PAD_IDX, dtype=torch.long, device=DEVICE)
+            dummy_mask = torch.ones_like(dummy_in)
+            start = time.perf_counter()
+            self.generate(dummy_in, dummy_mask, max_new_tokens)
+            timings[bucket] = (time.perf_counter() - start, self._warmup_key(bucket) in warmed)
+            warmed.add(self._warmup_key(bucket))
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(manifest_path, "w") as f:
+            json.dump(sorted(warmed), f)
+        return timings
+
+
+def run_split(generate_fn, tokenizer, loader, desc):
+    all_sql = []
+    start = time.perf_counter()
+    with torch.no_grad():
+        for batch in tqdm(loader, desc=desc, ncols=100):
+            enc_in, enc_mask = batch[0].to(DEVICE), batch[1].to(DEVICE)
+            gen = generate_fn(enc_in, enc_mask)
+            all_sql.extend([x.strip() for x in tokenizer.batch_decode(gen, skip_special_tokens=True)])
+    return all_sql, time.perf_counter() - start
+
+
+def main():
+    args = get_args()
+    enable_compile_cache()
+
+    checkpoint_dir = f"checkpoints/{args.experiment_name}"
+    tokenizer = load_target_tokenizer(checkpoint_dir, T5TokenizerFast.from_pretrained(checkpoint_dir))
+    model = load_pretrained_fast(checkpoint_dir).to(DEVICE)
+
+    generator = BucketedT5Generator(model, args.test_batch_size, args.length_buckets, args.compile_backend)
+    start = time.perf_counter()
+    timings = generator.warmup()
+    print(f"Warm-up took {time.perf_counter() - start:.1f}s "
+          f"({', '.join(f'{b}: {t:.1f}s' + (' cached' if cached else '') for b, (t, cached) in timings.items())})")
+    cold = [b for b, (_, cached) in timings.items() if not cached]
+    if cold:
+        print(f"Compiled from scratch for length buckets {cold}; later runs reuse {COMPILE_CACHE_DIR}")
+
+    os.makedirs("results", exist_ok=True)
+    for split in args.splits:
+        loader = get_dataloader(args.test_batch_size, split)
+        compiled_sql, compiled_secs = run_split(generator.generate, tokenizer, loader, f"compiled {split}")
+        with open(f"results/t5_compiled_{args.experiment_name}_{split}.sql", "w") as f:
+            for sql in compiled_sql:
+                f.write(f"{sql}\n")
+        print(f"compiled {split}: {compiled_secs:.1f}s ({len(compiled_sql) / compiled_secs:.2f} queries/s)")
+
+        if args.benchmark:
+            eager_fn = lambda enc_in, enc_mask: generate_ids(model, enc_in, enc_mask, MAX_NEW_TOKENS)
+            eager_sql, eager_secs = run_split(eager_fn, tokenizer, loader, f"eager {split}")
+            agree = sum(a == b for a, b in zip(compiled_sql, eager_sql)) / len(eager_sql)
+            print(f"eager {split}: {eager_secs:.1f}s ({len(eager_sql) / eager_secs:.2f} queries/s) | "
+                  f"speedup {eager_secs / compiled_secs:.2f}x | identical outputs {agree * 100:.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import os
+import time
+import argparse
+from argparse import Namespace
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from load_data import get_dataloader
+from t5_utils import initialize_model, setup_distributed
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Scaling benchmark for gloo data-parallel T5 training on CPU')
+    parser.add_argument('--world_sizes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--batch_size', type=int, default=16, help="Per-process batch size")
+    parser.add_argument('--warmup_steps', type=int, default=3)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--bind_numa', action='store_true')
+    parser.add_argument('--port', type=int, default=29512)
+    return parser.parse_args()
+
+
+def worker(rank, world_size, args, results):
+    os.environ.update({
+        "MASTER_ADDR": "127.0.0.1",
+        "MASTER_PORT": str(args.port + world_size),
+        "RANK": str(rank),
+        "WORLD_SIZE": str(world_size),
+        "LOCAL_RANK": str(rank),
+        "LOCAL_WORLD_SIZE": str(world_size),
+    })
+    setup_distributed(Namespace(ddp=True, bind_numa=args.bind_numa, threads_per_proc=None))
+
+    loader = get_dataloader(args.batch_size, "train", rank=rank, world_size=world_size)
+    model = initialize_model(Namespace(finetune=True))
+    model.train()
+    ddp_model = DistributedDataParallel(model)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+
+    batches = iter(loader)
+    for step in range(args.warmup_steps + args.steps):
+        if step == args.warmup_steps:
+            dist.barrier()
+            start = time.perf_counter()
+        enc_in, enc_mask, _, dec_tgt, _ = next(batches)
+        optimizer.zero_grad()
+        loss = ddp_model(input_ids=enc_in, attention_mask=enc_mask, labels=dec_tgt).loss
+        loss.backward()
+        optimizer.step()
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+
+    if rank == 0:
+        results.put((world_size, elapsed, torch.get_num_threads()))
+    dist.destroy_process_group()
+
+
+def main():
+    args = get_args()
+    ctx = mp.get_context("spawn")
+    results = ctx.SimpleQueue()
+
+    rows = []
+    for world_size in args.world_sizes:
+        mp.spawn(worker, args=(world_size, args, results), nprocs=world_size, join=True)
+        rows.append(results.get())
+
+    base = None
+    print(f"{'procs':>5} | {'threads/proc':>12} | {'secs':>7} | {'samples/s':>9} | {'speedup':>7} | {'efficiency':>10}")
+    for world_size, elapsed, threads in rows:
+        throughput = args.steps * args.batch_size * world_size / elapsed
+        base = base or throughput / world_size
+        speedup = throughput / base
+        print(f"{world_size:>5} | {threads:>12} | {elapsed:>7.2f} | {throughput:>9.2f} | "
+              f"{speedup:>6.2f}x | {speedup / world_size * 100:>9.1f}%")
+
+
+if __name__ == "__main__":
+    main()
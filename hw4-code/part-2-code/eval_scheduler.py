@@ -0,0 +1,59 @@
+# eval_scheduler.py
+
+import random
+from collections import defaultdict
+
+
+def stratified_subsample_indices(lengths, fraction, num_strata=5, seed=42):
+    '''
+    Fixed subsample of a split, stratified by target length so that short and
+    long queries stay represented in the same proportions as the full split.
+    '''
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    strata = defaultdict(list)
+    for rank, idx in enumerate(order):
+        strata[rank * num_strata // len(order)].append(idx)
+
+    rng = random.Random(seed)
+    chosen = []
+    for members in strata.values():
+        n = max(1, round(fraction * len(members)))
+        chosen.extend(rng.sample(members, n))
+    return sorted(chosen)
+
+
+class EvalScheduler:
+    '''
+    Decides when the expensive generate-and-execute dev evaluation has to run.
+    Cheap signals (teacher-forced proxy metrics on the full dev set and record
+    F1 on a fixed subsample) are computed every epoch; the full evaluation runs
+    when any of them reaches a new best, every `full_every` epochs, or when
+    skipping it would trigger early stopping.
+    '''
+
+    def __init__(self, mode="full", full_every=5):
+        self.mode = mode
+        self.full_every = full_every
+        self.best_signals = {}
+        self.last_full_epoch = -1
+
+    def should_run_full(self, epoch, signals, about_to_stop):
+        improved = False
+        for name, value in signals.items():
+            if value > self.best_signals.get(name, float("-inf")):
+                self.best_signals[name] = value
+                improved = True
+
+        if self.mode == "full" or improved or about_to_stop:
+            return True
+        return self.full_every > 0 and epoch - self.last_full_epoch >= self.full_every
+
+    def record_full(self, epoch):
+        self.last_full_epoch = epoch
+
+    def state_dict(self):
+        return {"best_signals": dict(self.best_signals), "last_full_epoch": self.last_full_epoch}
+
+    def load_state_dict(self, state):
+        self.best_signals = dict(state["best_signals"])
+        self.last_full_epoch = state["last_full_epoch"]
@@ -0,0 +1,195 @@
+# example_index.py
+
+import os
+import re
+import json
+import hashlib
+import time
+import argparse
+from collections import Counter
+
+import numpy as np
+
+INDEX_META_FILENAME = "meta.json"
+INDEX_ARRAYS = ["indptr", "doc_ids", "weights", "example_tokens"]
+WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return WORD_RE.findall(text.lower())
+
+
+def texts_hash(*text_lists):
+    # Identifies the data an index was built from, so a saved index is rebuilt when it changes
+    h = hashlib.sha1()
+    for texts in text_lists:
+        for text in texts:
+            h.update(text.encode())
+            h.update(b"\0")
+        h.update(b"\1")
+    return h.hexdigest()
+
+
+class ExampleIndex:
+    '''
+    BM25 inverted index over the training sentences, used to pick few-shot
+    examples. Postings are stored CSR-style per term (indptr, doc_ids) with
+    the BM25 term weight of each posting precomputed, so a query only sums the
+    postings of its own words. example_tokens holds the prompt length of each
+    formatted training example, for budgeting. source_hash identifies the
+    sentences and example texts it was built from.
+    '''
+
+    def __init__(self, vocab, indptr, doc_ids, weights, example_tokens, tokenizer_name=None, source_hash=None):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.example_tokens = example_tokens
+        self.tokenizer_name = tokenizer_name
+        self.source_hash = source_hash
+
+    def __len__(self):
+        return len(self.example_tokens)
+
+    @classmethod
+    def build(cls, sentences, example_tokens, k1=1.2, b=0.75, tokenizer_name=None, source_hash=None):
+        docs = [Counter(tokenize(s)) for s in sentences]
+        doc_lens = np.array([sum(d.values()) for d in docs], dtype=np.float32)
+        avg_len = max(doc_lens.mean(), 1.0)
+
+        postings = {}
+        for doc_id, counts in enumerate(docs):
+            for word, tf in counts.items():
+                postings.setdefault(word, []).append((doc_id, tf))
+
+        vocab = {word: i for i, word in enumerate(sorted(postings))}
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        doc_ids, weights = [], []
+        for word, term_id in vocab.items():
+            plist = postings[word]
+            idf = np.log(1 + (len(docs) - len(plist) + 0.5) / (len(plist) + 0.5))
+            for doc_id, tf in plist:
+                doc_ids.append(doc_id)
+                weights.append(idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * doc_lens[doc_id] / avg_len)))
+            indptr[term_id + 1] = len(doc_ids)
+
+        return cls(vocab, indptr, np.array(doc_ids, dtype=np.int32), np.array(weights, dtype=np.float32),
+                   np.asarray(example_tokens, dtype=np.int32), tokenizer_name, source_hash)
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        for name in INDEX_ARRAYS:
+            np.save(os.path.join(index_dir, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(index_dir, INDEX_META_FILENAME), "w") as f:
+            json.dump({"vocab": self.vocab, "tokenizer_name": self.tokenizer_name, "source_hash": self.source_hash}, f)
+
+    @classmethod
+    def load(cls, index_dir):
+        # Arrays are memory-mapped: loading costs the vocabulary JSON only
+        with open(os.path.join(index_dir, INDEX_META_FILENAME)) as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r") for name in INDEX_ARRAYS]
+        return cls(meta["vocab"], *arrays, meta["tokenizer_name"], meta.get("source_hash"))
+
+    @classmethod
+    def load_or_build(cls, index_dir, sentences, example_texts, tokenizer):
+        '''
+        Load the index saved in index_dir, or build and save it if there is
+        none or it was built for other data or another tokenizer.
+        '''
+        tokenizer_name = getattr(tokenizer, "name_or_path", None)
+        source_hash = texts_hash(sentences, example_texts)
+        if os.path.exists(os.path.join(index_dir, INDEX_META_FILENAME)):
+            index = cls.load(index_dir)
+            if index.source_hash == source_hash and index.tokenizer_name == tokenizer_name:
+                return index
+        lengths = [len(ids) for ids in tokenizer(example_texts, add_special_tokens=False)["input_ids"]]
+        index = cls.build(sentences, lengths, tokenizer_name=tokenizer_name, source_hash=source_hash)
+        index.save(index_dir)
+        return index
+
+    def scores(self, sentence):
+        docs, weights = [], []
+        for word, qtf in Counter(tokenize(sentence)).items():
+            term_id = self.vocab.get(word)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            docs.append(self.doc_ids[start:end])
+            weights.append(self.weights[start:end] * qtf)
+        if not docs:
+            return np.zeros(len(self), dtype=np.float32)
+        return np.bincount(np.concatenate(docs), np.concatenate(weights), minlength=len(self))
+
+    def top_k(self, sentence, k, token_budget=None):
+        '''
+        Ids of up to k training examples, most similar first. With a
+        token_budget, examples are taken in rank order while their total
+        prompt length fits; ones that do not fit are skipped.
+        '''
+        if k <= 0:
+            return []
+        scores = self.scores(sentence)
+        # Over-fetch so that skipped (over-budget) examples can be replaced
+        n = min(len(scores), k if token_budget is None else 4 * k)
+        candidates = np.argpartition(-scores, n - 1)[:n]
+        ranked = candidates[np.argsort(-scores[candidates], kind="stable")]
+        if token_budget is None:
+            return ranked[:k].tolist()
+
+        chosen, used = [], 0
+        for doc_id in ranked.tolist():
+            cost = int(self.example_tokens[doc_id])
+            if used + cost <= token_budget:
+                chosen.append(doc_id)
+                used += cost
+                if len(chosen) == k:
+                    break
+        return chosen
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Build the few-shot example index and measure its query latency')
+    parser.add_argument('-m', '--model', type=str, default='gemma', help='Model whose tokenizer counts prompt tokens')
+    parser.add_argument('--index_dir', type=str, default=None,
+                        help="Defaults to data/example_index_<model>")
+    parser.add_argument('-s', '--shot', type=int, default=8)
+    parser.add_argument('--token_budget', type=int, default=None)
+    return parser.parse_args()
+
+
+def main():
+    from transformers import AutoTokenizer
+    from load_data import load_prompting_data
+    from prompting import MODEL_IDS, format_example
+
+    args = get_args()
+    index_dir = args.index_dir or f"data/example_index_{args.model}"
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_IDS[args.model])
+    train_x, train_y, dev_x, _, _ = load_prompting_data("data")
+    example_texts = [format_example(x, y) for x, y in zip(train_x, train_y)]
+
+    start = time.perf_counter()
+    lengths = [len(ids) for ids in tokenizer(example_texts, add_special_tokens=False)["input_ids"]]
+    ExampleIndex.build(train_x, lengths, tokenizer_name=tokenizer.name_or_path,
+                       source_hash=texts_hash(train_x, example_texts)).save(index_dir)
+    print(f"Built index over {len(train_x)} examples in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    index = ExampleIndex.load(index_dir)
+    print(f"Loaded (memory-mapped) in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    start = time.perf_counter()
+    selections = [index.top_k(x, args.shot, args.token_budget) for x in dev_x]
+    query_ms = (time.perf_counter() - start) * 1000 / len(dev_x)
+
+    first_k = int(np.sum(index.example_tokens[:args.shot]))
+    retrieved = np.mean([sum(int(index.example_tokens[i]) for i in ids) for ids in selections])
+    shots = np.mean([len(ids) for ids in selections])
+    print(f"Query latency: {query_ms:.3f} ms | k={args.shot}: first-k examples {first_k} tokens, "
+          f"retrieved {shots:.1f} examples with {retrieved:.0f} tokens on average")
+
+
+if __name__ == "__main__":
+    main()
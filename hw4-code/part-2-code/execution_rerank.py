@@ -0,0 +1,226 @@
+# execution_rerank.py
+
+import time
+import pickle
+import sqlite3
+import argparse
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import torch
+from tqdm import tqdm
+from transformers import T5TokenizerFast
+
+from utils import (DB_PATH, SLOW_LANE_BUDGET_SECS, SLOW_LANE_NICENESS, compute_record_with_budget, compute_records,
+                   compute_record_F1, screen_query, open_thread_connection)
+from load_data import get_dataloader
+from t5_utils import load_pretrained_fast, generate_ids, full_width_logits
+from sql_tokenizer import load_target_tokenizer
+
+DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+MAX_NEW_TOKENS = 256
+
+
+class CachedSqlExecutor:
+    '''
+    Runs SQL candidates on a pool of threads that each keep their own
+    connection. Results (records or error message) are memoized in an LRU
+    cache keyed by the query string, so candidates repeated across beams or
+    inputs execute once. Queries that fail screen_query are answered without
+    being executed, and the ones it flags as slow run on a single low-priority
+    thread with slow_lane_secs each. Every query gets at most timeout_secs from
+    when a worker picks it up, and anything still running at the caller's
+    deadline is interrupted.
+    '''
+
+    def __init__(self, num_threads=8, cache_size=20000, db_path=DB_PATH, timeout_secs=120,
+                 slow_lane_secs=SLOW_LANE_BUDGET_SECS):
+        self.connections = []
+        self.pool = ThreadPoolExecutor(num_threads, initializer=open_thread_connection,
+                                       initargs=(self.connections,))
+        self.slow_pool = ThreadPoolExecutor(1, initializer=open_thread_connection,
+                                            initargs=(self.connections, SLOW_LANE_NICENESS))
+        self.timeout_secs = timeout_secs
+        self.slow_lane_secs = min(timeout_secs, slow_lane_secs)
+        self.screen_conn = sqlite3.connect(db_path)
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, query, result):
+        self.cache[query] = result
+        self.cache.move_to_end(query)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def run(self, queries, deadline):
+        '''
+        Execute the queries concurrently (until the time.monotonic() deadline,
+        if given) and return one (records, error_msg) per query. Timed-out
+        queries are not cached, since a later call with a larger budget may
+        still complete them.
+        '''
+        results = [None] * len(queries)
+        pending = defaultdict(list)  # query -> positions waiting for it
+        slow = set()
+        for i, query in enumerate(queries):
+            if query in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(query)
+                results[i] = self.cache[query]
+                continue
+            if query in pending:
+                self.hits += 1
+                pending[query].append(i)
+                continue
+            self.misses += 1
+            status, error_msg = screen_query(self.screen_conn, query)
+            if status == "invalid":
+                self._remember(query, ([], error_msg))
+                results[i] = ([], error_msg)
+                continue
+            if status == "slow":
+                slow.add(query)
+            pending[query].append(i)
+
+        futures = {}
+        for query in pending:
+            if query in slow:
+                futures[query] = self.slow_pool.submit(compute_record_with_budget, 0, query, self.slow_lane_secs,
+                                                       deadline)
+            else:
+                futures[query] = self.pool.submit(compute_record_with_budget, 0, query, self.timeout_secs, deadline)
+        # Without a deadline every query is still bounded by its own budget
+        wait(futures.values(), timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+        for query, future in futures.items():
+            if future.done():
+                _, rec, error_msg = future.result()
+                if error_msg != "Query timed out":
+                    self._remember(query, (rec, error_msg))
+                result = (rec, error_msg)
+            else:
+                future.cancel()
+                result = ([], "Query timed out")
+            for i in pending[query]:
+                results[i] = result
+        return results
+
+    def close(self):
+        self.pool.shutdown()
+        self.slow_pool.shutdown()
+        for conn in self.connections:
+            conn.close()
+        self.screen_conn.close()
+
+
+def rerank_generate(model, tokenizer, enc_in, enc_mask, executor, num_beams=4, max_new_tokens=MAX_NEW_TOKENS,
+                    budget_secs=None):
+    '''
+    Beam search with k returned beams per input, followed by execution of all
+    candidates; each input gets its highest-scoring beam that executes without
+    error (its top beam if none does). budget_secs (the executor's per-query
+    timeout if not given) bounds decoding plus execution per input: the clock
+    starts before beam search, execution gets whatever remains of
+    budget_secs * batch_size after decoding, and with no time left the top
+    beams are returned unexecuted. Returns (sql, records, error_msg) per
+    input; records are None for unexecuted candidates.
+    '''
+    start = time.monotonic()
+    if budget_secs is None:
+        budget_secs = executor.timeout_secs
+    batch_size = enc_in.size(0)
+    # Beam search needs full-vocabulary logits, also from a restricted output head
+    with full_width_logits(model):
+        gen = model.generate(
+            input_ids=enc_in,
+            attention_mask=enc_mask,
+            max_new_tokens=max_new_tokens,
+            num_beams=num_beams,
+            num_return_sequences=num_beams,
+            early_stopping=True,
+        )
+    # Beams come back grouped per input, best (highest sequence score) first
+    decoded = [x.strip() for x in tokenizer.batch_decode(gen, skip_special_tokens=True)]
+    candidates = [decoded[i * num_beams:(i + 1) * num_beams] for i in range(batch_size)]
+
+    deadline = start + budget_secs * batch_size
+    if time.monotonic() >= deadline:
+        return [(beams[0], None, "") for beams in candidates]
+
+    flat = [sql for beams in candidates for sql in beams]
+    executed = executor.run(flat, deadline)
+    results = []
+    for i, beams in enumerate(candidates):
+        outcomes = executed[i * num_beams:(i + 1) * num_beams]
+        choice = next((j for j, (_, err) in enumerate(outcomes) if not err), 0)
+        results.append((beams[choice], *outcomes[choice]))
+    return results
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Execution-guided beam reranking vs greedy decoding')
+    parser.add_argument('--experiment_name', type=str, default='ft_experiment',
+                        help="Loads the checkpoint from checkpoints/<experiment_name>")
+    parser.add_argument('--test_batch_size', type=int, default=16)
+    parser.add_argument('--num_beams', type=int, default=4)
+    parser.add_argument('--budget_secs', type=float, default=None,
+                        help="Decoding plus execution budget per input (defaults to --query_timeout_secs)")
+    parser.add_argument('--exec_threads', type=int, default=8)
+    parser.add_argument('--query_timeout_secs', type=float, default=120,
+                        help="Execution time limit per candidate query")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    checkpoint_dir = f"checkpoints/{args.experiment_name}"
+    tokenizer = load_target_tokenizer(checkpoint_dir, T5TokenizerFast.from_pretrained(checkpoint_dir))
+    model = load_pretrained_fast(checkpoint_dir).to(DEVICE)
+    loader = get_dataloader(args.test_batch_size, "dev")
+    with open("records/ground_truth_dev.pkl", "rb") as f:
+        gt_records, _ = pickle.load(f)
+
+    # Greedy baseline: generate, then execute as the training loop does
+    greedy_sql = []
+    start = time.perf_counter()
+    with torch.no_grad():
+        for enc_in, enc_mask, _, _, _ in tqdm(loader, desc="greedy", ncols=100):
+            enc_in, enc_mask = enc_in.to(DEVICE), enc_mask.to(DEVICE)
+            gen = generate_ids(model, enc_in, enc_mask, MAX_NEW_TOKENS)
+            greedy_sql.extend(x.strip() for x in tokenizer.batch_decode(gen, skip_special_tokens=True))
+    greedy_records, greedy_errors = compute_records(greedy_sql)
+    greedy_secs = time.perf_counter() - start
+
+    executor = CachedSqlExecutor(args.exec_threads, timeout_secs=args.query_timeout_secs)
+    reranked = []
+    start = time.perf_counter()
+    with torch.no_grad():
+        for enc_in, enc_mask, _, _, _ in tqdm(loader, desc=f"rerank k={args.num_beams}", ncols=100):
+            enc_in, enc_mask = enc_in.to(DEVICE), enc_mask.to(DEVICE)
+            reranked.extend(rerank_generate(model, tokenizer, enc_in, enc_mask, executor,
+                                            args.num_beams, MAX_NEW_TOKENS, args.budget_secs))
+    # Inputs that ran out of budget still need their records for scoring
+    unexecuted = [i for i, (_, rec, _) in enumerate(reranked) if rec is None]
+    late_records, late_errors = compute_records([reranked[i][0] for i in unexecuted])
+    for i, rec, err in zip(unexecuted, late_records, late_errors):
+        reranked[i] = (reranked[i][0], rec, err)
+    rerank_secs = time.perf_counter() - start
+    executor.close()
+
+    n = len(greedy_sql)
+    rerank_records = [rec for _, rec, _ in reranked]
+    rerank_errors = [err for _, _, err in reranked]
+    greedy_f1 = compute_record_F1(gt_records, greedy_records)
+    rerank_f1 = compute_record_F1(gt_records, rerank_records)
+    print(f"greedy: F1 {greedy_f1:.4f} | errors {sum(map(bool, greedy_errors)) / n * 100:.1f}% | "
+          f"{greedy_secs / n * 1000:.0f} ms/query")
+    print(f"rerank: F1 {rerank_f1:.4f} | errors {sum(map(bool, rerank_errors)) / n * 100:.1f}% | "
+          f"{rerank_secs / n * 1000:.0f} ms/query | {len(unexecuted)} inputs over budget | "
+          f"cache hits {executor.hits}/{executor.hits + executor.misses}")
+    print(f"F1 gain {rerank_f1 - greedy_f1:+.4f} for {(rerank_secs - greedy_secs) / n * 1000:+.0f} ms/query "
+          f"({rerank_secs / greedy_secs:.2f}x latency)")
+
+
+if __name__ == "__main__":
+    main()
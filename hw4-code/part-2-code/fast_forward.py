@@ -0,0 +1,250 @@
+# fast_forward.py
+
+import os
+import time
+import sqlite3
+import argparse
+import functools
+from collections import Counter
+
+import torch
+from tqdm import tqdm
+from transformers import T5TokenizerFast
+
+from load_data import get_dataloader
+from t5_utils import generate_ids, t5_decoder_step, load_pretrained_fast, full_vocab_ids
+from sql_tokenizer import SqlTargetTokenizer, load_target_tokenizer
+
+DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+DB_PATH = 'data/flight_database.db'
+MAX_NEW_TOKENS = 256
+
+
+class SqlFragmentTrie:
+    '''
+    Token-level trie of whole SQL words (schema identifiers such as
+    airport_service_1.city_code, keywords, recurring literals). A word starts
+    at a token whose SentencePiece piece begins with "▁"; given the tokens of
+    the word being generated, forced_span returns the continuation when only
+    one entry can follow.
+    '''
+
+    def __init__(self, word_start_ids):
+        self.word_start_ids = word_start_ids
+        self.root = {}
+        self.num_words = 0
+
+    def add(self, token_ids):
+        node = self.root
+        for t in token_ids:
+            node = node.setdefault(t, {})
+        if None not in node:
+            node[None] = True  # end-of-word marker
+            self.num_words += 1
+
+    @classmethod
+    def build(cls, tokenizer, target_ids, min_count=2, db_path=DB_PATH):
+        '''
+        Words that occur at least min_count times in the tokenized targets,
+        plus every table and column name of the database.
+        '''
+        base = tokenizer.base_tokenizer if isinstance(tokenizer, SqlTargetTokenizer) else tokenizer
+        pieces = base.convert_ids_to_tokens(list(range(len(base))))
+        word_start_ids = {i for i, p in enumerate(pieces) if p.startswith("▁")}
+        # Added SQL words are complete words by themselves
+        word_start_ids.update(range(len(base), len(tokenizer)))
+        trie = cls(word_start_ids)
+
+        counts = Counter()
+        for ids in target_ids:
+            counts.update(trie.split_words([i for i in ids.tolist() if i not in base.all_special_ids]))
+        for word, count in counts.items():
+            if count >= min_count:
+                trie.add(word)
+
+        if db_path is not None and os.path.exists(db_path):
+            for name in schema_names(db_path):
+                trie.add(base(name, add_special_tokens=False)["input_ids"])
+        return trie
+
+    def split_words(self, ids):
+        words, current = [], []
+        for i in ids:
+            if i in self.word_start_ids and current:
+                words.append(tuple(current))
+                current = []
+            current.append(i)
+        if current:
+            words.append(tuple(current))
+        return words
+
+    def current_word(self, ids):
+        # Tokens of the (possibly unfinished) word at the end of ids
+        for start in range(len(ids) - 1, -1, -1):
+            if ids[start] in self.word_start_ids:
+                return ids[start:]
+        return []
+
+    def forced_span(self, ids, max_len):
+        '''
+        Tokens that must follow ids if the current word is to end as one of
+        the trie's words: followed while each node has a single child and is
+        not itself the end of a word.
+        '''
+        node = self.root
+        for t in self.current_word(ids):
+            node = node.get(t)
+            if node is None:
+                return []
+        span = []
+        while len(span) < max_len and len(node) == 1 and None not in node:
+            (t, node), = node.items()
+            span.append(t)
+        return span
+
+
+def schema_names(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        tables = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        names = set(tables)
+        for table in tables:
+            names.update(r[1] for r in conn.execute(f"PRAGMA table_info({table})"))
+        return sorted(names)
+    finally:
+        conn.close()
+
+
+def crop_past(past_key_values, length):
+    # Drop decoder self-attention cache entries beyond `length` positions
+    if hasattr(past_key_values, "crop"):
+        past_key_values.crop(length)
+        return past_key_values
+    return tuple((k[:, :, :length], v[:, :, :length], *rest) for k, v, *rest in past_key_values)
+
+
+def fast_forward_decode_row(model, encoder_hidden, enc_mask, max_new_tokens, trie, stats=None):
+    '''
+    Greedy decoding of a single sequence. Whenever the trie forces a span,
+    it is fed together with the newly predicted token in one forward pass;
+    the longest prefix of the span that matches the model's own argmax is
+    kept and the cache is cropped after it, so the result is the greedy one.
+    '''
+    config = model.config
+    dec = [config.decoder_start_token_id]
+    feed, span = dec[:], []
+    past = None
+
+    while True:
+        logits, past = t5_decoder_step(model, torch.tensor([feed], device=encoder_hidden.device),
+                                       encoder_hidden, enc_mask, past)
+        if stats is not None:
+            stats["forward_passes"] += 1
+        # preds[j] is the greedy token after feed[:j + 1]; feed[1:] is the proposed span
+        preds = full_vocab_ids(model, logits[0].argmax(dim=-1)).tolist()
+        accepted = 0
+        while accepted < len(span) and preds[accepted] == span[accepted]:
+            accepted += 1
+        dec.extend(span[:accepted])
+        if accepted < len(span):
+            past = crop_past(past, len(dec))
+        if stats is not None:
+            stats["forced_tokens"] += accepted
+
+        next_token = preds[accepted]
+        dec.append(next_token)
+        if next_token == config.eos_token_id or len(dec) - 1 >= max_new_tokens:
+            return dec
+
+        # Leave room for the token predicted after the span
+        span = trie.forced_span(dec, max_new_tokens - len(dec))
+        feed = [next_token] + span
+
+
+def fast_forward_decode(model, enc_in, enc_mask, max_new_tokens, trie, stats=None):
+    '''
+    Drop-in for greedy_decode using trie fast-forwarding. Rows are decoded one
+    at a time (their forced spans differ) and padded like greedy_decode; main
+    compares it with batched greedy decoding at the eval batch size.
+    '''
+    config = model.config
+    encoder_hidden = model.encoder(input_ids=enc_in, attention_mask=enc_mask).last_hidden_state
+    rows = []
+    for i in range(enc_in.size(0)):
+        length = int(enc_mask[i].sum())
+        rows.append(fast_forward_decode_row(model, encoder_hidden[i:i + 1, :length], enc_mask[i:i + 1, :length],
+                                            max_new_tokens, trie, stats))
+
+    width = max(len(r) for r in rows)
+    dec = torch.full((len(rows), width), config.pad_token_id, dtype=torch.long, device=enc_in.device)
+    for i, row in enumerate(rows):
+        dec[i, :len(row)] = torch.tensor(row, device=enc_in.device)
+    return dec
+
+
+def load_fast_forward_decoder(tokenizer, train_targets, min_count=2):
+    '''
+    decode_fn for generate_sql that fast-forwards over the SQL words of the
+    training targets (train_targets: T5Dataset.decoder_targets).
+    '''
+    trie = SqlFragmentTrie.build(tokenizer, train_targets, min_count)
+    print(f"Fast-forward trie holds {trie.num_words} words")
+    return functools.partial(fast_forward_decode, trie=trie)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Greedy decoding with schema-identifier fast-forwarding')
+    parser.add_argument('--experiment_name', type=str, default='ft_experiment',
+                        help="Loads the checkpoint from checkpoints/<experiment_name>")
+    parser.add_argument('--split', type=str, default="dev", choices=["dev", "test"])
+    parser.add_argument('--test_batch_size', type=int, default=16)
+    parser.add_argument('--min_count', type=int, default=2,
+                        help="Minimum train frequency for a word to enter the trie")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    checkpoint_dir = f"checkpoints/{args.experiment_name}"
+    tokenizer = load_target_tokenizer(checkpoint_dir, T5TokenizerFast.from_pretrained(checkpoint_dir))
+    target_tokenizer = tokenizer if isinstance(tokenizer, SqlTargetTokenizer) else None
+    model = load_pretrained_fast(checkpoint_dir).to(DEVICE)
+
+    train_targets = get_dataloader(args.test_batch_size, "train", target_tokenizer=target_tokenizer).dataset
+    trie = SqlFragmentTrie.build(tokenizer, train_targets.decoder_targets, args.min_count)
+    print(f"Trie holds {trie.num_words} words")
+
+    loader = get_dataloader(args.test_batch_size, args.split, target_tokenizer=target_tokenizer)
+    stats = {"forward_passes": 0, "forced_tokens": 0}
+    greedy_secs = ff_secs = 0.0
+    greedy_passes = identical = total = 0
+
+    with torch.no_grad():
+        for batch in tqdm(loader, desc=f"{args.split}", ncols=100):
+            enc_in, enc_mask = batch[0].to(DEVICE), batch[1].to(DEVICE)
+
+            # Baseline: the padded-batch greedy decoding that generate_sql does
+            start = time.perf_counter()
+            greedy = generate_ids(model, enc_in, enc_mask, MAX_NEW_TOKENS)
+            greedy_secs += time.perf_counter() - start
+            greedy_passes += greedy.size(1) - 1
+
+            start = time.perf_counter()
+            fast = fast_forward_decode(model, enc_in, enc_mask, MAX_NEW_TOKENS, trie, stats)
+            ff_secs += time.perf_counter() - start
+
+            for g, f in zip(tokenizer.batch_decode(greedy, skip_special_tokens=True),
+                            tokenizer.batch_decode(fast, skip_special_tokens=True)):
+                identical += g.strip() == f.strip()
+                total += 1
+
+    print(f"Batched greedy (batch size {args.test_batch_size}): {greedy_passes} forward passes, "
+          f"{greedy_secs:.1f}s ({total / greedy_secs:.2f} queries/s)")
+    print(f"Fast-forward: {stats['forward_passes']} forward passes, {ff_secs:.1f}s "
+          f"({total / ff_secs:.2f} queries/s, {stats['forced_tokens']} tokens accepted from the trie)")
+    print(f"Speedup over batched greedy {greedy_secs / ff_secs:.2f}x | "
+          f"identical outputs {identical / total * 100:.1f}%")
+
+
+if __name__ == "__main__":
+    main()
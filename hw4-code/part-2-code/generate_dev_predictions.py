@@ -1,91 +1,123 @@
-import sqlite3
-import pickle
-from transformers import T5TokenizerFast, T5ForConditionalGeneration
+import os
+import time
+import argparse
+from transformers import T5TokenizerFast
 import torch
+from torch.nn.utils.rnn import pad_sequence
 from tqdm import tqdm
 
-# Define the database connection
-DB_PATH = 'data/flight_database.db'  # Adjust the path to your database
+from generation_cache import GenerationCache, model_fingerprint, generation_settings
+from t5_utils import load_pretrained_fast, generate_sql
+from sql_tokenizer import SqlTargetTokenizer, load_target_tokenizer
+from load_data import T5Dataset, load_lines, PAD_IDX
+from fast_forward import load_fast_forward_decoder
+from utils import compute_records, write_queries_and_records, load_ground_truth, score_predictions
 
 # Path to the trained model and tokenizer
 MODEL_PATH = './checkpoints/ft_experiment'  # Adjust to your model's checkpoint directory
 TOKENIZER_PATH = 't5-small'
-
-# Function to execute SQL queries and return the results
-def execute_sql_query(sql_query):
-    # Connect to the database
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    try:
-        cursor.execute(sql_query)
-        records = cursor.fetchall()  # Fetch all the results
-        return records
-    except Exception as e:
-        print(f"Error executing SQL query: {e}")
-        return []
-    finally:
-        conn.close()
-
-# Read the SQL queries from the file (assuming each query is on a new line)
-def read_sql_file(sql_file_path):
-    with open(sql_file_path, 'r') as f:
-        queries = f.readlines()
-    return queries
-
-# Function to save the results to a pickle file
-def save_results_to_pkl(results, output_pkl_path):
-    with open(output_pkl_path, 'wb') as f:
-        pickle.dump(results, f)
+GEN_CACHE_PATH = 'cache/t5_generation_cache.pkl'  # Set to None to keep the cache in memory only
+MAX_NEW_TOKENS = 256
+MAX_ENC_LEN = 256  # as in T5Dataset
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Batched SQL prediction (and execution) for a data split')
+    parser.add_argument('--model_path', type=str, default=MODEL_PATH)
+    parser.add_argument('--data_folder', type=str, default='data')
+    parser.add_argument('--split', type=str, default='dev', choices=['train', 'dev', 'test'])
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--output_name', type=str, default='t5_ft',
+                        help="Writes results/<output_name>_<split>.sql and records/<output_name>_<split>.pkl")
+    parser.add_argument('--no_cache', action='store_true', help="Do not use the persistent generation cache")
+    parser.add_argument('--fast_forward', action='store_true',
+                        help="Decode with trie fast-forwarding over SQL words from <data_folder>/train.sql "
+                             "(same outputs as greedy decoding)")
+    return parser.parse_args()
 
 # Initialize model and tokenizer
-def load_model_and_tokenizer():
+def load_model_and_tokenizer(model_path=MODEL_PATH):
     tokenizer = T5TokenizerFast.from_pretrained(TOKENIZER_PATH)
-    model = T5ForConditionalGeneration.from_pretrained(MODEL_PATH).to(torch.device("cuda" if torch.cuda.is_available() else "cpu"))
+    model = load_pretrained_fast(model_path)
     return tokenizer, model
 
 # Generate SQL queries using the fine-tuned T5 model
-def generate_sql_queries(model, tokenizer, dev_data):
+def generate_sql_queries(model, tokenizer, nl_queries, batch_size, cache=None, model_path=MODEL_PATH,
+                         decode_fn=None):
+    '''
+    Batched greedy generation. Inputs are sorted by token length so each
+    batch carries little padding; the queries are returned in input order.
+    decode_fn is passed on to generate_sql.
+    '''
     model.eval()
-    generated_sqls = []
+    # Models trained with --sql_target_vocab emit ids beyond the T5 vocabulary
+    output_tokenizer = load_target_tokenizer(model_path, tokenizer)
+    encoded = [torch.tensor(ids) for ids in
+               tokenizer(nl_queries, truncation=True, max_length=MAX_ENC_LEN)["input_ids"]]
+    order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]))
+    generated_sqls = [None] * len(encoded)
 
     with torch.no_grad():
-        for text in tqdm(dev_data, desc="Generating SQL queries", ncols=100):
-            # Tokenize the input text
-            inputs = tokenizer(text, return_tensors="pt").to(model.device)
-            outputs = model.generate(input_ids=inputs["input_ids"], max_length=256)
-
-            sql_query = tokenizer.decode(outputs[0], skip_special_tokens=True)
-            generated_sqls.append(sql_query)
+        for start in tqdm(range(0, len(order), batch_size), desc="Generating SQL queries", ncols=100):
+            idx = order[start:start + batch_size]
+            enc_in = pad_sequence([encoded[i] for i in idx], batch_first=True, padding_value=PAD_IDX)
+            enc_mask = (enc_in != PAD_IDX).long()
+            sqls = generate_sql(model, output_tokenizer, enc_in.to(model.device), enc_mask.to(model.device),
+                                MAX_NEW_TOKENS, cache, decode_fn)
+            for i, sql in zip(idx, sqls):
+                generated_sqls[i] = sql
 
     return generated_sqls
 
 # Main function
 def main():
-    # Adjust the path to your dev set or input data
-    dev_data = ["Query 1", "Query 2", "Query 3"]  # Replace with your actual dev set queries
+    args = get_args()
+    nl_queries = load_lines(os.path.join(args.data_folder, f"{args.split}.nl"))
+    sql_path = f"results/{args.output_name}_{args.split}.sql"
+    record_path = f"records/{args.output_name}_{args.split}.pkl"
 
     # Load model and tokenizer
-    tokenizer, model = load_model_and_tokenizer()
-
-    # Generate SQL queries from the dev set
-    generated_sqls = generate_sql_queries(model, tokenizer, dev_data)
-
-    # Save the generated SQL queries to a .sql file
-    with open('results/t5_ft_dev.sql', 'w') as f:
-        for sql in generated_sqls:
-            f.write(f"{sql}\n")
-
-    # Execute the SQL queries and get the results
-    all_results = []
-    for sql_query in generated_sqls:
-        results = execute_sql_query(sql_query)
-        all_results.append(results)
-
-    # Save the results into a .pkl file
-    save_results_to_pkl(all_results, 'records/t5_ft_dev.pkl')
-
-    print("SQL queries and results have been saved to 't5_ft_dev.sql' and 't5_ft_dev.pkl'")
+    start = time.perf_counter()
+    tokenizer, model = load_model_and_tokenizer(args.model_path)
+    decode_fn = None
+    if args.fast_forward:
+        output_tokenizer = load_target_tokenizer(args.model_path, tokenizer)
+        target_tokenizer = output_tokenizer if isinstance(output_tokenizer, SqlTargetTokenizer) else None
+        train_set = T5Dataset(args.data_folder, "train", target_tokenizer)
+        decode_fn = load_fast_forward_decoder(output_tokenizer, train_set.decoder_targets)
+    cache = None
+    if not args.no_cache:
+        cache = GenerationCache(tokenizer, path=GEN_CACHE_PATH)
+        cache.set_fingerprint(model_fingerprint(model), **generation_settings(model, MAX_NEW_TOKENS, decode_fn))
+    load_secs = time.perf_counter() - start
+
+    # Generate SQL queries for the split
+    start = time.perf_counter()
+    generated_sqls = generate_sql_queries(model, tokenizer, nl_queries, args.batch_size, cache, args.model_path,
+                                          decode_fn)
+    gen_secs = time.perf_counter() - start
+    if cache is not None:
+        print(cache.report())
+        cache.save()
+
+    # Execute them in parallel and save queries plus (records, error_msgs)
+    start = time.perf_counter()
+    records, error_msgs = compute_records(generated_sqls)
+    exec_secs = time.perf_counter() - start
+    os.makedirs("results", exist_ok=True)
+    os.makedirs("records", exist_ok=True)
+    write_queries_and_records(generated_sqls, records, error_msgs, sql_path, record_path)
+
+    n = len(nl_queries)
+    print(f"Saved {n} queries to {sql_path} and their records to {record_path}")
+    print(f"Load {load_secs:.1f}s | generation {gen_secs:.1f}s ({n / gen_secs:.1f} queries/s) | "
+          f"execution {exec_secs:.1f}s ({n / exec_secs:.1f} queries/s) | "
+          f"errors {sum(map(bool, error_msgs)) / n * 100:.1f}%")
+
+    gt_path = os.path.join(args.data_folder, f"{args.split}.sql")
+    if os.path.exists(gt_path):
+        gt_qs, gt_records = load_ground_truth(gt_path)
+        sql_em, record_em, record_f1 = score_predictions(gt_qs, gt_records, generated_sqls, records)
+        print(f"{args.split}: SQL EM {sql_em:.4f} | record EM {record_em:.4f} | record F1 {record_f1:.4f}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,114 @@
+# generation_cache.py
+
+import hashlib
+import os
+import pickle
+import re
+from collections import OrderedDict
+
+import torch
+
+
+def normalize_nl(text):
+    '''
+    Canonical form of a natural language query: lowercased with runs of
+    whitespace collapsed, so trivially different phrasings share a cache entry.
+    '''
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def model_fingerprint(model):
+    '''
+    Hash of the model config and weights. Any change to the checkpoint (e.g. an
+    extra training epoch) produces a new fingerprint and thus new cache keys.
+    '''
+    h = hashlib.sha1(model.config.to_json_string().encode())
+    with torch.no_grad():
+        for name, tensor in model.state_dict().items():
+            h.update(name.encode())
+            h.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()
+
+
+def generation_settings(model, max_new_tokens, decode_fn=None):
+    '''
+    The generation settings that, next to model_fingerprint, key cached
+    outputs. Every entry point builds them here, so training, prediction and
+    the server share a persisted cache for the same model and decoding.
+    '''
+    # A restricted output head is not part of the state dict, so its vocabulary is hashed here
+    vocab_ids = getattr(model.lm_head, "vocab_ids", None)
+    restrict_vocab = None if vocab_ids is None else hashlib.sha1(vocab_ids.cpu().numpy().tobytes()).hexdigest()
+    return {"max_new_tokens": max_new_tokens, "restrict_vocab": restrict_vocab,
+            "decode": "greedy" if decode_fn is None else "fast_forward"}
+
+
+class GenerationCache:
+    '''
+    LRU-bounded memo of generated SQL, keyed by the normalized input token ids,
+    the checkpoint fingerprint and the generation settings.
+    '''
+
+    def __init__(self, tokenizer, max_size=4096, path=None):
+        self.tokenizer = tokenizer
+        self.max_size = max_size
+        self.path = path
+        self.entries = OrderedDict()
+        self.fingerprint = None
+        self.hits = 0
+        self.misses = 0
+
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.entries = pickle.load(f)
+            self._evict()
+
+    def set_fingerprint(self, fingerprint, **gen_kwargs):
+        # Generation settings are part of the key: a beam search result must not
+        # be served for a greedy request.
+        self.fingerprint = (fingerprint, tuple(sorted(gen_kwargs.items())))
+
+    def key_for_text(self, text):
+        ids = self.tokenizer(normalize_nl(text), add_special_tokens=True)["input_ids"]
+        return (self.fingerprint, tuple(ids))
+
+    def key_for_ids(self, input_ids):
+        if isinstance(input_ids, torch.Tensor):
+            input_ids = input_ids.tolist()
+        text = self.tokenizer.decode(input_ids, skip_special_tokens=True)
+        return self.key_for_text(text)
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return (f"Generation cache: {self.hits}/{lookups} hits "
+                f"({self.hit_rate() * 100:.2f}% hit rate), {len(self.entries)} entries")
@@ -0,0 +1,204 @@
+# llm_backends.py
+
+import time
+import zlib
+from abc import ABC, abstractmethod
+
+import torch
+from tqdm import tqdm
+from transformers import StoppingCriteriaList
+
+from prompting_utils import StopOnStrings, STOP_STRINGS
+
+DEVICE = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+
+class LLMBackend(ABC):
+    '''
+    What the prompting pipeline needs from a language model: a tokenizer
+    (for prompt-length budgets), batched generation of prompt continuations
+    that end at the first stop string, and optional reuse of work for a
+    prompt prefix shared by many prompts.
+    '''
+
+    name = "backend"
+    tokenizer = None
+
+    def prefix_cache(self, prefix):
+        # Whatever can be precomputed once for prompts starting with prefix (nothing by default)
+        return None
+
+    @abstractmethod
+    def generate(self, prompts, batch_size=1, prefix=None, max_new_tokens=256, on_result=None):
+        '''
+        Continuations of the prompts, in order. on_result(i, response) is
+        called for every prompt as soon as its response is ready.
+        '''
+
+
+class HFBackend(LLMBackend):
+    '''Greedy generation with a Hugging Face causal LM.'''
+
+    def __init__(self, tokenizer, model, name="hf"):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.name = name
+        self._prefix_caches = {}
+
+    def prefix_cache(self, prefix):
+        '''
+        Token ids of the shared prompt prefix and its key/value cache, computed
+        once per prefix. The cache is kept in the legacy tuple format, which
+        generate treats as already-processed tokens and which is never modified
+        in place.
+        '''
+        if prefix not in self._prefix_caches:
+            prefix_ids = self.tokenizer(prefix)["input_ids"]
+            with torch.no_grad():
+                out = self.model(input_ids=torch.tensor([prefix_ids], device=DEVICE), use_cache=True)
+            past = out.past_key_values
+            if hasattr(past, "to_legacy_cache"):
+                past = past.to_legacy_cache()
+            self._prefix_caches[prefix] = (prefix_ids, past)
+        return self._prefix_caches[prefix]
+
+    def generate(self, prompts, batch_size=1, prefix=None, max_new_tokens=256, on_result=None):
+        '''
+        Prompts are sorted by token length so each batch needs little padding,
+        left-padded (decoder-only models continue from the last position), and
+        the responses are returned in the original order.
+
+        With a prefix, prompts that start with the prefix tokens only prefill
+        their own suffix: the cached keys/values are shared across the batch
+        and the suffixes are padded between the prefix and the suffix
+        (positions come from the attention mask, so they stay exact).
+
+        Each sequence stops at its first stop string (see StopOnStrings) and
+        only the generated continuation is decoded.
+        '''
+        tokenizer, model = self.tokenizer, self.model
+        encoded = tokenizer(prompts)["input_ids"] if prompts else []
+        order = sorted(range(len(prompts)), key=lambda i: len(encoded[i]))
+        pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        responses = [None] * len(prompts)
+
+        def finish(idx, outputs, prompt_len):
+            continuations = outputs[:, prompt_len:]
+            for i, response in zip(idx, tokenizer.batch_decode(continuations, skip_special_tokens=True)):
+                responses[i] = response
+                if on_result is not None:
+                    on_result(i, response)
+
+        cached = []
+        if prefix is not None:
+            prefix_ids, past = self.prefix_cache(prefix)
+            n_prefix = len(prefix_ids)
+            # A prompt whose tokens merge across the prefix boundary is prefilled in full
+            cached = [i for i in order if encoded[i][:n_prefix] == prefix_ids and len(encoded[i]) > n_prefix]
+        uncached = sorted(set(order) - set(cached), key=order.index)
+
+        for start in tqdm(range(0, len(cached), batch_size)):
+            idx = cached[start:start + batch_size]
+            suffixes = [encoded[i][n_prefix:] for i in idx]
+            width = max(len(suffix) for suffix in suffixes)
+            input_ids = [prefix_ids + [pad_token_id] * (width - len(x)) + x for x in suffixes]
+            attention_mask = [[1] * n_prefix + [0] * (width - len(x)) + [1] * len(x) for x in suffixes]
+            batch_past = tuple(tuple(t.expand(len(idx), *t.shape[1:]) for t in layer) for layer in past)
+            outputs = model.generate(
+                input_ids=torch.tensor(input_ids, device=DEVICE),
+                attention_mask=torch.tensor(attention_mask, device=DEVICE),
+                past_key_values=batch_past,
+                max_new_tokens=max_new_tokens,
+                pad_token_id=pad_token_id,
+                stopping_criteria=StoppingCriteriaList([StopOnStrings(tokenizer, n_prefix + width)]),
+            )
+            finish(idx, outputs, n_prefix + width)
+
+        padding_side = tokenizer.padding_side
+        tokenizer.padding_side = "left"
+        try:
+            for start in tqdm(range(0, len(uncached), batch_size)):
+                idx = uncached[start:start + batch_size]
+                batch = tokenizer([prompts[i] for i in idx], padding=True, return_tensors="pt").to(DEVICE)
+                prompt_len = batch["input_ids"].size(1)
+                outputs = model.generate(**batch, max_new_tokens=max_new_tokens, pad_token_id=pad_token_id,
+                                         stopping_criteria=StoppingCriteriaList([StopOnStrings(tokenizer, prompt_len)]))
+                finish(idx, outputs, prompt_len)
+        finally:
+            tokenizer.padding_side = padding_side
+        return responses
+
+
+class TinyRandomBackend(HFBackend):
+    '''
+    A randomly initialized two-layer Gemma with a small byte-level BPE
+    tokenizer trained on the given texts: no downloads, real transformer
+    generation (prefill, KV cache, batching) at a tiny fraction of the cost.
+    Its outputs are meaningless but deterministic for a given seed.
+    '''
+
+    def __init__(self, texts, seed=0, vocab_size=2000, hidden_size=64, num_layers=2):
+        from tokenizers import Tokenizer, models, trainers, pre_tokenizers, decoders, processors
+        from transformers import PreTrainedTokenizerFast, GemmaConfig, GemmaForCausalLM
+
+        specials = ["<pad>", "<eos>", "<bos>", "<unk>"]
+        bpe = Tokenizer(models.BPE(unk_token="<unk>"))
+        bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+        bpe.decoder = decoders.ByteLevel()
+        bpe.train_from_iterator(list(texts) + list(STOP_STRINGS), trainers.BpeTrainer(
+            vocab_size=vocab_size, special_tokens=specials, initial_alphabet=pre_tokenizers.ByteLevel.alphabet()))
+        bpe.post_processor = processors.TemplateProcessing(single="<bos> $A",
+                                                           special_tokens=[("<bos>", bpe.token_to_id("<bos>"))])
+        tokenizer = PreTrainedTokenizerFast(tokenizer_object=bpe, bos_token="<bos>", eos_token="<eos>",
+                                            pad_token="<pad>", unk_token="<unk>",
+                                            model_input_names=["input_ids", "attention_mask"])
+        tokenizer.name_or_path = f"tiny-bpe-{vocab_size}"
+
+        config = GemmaConfig(vocab_size=len(tokenizer), hidden_size=hidden_size, intermediate_size=2 * hidden_size,
+                             num_hidden_layers=num_layers, num_attention_heads=4, num_key_value_heads=1,
+                             head_dim=hidden_size // 4, hidden_activation="gelu_pytorch_tanh",
+                             pad_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id,
+                             bos_token_id=tokenizer.bos_token_id)
+        torch.manual_seed(seed)
+        model = GemmaForCausalLM(config).to(DEVICE).eval()
+        super().__init__(tokenizer, model, name="tiny")
+
+
+class WhitespaceTokenizer:
+    # Just enough of the tokenizer interface for prompt-length budgets
+    name_or_path = "whitespace"
+
+    def __call__(self, texts, add_special_tokens=True):
+        single = isinstance(texts, str)
+        ids = [[zlib.crc32(word.encode()) for word in text.split()] for text in ([texts] if single else texts)]
+        return {"input_ids": ids[0] if single else ids}
+
+
+class ReplayBackend(LLMBackend):
+    '''
+    Deterministic stub: each prompt is answered with a line of a saved SQL
+    file (results/llm_test.sql by default), chosen by a hash of the prompt, in
+    the format a model continuation would have (" <sql>\\n"). secs_per_prompt
+    simulates generation time, so prompt construction, extraction and
+    evaluation can be measured in isolation.
+    '''
+
+    def __init__(self, path="results/llm_test.sql", secs_per_prompt=0.0):
+        with open(path) as f:
+            self.queries = [line.strip() for line in f if line.strip()]
+        self.secs_per_prompt = secs_per_prompt
+        self.tokenizer = WhitespaceTokenizer()
+        self.name = "replay"
+
+    def generate(self, prompts, batch_size=1, prefix=None, max_new_tokens=256, on_result=None):
+        responses = []
+        for start in range(0, len(prompts), batch_size):
+            batch = prompts[start:start + batch_size]
+            if self.secs_per_prompt:
+                time.sleep(self.secs_per_prompt * len(batch))
+            for i, prompt in enumerate(batch, start):
+                response = f" {self.queries[zlib.crc32(prompt.encode()) % len(self.queries)]}\n"
+                responses.append(response)
+                if on_result is not None:
+                    on_result(i, response)
+        return responses
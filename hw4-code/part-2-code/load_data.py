@@ -1,9 +1,10 @@
 # load_data.py
 
 import os
+import math
 from collections import Counter
 
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 from torch.nn.utils.rnn import pad_sequence
 import torch
 
@@ -11,25 +12,32 @@ import nltk
 nltk.download('punkt')
 from transformers import T5TokenizerFast
 
+from profiling import PROFILER
+
 PAD_IDX = 0
 
 
 class T5Dataset(Dataset):
-    def __init__(self, data_folder, split):
+    def __init__(self, data_folder, split, target_tokenizer=None):
         """
-        Dataset class for T5 preprocessing.
+        Dataset class for T5 preprocessing. An optional target_tokenizer (see
+        sql_tokenizer.SqlTargetTokenizer) replaces the T5 tokenizer for the
+        SQL decoder targets.
         """
         self.data_folder = data_folder
         self.split = split
         self.tokenizer = T5TokenizerFast.from_pretrained("google-t5/t5-small")
+        self.target_tokenizer = target_tokenizer
         self.bos_token_id = self.tokenizer.convert_tokens_to_ids("<extra_id_0>")
 
-        (
-            self.encoder_ids,
-            self.decoder_inputs,
-            self.decoder_targets,
-            self.initial_decoder_inputs,
-        ) = self.process_data(data_folder, split, self.tokenizer)
+        with PROFILER.span("data.tokenize", split=split):
+            (
+                self.encoder_ids,
+                self.decoder_inputs,
+                self.decoder_targets,
+                self.initial_decoder_inputs,
+            ) = self.process_data(data_folder, split, self.tokenizer)
+        PROFILER.count("data.examples", len(self.encoder_ids))
 
     def process_data(self, data_folder, split, tokenizer):
         nl_path = os.path.join(data_folder, f"{split}.nl")
@@ -64,14 +72,18 @@ class T5Dataset(Dataset):
 
             if split != "test":
                 sql = sql_lines[i]
-                tgt = tokenizer(
-                    sql + tokenizer.eos_token,
-                    truncation=True,
-                    max_length=max_dec_len,
-                    padding=False,
-                    return_tensors="pt",
-                )
-                tgt_ids = tgt["input_ids"].squeeze(0)
+                if self.target_tokenizer is not None:
+                    ids = self.target_tokenizer.encode(sql)[:max_dec_len - 1] + [tokenizer.eos_token_id]
+                    tgt_ids = torch.tensor(ids, dtype=torch.long)
+                else:
+                    tgt = tokenizer(
+                        sql + tokenizer.eos_token,
+                        truncation=True,
+                        max_length=max_dec_len,
+                        padding=False,
+                        return_tensors="pt",
+                    )
+                    tgt_ids = tgt["input_ids"].squeeze(0)
 
                 bos = torch.tensor([self.bos_token_id], dtype=torch.long)
                 dec_in = torch.cat([bos, tgt_ids[:-1]], dim=0)
@@ -98,6 +110,89 @@ class T5Dataset(Dataset):
         }
 
 
+def pack_dataset(dset):
+    """
+    Flatten a T5Dataset's variable-length id tensors into contiguous tensors in
+    shared memory, so that worker processes can read them without copies.
+    """
+    packed = {}
+    for field in ("encoder_ids", "decoder_inputs", "decoder_targets"):
+        seqs = getattr(dset, field)
+        if seqs[0] is None:
+            continue
+        offsets = torch.zeros(len(seqs) + 1, dtype=torch.long)
+        offsets[1:] = torch.tensor([len(x) for x in seqs]).cumsum(0)
+        packed[field] = (torch.cat(seqs).share_memory_(), offsets.share_memory_())
+    packed["initial_decoder_inputs"] = torch.tensor(dset.initial_decoder_inputs).share_memory_()
+    return packed
+
+
+class SharedT5Dataset(Dataset):
+    """
+    Read-only view over the output of pack_dataset, returning the same items as
+    T5Dataset.
+    """
+
+    def __init__(self, packed):
+        self.packed = packed
+
+    def _get(self, field, idx):
+        if field not in self.packed:
+            return None
+        flat, offsets = self.packed[field]
+        return flat[offsets[idx]:offsets[idx + 1]]
+
+    @property
+    def decoder_targets(self):
+        return [self._get("decoder_targets", i) for i in range(len(self))]
+
+    def __len__(self):
+        return len(self.packed["initial_decoder_inputs"])
+
+    def __getitem__(self, idx):
+        return {
+            "encoder_ids": self._get("encoder_ids", idx),
+            "decoder_inputs": self._get("decoder_inputs", idx),
+            "decoder_targets": self._get("decoder_targets", idx),
+            "initial_decoder_input": int(self.packed["initial_decoder_inputs"][idx]),
+        }
+
+
+class ResumableSampler(Sampler):
+    """
+    Shuffling sampler whose order depends only on (seed, epoch), so an
+    interrupted epoch can be replayed exactly and resumed at any position.
+    With num_replicas > 1 it also shards the permutation across data-parallel
+    ranks (padding by wrap-around so every rank sees the same number of samples).
+    """
+
+    def __init__(self, data_source, seed=42, num_replicas=1, rank=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = math.ceil(len(data_source) / num_replicas)
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch, start_index=0):
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.data_source), generator=generator).tolist()
+        if self.num_replicas > 1:
+            total = self.num_samples * self.num_replicas
+            order = (order * math.ceil(total / len(order)))[:total]
+            order = order[self.rank::self.num_replicas]
+        return iter(order[self.start_index:])
+
+    def __len__(self):
+        return max(self.num_samples - self.start_index, 0)
+
+
 def normal_collate_fn(batch):
     enc_list = [item["encoder_ids"] for item in batch]
     enc_padded = pad_sequence(enc_list, batch_first=True, padding_value=PAD_IDX)
@@ -125,18 +220,21 @@ def test_collate_fn(batch):
     return enc_padded, encoder_mask, initial_decoder_inputs
 
 
-def get_dataloader(batch_size, split):
+def get_dataloader(batch_size, split, seed=42, rank=0, world_size=1, target_tokenizer=None):
     data_folder = 'data'
-    dset = T5Dataset(data_folder, split)
-    shuffle = split == "train"
+    dset = T5Dataset(data_folder, split, target_tokenizer)
+    sampler = ResumableSampler(dset, seed, world_size, rank) if split == "train" else None
     collate_fn = normal_collate_fn if split != "test" else test_collate_fn
-    return DataLoader(dset, batch_size=batch_size, shuffle=shuffle, collate_fn=collate_fn)
+    # A private generator keeps the loader from drawing on the global torch RNG,
+    # so restoring the RNG state on resume reproduces dropout exactly
+    generator = torch.Generator().manual_seed(seed)
+    return DataLoader(dset, batch_size=batch_size, sampler=sampler, collate_fn=collate_fn, generator=generator)
 
 
-def load_t5_data(batch_size, test_batch_size):
-    train_loader = get_dataloader(batch_size, "train")
-    dev_loader = get_dataloader(test_batch_size, "dev")
-    test_loader = get_dataloader(test_batch_size, "test")
+def load_t5_data(batch_size, test_batch_size, seed=42, rank=0, world_size=1, target_tokenizer=None):
+    train_loader = get_dataloader(batch_size, "train", seed, rank, world_size, target_tokenizer)
+    dev_loader = get_dataloader(test_batch_size, "dev", target_tokenizer=target_tokenizer)
+    test_loader = get_dataloader(test_batch_size, "test", target_tokenizer=target_tokenizer)
     return train_loader, dev_loader, test_loader
 
 
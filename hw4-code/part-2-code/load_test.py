@@ -0,0 +1,74 @@
+# load_test.py
+
+import json
+import time
+import argparse
+import statistics
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from load_data import load_lines
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Load test for sql_server.py')
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8008')
+    parser.add_argument('--nl_path', type=str, default='data/dev.nl', help="Questions sent, cycled as needed")
+    parser.add_argument('--num_requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32],
+                        help="Clients sending requests back to back; one run per value")
+    parser.add_argument('--no_execute', action='store_true', help="Ask for SQL only")
+    return parser.parse_args()
+
+
+def send(url, text, execute):
+    body = json.dumps({"nl": text, "execute": execute}).encode()
+    request = urllib.request.Request(f"{url}/query", data=body, headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        json.load(response)
+    return time.perf_counter() - start
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def run(url, texts, num_requests, concurrency, execute):
+    '''Send num_requests questions from concurrency clients; returns (latencies, failures, wall secs).'''
+    latencies, failures = [], 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        futures = [pool.submit(send, url, texts[i % len(texts)], execute) for i in range(num_requests)]
+        for future in futures:
+            try:
+                latencies.append(future.result())
+            except Exception:
+                failures += 1
+    return latencies, failures, time.perf_counter() - start
+
+
+def get_health(url):
+    with urllib.request.urlopen(f"{url}/health") as response:
+        return json.load(response)
+
+
+def main():
+    args = get_args()
+    texts = load_lines(args.nl_path)
+    for concurrency in args.concurrency:
+        before = get_health(args.url)
+        latencies, failures, secs = run(args.url, texts, args.num_requests, concurrency, not args.no_execute)
+        after = get_health(args.url)
+        batches = after["batches"] - before["batches"]
+        mean_batch = (after["served"] - before["served"]) / max(batches, 1)
+
+        latencies.sort()
+        ms = [x * 1000 for x in latencies] or [float("nan")]
+        print(f"concurrency {concurrency}: {len(latencies) / secs:.1f} req/s | p50 {percentile(ms, 0.5):.1f} ms | "
+              f"p99 {percentile(ms, 0.99):.1f} ms | mean {statistics.mean(ms):.1f} ms | "
+              f"mean batch {mean_batch:.1f} | failed {failures}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# output_journal.py
+
+import os
+import json
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import DB_PATH, compute_record_with_budget, screen_query, open_thread_connection
+
+
+def prompt_hash(prompt):
+    return hashlib.sha1(prompt.encode()).hexdigest()
+
+
+class OutputJournal:
+    '''
+    Append-only JSONL log of generated outputs, one {"id", "input", "prompt",
+    "raw", "sql"} line per input, flushed and fsynced as it is written; "prompt"
+    is a hash of the full prompt the output was generated from. Reopening a
+    journal restores the entries whose input and prompt still match, so an
+    interrupted run only generates what is missing, while outputs of another
+    prompt configuration (shots, prompt type, retrieval, token budget) are
+    generated again. A line cut short by a crash is discarded.
+    '''
+
+    def __init__(self, path, inputs, prompts=None):
+        self.path = path
+        self.inputs = inputs
+        self.prompt_hashes = [prompt_hash(p) for p in (prompts if prompts is not None else inputs)]
+        self.entries = {}
+        if os.path.exists(path):
+            self._restore()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a")
+
+    def _restore(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        complete = data[:data.rfind(b"\n") + 1]
+        if len(complete) < len(data):
+            with open(self.path, "r+b") as f:
+                f.truncate(len(complete))
+        for line in complete.decode().splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            i = entry.get("id")
+            if (isinstance(i, int) and 0 <= i < len(self.inputs) and entry.get("input") == self.inputs[i]
+                    and entry.get("prompt") == self.prompt_hashes[i]):
+                self.entries[i] = entry
+
+    def pending(self):
+        return [i for i in range(len(self.inputs)) if i not in self.entries]
+
+    def append(self, i, raw, sql):
+        entry = {"id": i, "input": self.inputs[i], "prompt": self.prompt_hashes[i], "raw": raw, "sql": sql}
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.entries[i] = entry
+
+    def outputs(self):
+        '''Raw outputs and extracted queries in input order ("" for missing ones).'''
+        raw = [self.entries[i]["raw"] if i in self.entries else "" for i in range(len(self.inputs))]
+        sql = [self.entries[i]["sql"] if i in self.entries else "" for i in range(len(self.inputs))]
+        return raw, sql
+
+    def close(self):
+        self.file.close()
+
+
+class StreamingSqlExecutor:
+    '''
+    Executes queries as they are submitted instead of once a whole split has
+    been generated: screened with screen_query on the calling thread, then run
+    on a pool of threads with their own connections, each with a timeout_secs
+    budget.
+    '''
+
+    def __init__(self, num_threads=4, timeout_secs=120, db_path=DB_PATH):
+        self.timeout_secs = timeout_secs
+        self.connections = []
+        self.pool = ThreadPoolExecutor(num_threads, initializer=open_thread_connection,
+                                       initargs=(self.connections,))
+        self.screen_conn = sqlite3.connect(db_path)
+        self.results = {}
+        self.futures = {}
+
+    def submit(self, i, query):
+        status, error_msg = screen_query(self.screen_conn, query)
+        if status == "invalid":
+            self.results[i] = ([], error_msg)
+            return
+        self.futures[i] = self.pool.submit(self._run, i, query)
+
+    def _run(self, i, query):
+        return compute_record_with_budget(i, query, self.timeout_secs)
+
+    def records(self, n):
+        '''Wait for everything submitted and return (records, error_msgs) for ids 0..n-1.'''
+        for i, future in self.futures.items():
+            _, rec, error_msg = future.result()
+            self.results[i] = (rec, error_msg)
+        self.futures = {}
+        results = [self.results.get(i, ([], "Query not executed")) for i in range(n)]
+        return [rec for rec, _ in results], [error_msg for _, error_msg in results]
+
+    def close(self):
+        self.pool.shutdown()
+        for conn in self.connections:
+            conn.close()
+        self.screen_conn.close()
@@ -0,0 +1,124 @@
+# profiling.py
+
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+
+
+class _NullSpan:
+    # Shared no-op context returned while profiling is off
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Profiler:
+    '''
+    Named spans and counters around the hot paths of a run (tokenization,
+    training steps, generation, SQL execution, metrics). Disabled by default:
+    span() then returns a shared no-op context and count() returns at once,
+    so instrumented code pays one attribute check per call.
+
+    Spans nest per thread and are recorded as complete events with their
+    thread id; export_chrome_trace writes them (and the counters) in the
+    Chrome trace format read by chrome://tracing and Perfetto. With
+    cuda_sync, a span synchronizes CUDA before it ends so that asynchronous
+    kernels are charged to the span that launched them.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.cuda_sync = False
+        self.events = []
+        self.counter_events = []
+        self.counters = defaultdict(float)
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._flushed = {}
+
+    def enable(self, cuda_sync=True):
+        self.enabled = True
+        self.cuda_sync = cuda_sync and torch.cuda.is_available()
+        self._origin = time.perf_counter()
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(name, args)
+
+    @contextmanager
+    def _span(self, name, args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.cuda_sync:
+                torch.cuda.synchronize()
+            end = time.perf_counter()
+            event = {"name": name, "ph": "X", "ts": (start - self._origin) * 1e6, "dur": (end - start) * 1e6,
+                     "pid": os.getpid(), "tid": threading.get_ident()}
+            if args:
+                event["args"] = args
+            with self._lock:
+                self.events.append(event)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += value
+            self.counter_events.append({"name": name, "ph": "C", "ts": (time.perf_counter() - self._origin) * 1e6,
+                                        "pid": os.getpid(), "args": {name: self.counters[name]}})
+
+    def totals(self):
+        '''{span name: (calls, total secs)}'''
+        totals = defaultdict(lambda: [0, 0.0])
+        with self._lock:
+            events = list(self.events)
+        for event in events:
+            totals[event["name"]][0] += 1
+            totals[event["name"]][1] += event["dur"] / 1e6
+        return {name: tuple(x) for name, x in totals.items()}
+
+    def summary(self):
+        '''Table of spans by total time, followed by the counters.'''
+        totals = sorted(self.totals().items(), key=lambda x: -x[1][1])
+        wall = time.perf_counter() - self._origin
+        lines = [f"{'span':<24}{'calls':>8}{'total s':>11}{'mean ms':>11}{'% wall':>8}"]
+        for name, (calls, secs) in totals:
+            lines.append(f"{name:<24}{calls:>8}{secs:>11.2f}{secs / calls * 1000:>11.2f}{secs / wall * 100:>8.1f}")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:<24}{value:>8g}")
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._lock:
+            trace = {"traceEvents": self.events + self.counter_events, "displayTimeUnit": "ms"}
+        with open(path, "w") as f:
+            json.dump(trace, f)
+
+    def log_to_wandb(self, step=None):
+        '''Log the time spent in each span (and counter growth) since the last call.'''
+        import wandb
+        metrics = {}
+        for name, (_, secs) in self.totals().items():
+            metrics[f"profile/{name}_s"] = secs - self._flushed.get(name, 0.0)
+            self._flushed[name] = secs
+        for name, value in list(self.counters.items()):
+            metrics[f"profile/{name}"] = value - self._flushed.get(f"#{name}", 0.0)
+            self._flushed[f"#{name}"] = value
+        wandb.log(metrics, step=step)
+
+
+PROFILER = Profiler()
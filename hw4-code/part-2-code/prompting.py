@@ -1,64 +1,192 @@
-import os, argparse, random
-from tqdm import tqdm
+import os, time, argparse, random
 
 import torch
 from transformers import GemmaTokenizerFast, GemmaForCausalLM
 from transformers import GemmaTokenizer, AutoModelForCausalLM
 from transformers import BitsAndBytesConfig
 
-from utils import set_random_seeds, compute_metrics, save_queries_and_records, compute_records
+from utils import set_random_seeds, compute_records
+from utils import load_ground_truth, score_predictions, write_queries_and_records
 from prompting_utils import read_schema, extract_sql_query, save_logs
 from load_data import load_prompting_data
+from example_index import ExampleIndex
+from schema_index import SchemaIndex
+from output_journal import OutputJournal, StreamingSqlExecutor
+from llm_backends import HFBackend, TinyRandomBackend, ReplayBackend
 
 DEVICE = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 MAX_NEW_TOKENS = 256  # max tokens to generate
+MODEL_IDS = {"gemma": "google/gemma-1.1-2b-it", "codegemma": "google/codegemma-7b-it"}
 
 def get_args():
     parser = argparse.ArgumentParser(description='Text-to-SQL experiments with prompting.')
     parser.add_argument('-s', '--shot', type=int, default=0, help='Number of examples for k-shot')
-    parser.add_argument('-p', '--ptype', type=int, default=0, help='Prompt type')
-    parser.add_argument('-m', '--model', type=str, default='gemma', help='Model: gemma or codegemma')
+    parser.add_argument('-p', '--ptype', type=int, default=0, choices=[0, 1, 2],
+                        help='Prompt type: 0 no schema, 1 tables relevant to the sentence, 2 full schema')
+    parser.add_argument('-m', '--model', type=str, default='gemma', choices=['gemma', 'codegemma', 'tiny', 'replay'],
+                        help='Model: gemma or codegemma, a tiny random local model, or replayed SQL (no model)')
     parser.add_argument('-q', '--quantization', action='store_true', help='Use quantized model')
     parser.add_argument('--seed', type=int, default=42, help='Random seed')
     parser.add_argument('--experiment_name', type=str, default='experiment', help="Experiment name")
+    parser.add_argument('-b', '--batch_size', type=int, default=8,
+                        help='Prompts per generate call (1 reproduces the unbatched loop)')
+    parser.add_argument('--benchmark_batching', type=int, default=0, metavar='N',
+                        help='Compare batched and unbatched generation on the first N dev sentences and exit')
+    parser.add_argument('--prefix_cache', action='store_true',
+                        help='Prefill the shared k-shot prefix once and reuse its key/value cache for every prompt')
+    parser.add_argument('--benchmark_prefix_cache', type=int, nargs='+', default=None, metavar='K',
+                        help='Compare prefill time with and without the prefix cache for each k and exit')
+    parser.add_argument('--benchmark_sentences', type=int, default=32,
+                        help='Dev sentences used by --benchmark_prefix_cache')
+    parser.add_argument('--retrieve', action='store_true',
+                        help='Use the k most similar training examples (BM25) instead of the first k')
+    parser.add_argument('--shot_token_budget', type=int, default=None,
+                        help='Max prompt tokens spent on retrieved examples')
+    parser.add_argument('--index_dir', type=str, default=None,
+                        help='Example index location (defaults to data/example_index_<model>)')
+    parser.add_argument('--replay_path', type=str, default='results/llm_test.sql',
+                        help='SQL lines answered by the replay backend')
+    parser.add_argument('--replay_latency', type=float, default=0.0,
+                        help='Simulated generation seconds per prompt for the replay backend')
+    parser.add_argument('--benchmark_pipeline', type=int, default=0, metavar='N',
+                        help='Time each pipeline stage on the first N dev sentences and exit')
     return parser.parse_args()
 
-def create_prompt(sentence, k, train_x=None, train_y=None):
-    """Create a 0-shot or k-shot prompt for text-to-SQL."""
-    prompt = ""
-    # k-shot examples if available
+def format_example(x, y):
+    return f"Text: {x}\nSQL: {y}\n\n"
+
+def create_prefix(k, train_x=None, train_y=None, example_ids=None):
+    """
+    The k-shot examples a prompt starts with (empty for 0-shot): the first k
+    training pairs, or the given example_ids (e.g. retrieved ones) instead.
+    """
+    prefix = ""
     if k > 0 and train_x and train_y:
-        for i in range(k):
-            prompt += f"Text: {train_x[i]}\nSQL: {train_y[i]}\n\n"
-    # Target sentence
-    prompt += f"Text: {sentence}\nSQL:"
-    return prompt
-
-def exp_kshot(tokenizer, model, inputs, k, train_x=None, train_y=None):
-    raw_outputs = []
-    extracted_queries = []
-    for sentence in tqdm(inputs):
-        prompt = create_prompt(sentence, k, train_x, train_y)
-        input_ids = tokenizer(prompt, return_tensors="pt").to(DEVICE)
-        outputs = model.generate(**input_ids, max_new_tokens=MAX_NEW_TOKENS)
-        response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        raw_outputs.append(response)
-        extracted_queries.append(extract_sql_query(response))
-    return raw_outputs, extracted_queries
-
-def eval_outputs(gt_sql_path, model_sql_path, gt_record_path, model_record_path):
-    sql_em, record_em, record_f1, model_error_msgs, error_rate = compute_metrics(
-        gt_sql_path, model_sql_path, gt_record_path, model_record_path
-    )
+        for i in (range(k) if example_ids is None else example_ids):
+            prefix += format_example(train_x[i], train_y[i])
+    return prefix
+
+def create_prompt(sentence, k, train_x=None, train_y=None, example_ids=None, schema=None):
+    """Create a 0-shot or k-shot prompt for text-to-SQL."""
+    # k-shot examples if available, then the schema slice (after the examples, so
+    # they stay a shared prefix) and the target sentence
+    prompt = create_prefix(k, train_x, train_y, example_ids)
+    if schema:
+        prompt += f"Tables:\n{schema}\n\n"
+    return prompt + f"Text: {sentence}\nSQL:"
+
+def prompt_schema(schema_index, sentence, ptype):
+    """Schema text for the prompt type: none (0), the pruned slice (1) or the whole schema (2)."""
+    if schema_index is None or ptype == 0:
+        return None
+    if ptype == 1:
+        return schema_index.prompt_schema(sentence)
+    return schema_index.schema_text(tuple(sorted(schema_index.schema)))
+
+def load_example_index(tokenizer, train_x, train_y, index_dir):
+    """BM25 index over the training sentences, built and saved on first use."""
+    example_texts = [format_example(x, y) for x, y in zip(train_x, train_y)]
+    return ExampleIndex.load_or_build(index_dir, train_x, example_texts, tokenizer)
+
+def build_prompts(inputs, k, train_x=None, train_y=None, index=None, token_budget=None, schema_index=None, ptype=0):
+    schemas = [prompt_schema(schema_index, sentence, ptype) for sentence in inputs]
+    if index is not None:
+        # Most similar example last, right before the sentence it is meant to help with
+        return [create_prompt(sentence, k, train_x, train_y, index.top_k(sentence, k, token_budget)[::-1], schema)
+                for sentence, schema in zip(inputs, schemas)]
+    return [create_prompt(sentence, k, train_x, train_y, schema=schema) for sentence, schema in zip(inputs, schemas)]
+
+def exp_kshot(backend, inputs, k, train_x=None, train_y=None, batch_size=1, prefix_cache=False,
+              index=None, token_budget=None, schema_index=None, ptype=0, on_result=None, prompts=None):
+    # on_result(i, response) is called as soon as the response to inputs[i] is generated;
+    # prompts, if given, are the already built prompts for inputs
+    if prompts is None:
+        prompts = build_prompts(inputs, k, train_x, train_y, index, token_budget, schema_index, ptype)
+    # Retrieved examples differ per prompt, so there is no shared prefix to cache
+    prefix = create_prefix(k, train_x, train_y) if prefix_cache and index is None else None
+    raw_outputs = backend.generate(prompts, batch_size, prefix, MAX_NEW_TOKENS, on_result)
+    return raw_outputs, [extract_sql_query(response) for response in raw_outputs]
+
+def benchmark_batching(backend, inputs, k, train_x, train_y, batch_size):
+    """Throughput of unbatched vs batched generation and how often their outputs agree."""
+    results = {}
+    for name, bs in [("unbatched", 1), (f"batch size {batch_size}", batch_size)]:
+        start = time.perf_counter()
+        raw_outputs, _ = exp_kshot(backend, inputs, k, train_x, train_y, bs)
+        elapsed = time.perf_counter() - start
+        results[name] = raw_outputs
+        print(f"{name}: {elapsed:.1f}s ({len(inputs) / elapsed:.2f} sentences/s)")
+    unbatched, batched = results.values()
+    same = sum(a == b for a, b in zip(unbatched, batched))
+    print(f"Identical outputs: {same}/{len(inputs)}")
+
+def benchmark_prefix_cache(backend, inputs, ks, train_x, train_y, batch_size):
+    """Prefill time (generating a single token) with and without the shared prefix cache, for each k."""
+    for k in ks:
+        prompts = [create_prompt(sentence, k, train_x, train_y) for sentence in inputs]
+        prefix = create_prefix(k, train_x, train_y)
+        start = time.perf_counter()
+        full = backend.generate(prompts, batch_size, max_new_tokens=1)
+        full_secs = time.perf_counter() - start
+
+        start = time.perf_counter()
+        backend.prefix_cache(prefix)
+        build_secs = time.perf_counter() - start
+        start = time.perf_counter()
+        cached = backend.generate(prompts, batch_size, prefix, max_new_tokens=1)
+        cached_secs = time.perf_counter() - start
+
+        same = sum(a == b for a, b in zip(full, cached))
+        print(f"k={k}: prefix {len(backend.tokenizer(prefix)['input_ids'])} tokens | full prefill {full_secs:.2f}s | "
+              f"cached {cached_secs:.2f}s (+{build_secs:.2f}s once) | "
+              f"saving {(1 - (cached_secs + build_secs) / full_secs) * 100:.1f}% | identical {same}/{len(inputs)}")
+
+def benchmark_pipeline(backend, inputs, gt_sql, args, train_x, train_y, index=None, schema_index=None):
+    """Time of each pipeline stage (prompt construction, generation, extraction, execution, scoring)."""
+    timings = {}
+    start = time.perf_counter()
+    prompts = build_prompts(inputs, args.shot, train_x, train_y, index, args.shot_token_budget, schema_index,
+                            args.ptype)
+    timings["prompts"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    prefix = create_prefix(args.shot, train_x, train_y) if args.prefix_cache and index is None else None
+    raw_outputs = backend.generate(prompts, args.batch_size, prefix, MAX_NEW_TOKENS)
+    timings["generate"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    queries = [extract_sql_query(response) for response in raw_outputs]
+    timings["extract"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    records, _ = compute_records(queries)
+    timings["execute"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    gt_records, _ = compute_records(gt_sql, screen=False)
+    _, _, record_f1 = score_predictions(gt_sql, gt_records, queries, records)
+    timings["score"] = time.perf_counter() - start
+
+    total = sum(timings.values())
+    print(f"{backend.name} backend, {len(inputs)} sentences, {total:.2f}s ({len(inputs) / total:.1f} sentences/s), "
+          f"F1 {record_f1:.4f}")
+    for stage, secs in timings.items():
+        print(f"  {stage:>8}: {secs * 1000 / len(inputs):8.3f} ms/sentence ({secs / total * 100:.1f}%)")
+
+def eval_outputs(gt_sql_path, gt_record_path, model_qs, model_records, model_error_msgs):
+    # Ground-truth records are executed once if there is no saved copy
+    gt_qs, gt_records = load_ground_truth(gt_sql_path, gt_record_path if os.path.exists(gt_record_path) else None)
+    sql_em, record_em, record_f1 = score_predictions(gt_qs, gt_records, model_qs, model_records)
+    error_rate = sum(map(bool, model_error_msgs)) / len(model_error_msgs)
     return sql_em, record_em, record_f1, model_error_msgs, error_rate
 
 def initialize_model_and_tokenizer(model_name, to_quantize=False):
     if model_name == "gemma":
-        model_id = "google/gemma-1.1-2b-it"
+        model_id = MODEL_IDS["gemma"]
         tokenizer = GemmaTokenizerFast.from_pretrained(model_id)
         model = GemmaForCausalLM.from_pretrained(model_id, torch_dtype=torch.bfloat16).to(DEVICE)
     elif model_name == "codegemma":
-        model_id = "google/codegemma-7b-it"
+        model_id = MODEL_IDS["codegemma"]
         tokenizer = GemmaTokenizer.from_pretrained(model_id)
         if to_quantize:
             nf4_config = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_quant_type="nf4")
@@ -67,24 +195,83 @@ def initialize_model_and_tokenizer(model_name, to_quantize=False):
             model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch.bfloat16).to(DEVICE)
     return tokenizer, model
 
+def initialize_backend(args, train_x, train_y):
+    if args.model == "tiny":
+        return TinyRandomBackend(train_x + train_y, seed=args.seed)
+    if args.model == "replay":
+        return ReplayBackend(args.replay_path, args.replay_latency)
+    tokenizer, model = initialize_model_and_tokenizer(args.model, args.quantization)
+    return HFBackend(tokenizer, model, args.model)
+
 def main():
     args = get_args()
     set_random_seeds(args.seed)
 
     train_x, train_y, dev_x, dev_y, test_x = load_prompting_data("data")
-    tokenizer, model = initialize_model_and_tokenizer(args.model, args.quantization)
+    backend = initialize_backend(args, train_x, train_y)
+
+    if args.benchmark_batching > 0:
+        benchmark_batching(backend, dev_x[:args.benchmark_batching], args.shot, train_x, train_y, args.batch_size)
+        return
+    if args.benchmark_prefix_cache:
+        benchmark_prefix_cache(backend, dev_x[:args.benchmark_sentences], args.benchmark_prefix_cache,
+                               train_x, train_y, args.batch_size)
+        return
+
+    index = None
+    if args.retrieve:
+        index = load_example_index(backend.tokenizer, train_x, train_y,
+                                   args.index_dir or f"data/example_index_{args.model}")
+    schema_index = SchemaIndex.build(train_x=train_x, train_y=train_y) if args.ptype > 0 else None
+
+    if args.benchmark_pipeline > 0:
+        benchmark_pipeline(backend, dev_x[:args.benchmark_pipeline], dev_y[:args.benchmark_pipeline], args,
+                           train_x, train_y, index, schema_index)
+        return
 
     for eval_split in ["dev", "test"]:
         eval_x, eval_y = (dev_x, dev_y) if eval_split == "dev" else (test_x, None)
-        raw_outputs, extracted_queries = exp_kshot(tokenizer, model, eval_x, args.shot, train_x, train_y)
 
         gt_sql_path = f"data/{eval_split}.sql"
         gt_record_path = f"records/{eval_split}_gt_records.pkl"
         model_sql_path = f"results/{args.model}_{args.experiment_name}_{eval_split}.sql"
         model_record_path = f"records/{args.model}_{args.experiment_name}_{eval_split}.pkl"
+        journal_path = f"results/{args.model}_{args.experiment_name}_{eval_split}_journal.jsonl"
+
+        # Outputs are journaled as they are generated (a rerun resumes from the journal,
+        # for the inputs whose prompt is unchanged) and executed while generation continues
+        prompts = build_prompts(eval_x, args.shot, train_x, train_y, index, args.shot_token_budget, schema_index,
+                                args.ptype)
+        journal = OutputJournal(journal_path, eval_x, prompts)
+        executor = StreamingSqlExecutor()
+        for i, entry in journal.entries.items():
+            executor.submit(i, entry["sql"])
+        todo = journal.pending()
+        if len(todo) < len(eval_x):
+            print(f"Resuming {eval_split}: {len(eval_x) - len(todo)} of {len(eval_x)} outputs found in {journal_path}")
+
+        def record_output(j, response):
+            sql = extract_sql_query(response)
+            journal.append(todo[j], response, sql)
+            executor.submit(todo[j], sql)
+
+        if todo:
+            exp_kshot(backend, [eval_x[i] for i in todo], args.shot, train_x, train_y, args.batch_size,
+                      args.prefix_cache, index, args.shot_token_budget, schema_index, args.ptype,
+                      on_result=record_output, prompts=[prompts[i] for i in todo])
+        journal.close()
+        raw_outputs, extracted_queries = journal.outputs()
+        records, error_msgs = executor.records(len(eval_x))
+        executor.close()
+        os.makedirs("results", exist_ok=True)
+        os.makedirs("records", exist_ok=True)
+        write_queries_and_records(extracted_queries, records, error_msgs, model_sql_path, model_record_path)
+
+        if eval_y is None:
+            continue  # no ground truth for the test split
 
         sql_em, record_em, record_f1, model_error_msgs, error_rate = eval_outputs(
-            gt_sql_path, model_sql_path, gt_record_path, model_record_path
+            gt_sql_path, gt_record_path, extracted_queries, records, error_msgs
         )
 
         print(f"{eval_split} results - SQL EM: {sql_em}, Record EM: {record_em}, Record F1: {record_f1}, Error Rate: {error_rate*100:.2f}%")
@@ -1,15 +1,42 @@
 import os
 
+import torch
+from transformers import StoppingCriteria
+
+# The SQL answer ends at the end of its line; ";" and a new "Text:" example also end it
+STOP_STRINGS = ["\n", ";", "Text:"]
+
 def read_schema(schema_path):
     with open(schema_path, "r") as f:
         schema = f.read()
     return schema
 
-def extract_sql_query(response):
-    """Extract SQL query from model response."""
-    if "SQL:" in response:
-        return response.split("SQL:")[1].strip()
-    return response.strip()
+def extract_sql_query(response, stop_strings=STOP_STRINGS):
+    """Extract SQL query from the model's continuation of the prompt (up to the first stop string)."""
+    response = response.lstrip()
+    end = min((response.find(stop) for stop in stop_strings if stop in response), default=len(response))
+    return response[:end].strip()
+
+class StopOnStrings(StoppingCriteria):
+    """
+    Ends each sequence of a (batched) generate call as soon as its continuation
+    past prompt_len contains a stop string, ignoring leading whitespace; the
+    other sequences keep generating.
+    """
+    def __init__(self, tokenizer, prompt_len, stop_strings=STOP_STRINGS):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.stop_strings = stop_strings
+        self.done = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.done is None:
+            self.done = torch.zeros(input_ids.size(0), dtype=torch.bool, device=input_ids.device)
+        # Finished sequences are not decoded again
+        for i in (~self.done).nonzero().flatten().tolist():
+            text = self.tokenizer.decode(input_ids[i, self.prompt_len:], skip_special_tokens=True).lstrip()
+            self.done[i] = any(stop in text for stop in self.stop_strings)
+        return self.done.clone()
 
 def save_logs(output_path, sql_em, record_em, record_f1, error_msgs):
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
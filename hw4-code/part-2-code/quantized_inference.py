@@ -0,0 +1,226 @@
+import os
+import io
+import time
+import argparse
+import multiprocessing
+from tqdm import tqdm
+
+import torch
+import torch.nn as nn
+from transformers import T5TokenizerFast
+
+from utils import compute_metrics, save_queries_and_records
+from load_data import get_dataloader
+from t5_utils import generate_sql, load_pretrained_fast, SQL_VOCAB_FILENAME
+from sql_tokenizer import load_target_tokenizer
+
+DEVICE = torch.device('cpu')  # dynamic quantization kernels are CPU-only
+MAX_NEW_TOKENS = 256
+QUANTIZED_FILENAME = "quantized_int8.pt"
+# Checkpoint files the int8 model is derived from
+SOURCE_FILENAMES = ("best_model.safetensors", "model.safetensors", "pytorch_model.bin", "config.json",
+                    SQL_VOCAB_FILENAME)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Dynamic int8 CPU inference for a fine-tuned T5 checkpoint')
+    parser.add_argument('--experiment_name', type=str, default='ft_experiment',
+                        help="Loads the checkpoint from checkpoints/<experiment_name>")
+    parser.add_argument('--splits', nargs='+', default=["dev", "test"], choices=["dev", "test"])
+    parser.add_argument('--test_batch_size', type=int, default=16)
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help="torch intra-op threads (defaults to torch's choice)")
+    parser.add_argument('--save_quantized', action='store_true',
+                        help="Keep the quantized weights so later runs skip the conversion "
+                             "(they are redone when the checkpoint changes)")
+    parser.add_argument('--skip_fp32', action='store_true',
+                        help="Only run the int8 model (no latency/F1 comparison)")
+    return parser.parse_args()
+
+
+def quantize_model(model):
+    '''
+    Replace every nn.Linear (attention projections, FFN and lm_head) with a
+    dynamically quantized int8 version. Activations stay fp32 and are
+    quantized on the fly per batch. A restricted output head is not an
+    nn.Linear and stays fp32.
+    '''
+    model = model.to(DEVICE).eval()
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def source_signature(checkpoint_dir):
+    # Name, size and modification time of the checkpoint files the int8 model is built from
+    signature = []
+    for name in SOURCE_FILENAMES:
+        path = os.path.join(checkpoint_dir, name)
+        if os.path.exists(path):
+            st = os.stat(path)
+            signature.append([name, st.st_size, st.st_mtime_ns])
+    return signature
+
+
+def save_quantized_model(model, checkpoint_dir, path=None):
+    # The whole module is pickled, so loading it needs neither an fp32 skeleton nor a
+    # quantization pass, and keeps its exact structure (e.g. a restricted output head)
+    path = path or os.path.join(checkpoint_dir, QUANTIZED_FILENAME)
+    tmp_path = path + ".tmp"
+    torch.save({"source": source_signature(checkpoint_dir), "model": model}, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def is_quantized_model_current(checkpoint_dir, path=None):
+    '''Whether the saved int8 model was quantized from the checkpoint as it is now.'''
+    path = path or os.path.join(checkpoint_dir, QUANTIZED_FILENAME)
+    if not os.path.exists(path):
+        return False
+    saved = torch.load(path, map_location=DEVICE, weights_only=False, mmap=True)
+    # Files from before whole-module saving only hold a state dict and are quantized again
+    return isinstance(saved, dict) and "model" in saved and saved.get("source") == source_signature(checkpoint_dir)
+
+
+def load_quantized_model(checkpoint_dir, path=None):
+    '''Load a previously saved int8 model as it was saved, without converting anything.'''
+    path = path or os.path.join(checkpoint_dir, QUANTIZED_FILENAME)
+    saved = torch.load(path, map_location=DEVICE, weights_only=False)
+    return saved["model"].eval()
+
+
+def check_quantized_reload(model, checkpoint_dir, path=None):
+    '''
+    Reload a just-saved int8 model and check that it has the same modules and
+    gives the same logits as the model it was saved from.
+    '''
+    reloaded = load_quantized_model(checkpoint_dir, path)
+    types = [type(m) for m in model.modules()]
+    if [type(m) for m in reloaded.modules()] != types:
+        raise RuntimeError("Reloaded int8 model has a different module structure")
+    ids = torch.arange(1, 9, device=DEVICE).unsqueeze(0)
+    with torch.no_grad():
+        logits = model(input_ids=ids, decoder_input_ids=ids[:, :4]).logits
+        reloaded_logits = reloaded(input_ids=ids, decoder_input_ids=ids[:, :4]).logits
+    if not torch.equal(logits, reloaded_logits):
+        raise RuntimeError("Reloaded int8 model gives different logits")
+
+
+def model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2 ** 20
+
+
+def current_rss_mb():
+    # Resident set size of this process (Linux); falls back to the peak RSS elsewhere
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def run_generation(model, tokenizer, loader, desc):
+    '''
+    Greedy generation over a loader, timing each batch.
+    '''
+    model.eval()
+    all_sql = []
+    batch_latencies = []
+    peak_rss = current_rss_mb()
+
+    with torch.no_grad():
+        for batch in tqdm(loader, desc=desc, ncols=100):
+            enc_in, enc_mask = batch[0].to(DEVICE), batch[1].to(DEVICE)
+            start = time.perf_counter()
+            all_sql.extend(generate_sql(model, tokenizer, enc_in, enc_mask, MAX_NEW_TOKENS))
+            batch_latencies.append(time.perf_counter() - start)
+            peak_rss = max(peak_rss, current_rss_mb())
+
+    total = sum(batch_latencies)
+    stats = {
+        "total_secs": total,
+        "mean_batch_latency_ms": 1000 * total / len(batch_latencies),
+        "throughput": len(all_sql) / total,
+        "peak_rss_mb": peak_rss,
+    }
+    return all_sql, stats
+
+
+def measure_model(name, checkpoint_dir, int8_path, splits, test_batch_size, num_threads):
+    '''
+    Load one model and generate every split with it. Runs in a process of its
+    own, so the RSS figures only cover this model.
+    '''
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    tokenizer = load_target_tokenizer(checkpoint_dir, T5TokenizerFast.from_pretrained(checkpoint_dir))
+    if name == "int8":
+        model = load_quantized_model(checkpoint_dir, int8_path)
+    else:
+        model = load_pretrained_fast(checkpoint_dir).to(DEVICE)
+    results = {split: run_generation(model, tokenizer, get_dataloader(test_batch_size, split), f"{name} {split}")
+               for split in splits}
+    return model_size_mb(model), results
+
+
+def main():
+    args = get_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    checkpoint_dir = f"checkpoints/{args.experiment_name}"
+    saved_path = os.path.join(checkpoint_dir, QUANTIZED_FILENAME)
+    # Without --save_quantized the int8 weights only live for this run (the worker loads them from disk)
+    int8_path = saved_path if args.save_quantized else saved_path + ".run"
+
+    start = time.perf_counter()
+    if is_quantized_model_current(checkpoint_dir, saved_path):
+        int8_path = saved_path
+        print(f"Using saved int8 model {saved_path}")
+    else:
+        if os.path.exists(saved_path):
+            print(f"{saved_path} was quantized from an older checkpoint; quantizing again")
+        model = quantize_model(load_pretrained_fast(checkpoint_dir))
+        save_quantized_model(model, checkpoint_dir, int8_path)
+        print(f"Quantized fp32 checkpoint in {time.perf_counter() - start:.2f}s")
+        check_quantized_reload(model, checkpoint_dir, int8_path)
+        del model
+
+    names = ["int8"] if args.skip_fp32 else ["fp32", "int8"]
+    outputs = {}
+    # A fresh process per model: neither model's memory shows up in the other's RSS
+    context = multiprocessing.get_context("spawn")
+    for name in names:
+        with context.Pool(1) as pool:
+            size_mb, outputs[name] = pool.apply(measure_model, (name, checkpoint_dir, int8_path, args.splits,
+                                                                args.test_batch_size, args.num_threads))
+        print(f"{name} model size: {size_mb:.1f} MB")
+    if int8_path != saved_path:
+        os.remove(int8_path)
+
+    os.makedirs("results", exist_ok=True)
+    os.makedirs("records", exist_ok=True)
+    for split in args.splits:
+        f1s = {}
+        for name in names:
+            all_sql, stats = outputs[name][split]
+            model_sql = f"results/t5_{name}_{args.experiment_name}_{split}.sql"
+            model_rec = f"records/t5_{name}_{args.experiment_name}_{split}.pkl"
+            save_queries_and_records(all_sql, model_sql, model_rec)
+
+            print(f"{name} {split}: {stats['total_secs']:.1f}s total | "
+                  f"{stats['mean_batch_latency_ms']:.1f} ms/batch | "
+                  f"{stats['throughput']:.2f} queries/s | peak RSS {stats['peak_rss_mb']:.0f} MB")
+
+            if split == "dev":
+                _, _, f1s[name], _ = compute_metrics("data/dev.sql", model_sql,
+                                                     "records/ground_truth_dev.pkl", model_rec)
+                print(f"{name} dev Record F1: {f1s[name]:.4f}")
+
+        if "fp32" in f1s:
+            print(f"Record F1 delta (int8 - fp32): {f1s['int8'] - f1s['fp32']:+.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# schema_index.py
+
+import os
+import re
+import time
+import sqlite3
+import argparse
+from collections import Counter, defaultdict
+from functools import lru_cache
+
+from utils import DB_PATH
+from example_index import tokenize
+
+IDENTIFIER_RE = re.compile(r"[a-z_][a-z0-9_]*")
+
+
+def word_keys(word):
+    # Crude plural folding so "fares" and "airlines" hit fare and airline
+    return [word, word[:-1]] if len(word) > 3 and word.endswith("s") else [word]
+
+
+@lru_cache(maxsize=None)
+def _load_schema(db_path, mtime):
+    conn = sqlite3.connect(db_path)
+    try:
+        tables = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+        return {table: tuple((r[1], r[2]) for r in conn.execute(f"PRAGMA table_info({table})")) for table in tables}
+    finally:
+        conn.close()
+
+
+def load_schema(db_path=DB_PATH):
+    '''
+    Tables of the database as {table: ((column, type), ...)}, read with PRAGMA
+    once per process (and again only if the file changes).
+    '''
+    return _load_schema(db_path, os.path.getmtime(db_path))
+
+
+def tables_in_sql(sql, tables):
+    return {word for word in IDENTIFIER_RE.findall(sql.lower()) if word in tables}
+
+
+class SchemaIndex:
+    '''
+    Lexical index from NL words to the tables a question needs. Words come
+    from three sources: the parts of table and column names ("fare",
+    "airline"), the values of small text columns (city and airline names),
+    and, given training pairs, words that reliably co-occur with a table in the
+    gold SQL. Tables used by most training queries are always included.
+    '''
+
+    def __init__(self, schema, word_tables, default_tables=()):
+        self.schema = schema
+        self.word_tables = word_tables
+        self.default_tables = tuple(default_tables)
+        self._text_cache = {}
+
+    @classmethod
+    def build(cls, db_path=DB_PATH, train_x=None, train_y=None, max_values=500, max_tables=3, min_count=5,
+              min_precision=0.5):
+        '''
+        Schema and value words that point to more than max_tables tables (such
+        as "code" or "name") are dropped; a training word is kept for a table
+        if it occurs in at least min_count questions and at least min_precision
+        of them use the table.
+        '''
+        schema = load_schema(db_path)
+        word_tables = defaultdict(set)
+        for table, columns in schema.items():
+            for name in [table] + [column for column, _ in columns]:
+                for part in name.lower().split("_"):
+                    word_tables[part].add(table)
+
+        # Values of low-cardinality text columns, e.g. city_name BOSTON -> city
+        conn = sqlite3.connect(db_path)
+        try:
+            for table, columns in schema.items():
+                for column, col_type in columns:
+                    if "CHAR" not in col_type.upper() and "TEXT" not in col_type.upper():
+                        continue
+                    values = conn.execute(f"SELECT DISTINCT {column} FROM {table} LIMIT {max_values + 1}").fetchall()
+                    if len(values) > max_values:
+                        continue
+                    for (value,) in values:
+                        for word in tokenize(str(value)):
+                            if len(word) >= 3:
+                                word_tables[word].add(table)
+        finally:
+            conn.close()
+        word_tables = defaultdict(set, {w: t for w, t in word_tables.items() if len(t) <= max_tables})
+
+        default_tables = []
+        if train_x is not None and train_y is not None:
+            word_counts, pair_counts, table_counts = Counter(), Counter(), Counter()
+            for nl, sql in zip(train_x, train_y):
+                gold = tables_in_sql(sql, schema)
+                table_counts.update(gold)
+                for word in set(tokenize(nl)):
+                    word_counts[word] += 1
+                    pair_counts.update((word, table) for table in gold)
+            for (word, table), count in pair_counts.items():
+                if word_counts[word] >= min_count and count / word_counts[word] >= min_precision:
+                    word_tables[word].add(table)
+            default_tables = sorted(t for t, count in table_counts.items() if count / len(train_y) >= 0.5)
+
+        return cls(schema, {w: frozenset(t) for w, t in word_tables.items()}, default_tables)
+
+    def relevant_tables(self, sentence):
+        tables = set(self.default_tables)
+        for word in tokenize(sentence):
+            for key in word_keys(word):
+                tables.update(self.word_tables.get(key, ()))
+        return tuple(sorted(tables))
+
+    def schema_text(self, tables):
+        # One line per table; cached per table combination (on the instance, which owns the cache)
+        if tables not in self._text_cache:
+            self._text_cache[tables] = "\n".join(f"{table}({', '.join(column for column, _ in self.schema[table])})"
+                                                  for table in tables)
+        return self._text_cache[tables]
+
+    def prompt_schema(self, sentence):
+        return self.schema_text(self.relevant_tables(sentence))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Schema pruning: prompt length and gold-table recall on dev')
+    parser.add_argument('-m', '--model', type=str, default='gemma', help='Model whose tokenizer counts prompt tokens')
+    parser.add_argument('--min_count', type=int, default=5)
+    parser.add_argument('--min_precision', type=float, default=0.5)
+    return parser.parse_args()
+
+
+def main():
+    from transformers import AutoTokenizer
+    from load_data import load_prompting_data
+    from prompting import MODEL_IDS
+
+    args = get_args()
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_IDS[args.model])
+    train_x, train_y, dev_x, dev_y, _ = load_prompting_data("data")
+
+    start = time.perf_counter()
+    index = SchemaIndex.build(DB_PATH, train_x, train_y, min_count=args.min_count, min_precision=args.min_precision)
+    print(f"Built schema index ({len(index.schema)} tables, {len(index.word_tables)} words) "
+          f"in {time.perf_counter() - start:.2f}s | always included: {', '.join(index.default_tables) or 'none'}")
+
+    def num_tokens(tables):
+        return len(tokenizer(index.schema_text(tables), add_special_tokens=False)["input_ids"])
+
+    full_tokens = num_tokens(tuple(sorted(index.schema)))
+    start = time.perf_counter()
+    selections = [index.relevant_tables(x) for x in dev_x]
+    select_ms = (time.perf_counter() - start) * 1000 / len(dev_x)
+    pruned_tokens = [num_tokens(tables) for tables in selections]
+    recall = sum(tables_in_sql(y, index.schema) <= set(tables) for y, tables in zip(dev_y, selections)) / len(dev_y)
+
+    mean_tokens = sum(pruned_tokens) / len(pruned_tokens)
+    print(f"Full schema: {full_tokens} tokens | pruned: {mean_tokens:.0f} tokens on average "
+          f"({(1 - mean_tokens / full_tokens) * 100:.1f}% shorter), {len(set(selections))} distinct slices")
+    print(f"Dev queries whose gold tables are all included: {recall * 100:.1f}% | selection {select_ms:.3f} ms/query")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+# sql_server.py
+
+import json
+import time
+import queue
+import sqlite3
+import argparse
+import threading
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import torch
+from transformers import T5TokenizerFast
+
+from utils import DB_PATH, PROGRESS_CHECK_INSTRUCTIONS
+from t5_utils import load_pretrained_fast, generate_sql, DEVICE
+from sql_tokenizer import load_target_tokenizer
+from generation_cache import GenerationCache, model_fingerprint, generation_settings
+
+MAX_NEW_TOKENS = 256
+MAX_ENC_LEN = 256  # as in T5Dataset
+
+
+class MicroBatcher:
+    '''
+    Groups concurrent requests into batches for one warm model. A batch runs
+    as soon as max_batch_size requests are waiting or max_wait_ms after its
+    first request arrived, whichever comes first. Generation happens on a
+    single worker thread; callers wait on the Future returned by submit.
+    '''
+
+    def __init__(self, model, tokenizer, decode_tokenizer, max_batch_size=16, max_wait_ms=10, cache=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.decode_tokenizer = decode_tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.cache = cache
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.served = 0
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, text):
+        future = Future()
+        self.requests.put((text, future))
+        return future
+
+    def _loop(self):
+        while True:
+            first = self.requests.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.requests.put(None)  # stop after this batch
+                    break
+                batch.append(item)
+            self._run(batch)
+
+    def _run(self, batch):
+        texts = [text for text, _ in batch]
+        try:
+            enc = self.tokenizer(texts, padding=True, truncation=True, max_length=MAX_ENC_LEN,
+                                 return_tensors="pt").to(DEVICE)
+            with torch.no_grad():
+                sqls = generate_sql(self.model, self.decode_tokenizer, enc["input_ids"], enc["attention_mask"],
+                                    MAX_NEW_TOKENS, self.cache)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.served += len(batch)
+        for (_, future), sql in zip(batch, sqls):
+            future.set_result(sql)
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+
+class ReadOnlyConnectionPool:
+    '''
+    Fixed set of read-only (mode=ro) connections shared by the request
+    threads. Each query is interrupted after timeout_secs.
+    '''
+
+    def __init__(self, size=4, db_path=DB_PATH, timeout_secs=10):
+        self.timeout_secs = timeout_secs
+        self.connections = queue.Queue()
+        for _ in range(size):
+            self.connections.put(sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False))
+
+    def execute(self, query, max_rows=None):
+        conn = self.connections.get()
+        deadline = time.monotonic() + self.timeout_secs
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_CHECK_INSTRUCTIONS)
+        try:
+            cursor = conn.execute(query)
+            rows = cursor.fetchmany(max_rows) if max_rows else cursor.fetchall()
+            return rows, ""
+        except Exception as e:
+            return [], "Query timed out" if time.monotonic() > deadline else f"{type(e).__name__}: {e}"
+        finally:
+            conn.set_progress_handler(None, 0)
+            self.connections.put(conn)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
+
+class SqlHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default listen backlog (5) drops or delays connections under concurrent load
+    request_queue_size = 128
+
+
+def make_handler(batcher, db_pool=None):
+    '''
+    POST /query with {"nl": ..., "execute": true, "max_rows": null} returns
+    {"sql", "rows", "error", "latency_ms"}; GET /health returns batching stats.
+    '''
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive for clients that reuse connections
+
+        def do_POST(self):
+            if self.path != "/query":
+                return self._reply(404, {"error": f"unknown path {self.path}"})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                text = body["nl"]
+            except (ValueError, KeyError, TypeError):
+                return self._reply(400, {"error": 'expected a JSON body with an "nl" field'})
+            # Checked here: a malformed input inside a batch would fail every request in it
+            if not isinstance(text, str):
+                return self._reply(400, {"error": '"nl" must be a string'})
+
+            start = time.perf_counter()
+            try:
+                sql = batcher.submit(text).result()
+            except Exception as e:
+                return self._reply(500, {"error": f"{type(e).__name__}: {e}"})
+            response = {"sql": sql}
+            if body.get("execute", True) and db_pool is not None:
+                rows, error = db_pool.execute(sql, body.get("max_rows"))
+                response.update(rows=rows, error=error)
+            response["latency_ms"] = (time.perf_counter() - start) * 1000
+            self._reply(200, response)
+
+        def do_GET(self):
+            if self.path != "/health":
+                return self._reply(404, {"error": f"unknown path {self.path}"})
+            self._reply(200, {"batches": batcher.batches, "served": batcher.served,
+                              "mean_batch_size": batcher.served / max(batcher.batches, 1)})
+
+        def _reply(self, code, obj):
+            data = json.dumps(obj, default=str).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass  # one line per request would dominate a load test
+
+    return Handler
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Text-to-SQL HTTP server with micro-batching')
+    parser.add_argument('--experiment_name', type=str, default='ft_experiment',
+                        help="Serves the checkpoint in checkpoints/<experiment_name>")
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8008)
+    parser.add_argument('--max_batch_size', type=int, default=16)
+    parser.add_argument('--max_wait_ms', type=float, default=10,
+                        help="How long the first request of a batch waits for others")
+    parser.add_argument('--db_connections', type=int, default=4)
+    parser.add_argument('--query_timeout_secs', type=float, default=10)
+    parser.add_argument('--no_execute', action='store_true', help="Only return SQL (no database access)")
+    parser.add_argument('--cache_size', type=int, default=0,
+                        help="Remember this many generated queries (0 disables the generation cache)")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    checkpoint_dir = f"checkpoints/{args.experiment_name}"
+    tokenizer = T5TokenizerFast.from_pretrained(checkpoint_dir)
+    decode_tokenizer = load_target_tokenizer(checkpoint_dir, tokenizer)
+    model = load_pretrained_fast(checkpoint_dir)
+
+    cache = None
+    if args.cache_size > 0:
+        cache = GenerationCache(tokenizer, max_size=args.cache_size)
+        cache.set_fingerprint(model_fingerprint(model), **generation_settings(model, MAX_NEW_TOKENS))
+
+    batcher = MicroBatcher(model, tokenizer, decode_tokenizer, args.max_batch_size, args.max_wait_ms, cache)
+    batcher.submit("warm up").result()  # first call pays for lazy initialization
+    db_pool = None if args.no_execute else ReadOnlyConnectionPool(args.db_connections,
+                                                                  timeout_secs=args.query_timeout_secs)
+
+    server = SqlHTTPServer((args.host, args.port), make_handler(batcher, db_pool))
+    print(f"Serving {checkpoint_dir} on http://{args.host}:{args.port} (POST /query, GET /health)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if db_pool is not None:
+            db_pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+# sql_tokenizer.py
+
+import os
+import re
+import json
+import time
+import argparse
+from collections import Counter
+
+import torch
+from tqdm import tqdm
+from transformers import T5TokenizerFast
+
+SQL_TOKENS_FILENAME = "sql_tokens.json"
+# Keywords and (optionally alias-qualified) schema identifiers, e.g. SELECT, airport_service_1.city_code
+IDENTIFIER_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?$")
+
+
+class SqlTargetTokenizer:
+    '''
+    Decoder-side tokenizer for the SQL targets. Frequent SQL words (keywords
+    and schema identifiers) that the T5 SentencePiece model splits into
+    several pieces get a single id of their own, numbered after the model's
+    existing embedding rows; every other word falls back to the base
+    tokenizer's pieces. Words the base tokenizer cannot represent (such as
+    "<", which T5 maps to <unk>) are added as well.
+    '''
+
+    def __init__(self, base_tokenizer, words, base_vocab_size):
+        self.base_tokenizer = base_tokenizer
+        self.words = list(words)
+        self.base_vocab_size = base_vocab_size
+        self.word_to_id = {w: base_vocab_size + i for i, w in enumerate(self.words)}
+        self._pieces = {}
+
+    def __len__(self):
+        return self.base_vocab_size + len(self.words)
+
+    @property
+    def eos_token_id(self):
+        return self.base_tokenizer.eos_token_id
+
+    def base_pieces(self, word):
+        if word not in self._pieces:
+            self._pieces[word] = self.base_tokenizer(word, add_special_tokens=False)["input_ids"]
+        return self._pieces[word]
+
+    @classmethod
+    def learn(cls, sql_lines, base_tokenizer, base_vocab_size, min_count=2):
+        '''
+        Pick the whitespace-separated SQL words that occur at least min_count
+        times and are either identifiers the base tokenizer splits into more
+        than one piece or words it cannot encode at all.
+        '''
+        tokenizer = cls(base_tokenizer, [], base_vocab_size)
+        counts = Counter(word for sql in sql_lines for word in sql.split())
+        words = []
+        for word, count in counts.items():
+            if count < min_count:
+                continue
+            pieces = tokenizer.base_pieces(word)
+            if base_tokenizer.unk_token_id in pieces or (IDENTIFIER_RE.match(word) and len(pieces) > 1):
+                words.append(word)
+        return cls(base_tokenizer, sorted(words), base_vocab_size)
+
+    def encode(self, sql):
+        ids = []
+        for word in sql.split():
+            if word in self.word_to_id:
+                ids.append(self.word_to_id[word])
+            else:
+                ids.extend(self.base_pieces(word))
+        return ids
+
+    def decode(self, ids, skip_special_tokens=True):
+        if isinstance(ids, torch.Tensor):
+            ids = ids.tolist()
+        special = set(self.base_tokenizer.all_special_ids) if skip_special_tokens else set()
+        words, run = [], []
+        for i in ids:
+            if i >= self.base_vocab_size:
+                if run:
+                    words.append(self.base_tokenizer.decode(run, skip_special_tokens=skip_special_tokens))
+                    run = []
+                if i < len(self):
+                    words.append(self.words[i - self.base_vocab_size])
+            elif i not in special:
+                run.append(i)
+        if run:
+            words.append(self.base_tokenizer.decode(run, skip_special_tokens=skip_special_tokens))
+        return " ".join(w.strip() for w in words if w.strip())
+
+    def batch_decode(self, sequences, skip_special_tokens=True):
+        return [self.decode(ids, skip_special_tokens) for ids in sequences]
+
+    def extend_model_embeddings(self, model):
+        '''
+        Grow the (tied) embedding matrix to cover the added words and
+        initialize each new row as the mean of the embeddings of the base
+        pieces it replaces.
+        '''
+        if model.config.vocab_size != self.base_vocab_size:
+            raise ValueError(f"Model has {model.config.vocab_size} embeddings, "
+                             f"tokenizer was learned for {self.base_vocab_size}")
+        model.resize_token_embeddings(len(self))
+        embeddings = model.get_input_embeddings().weight
+        with torch.no_grad():
+            for word, idx in self.word_to_id.items():
+                embeddings[idx] = embeddings[self.base_pieces(word)].mean(dim=0)
+        return model
+
+    def save(self, checkpoint_dir):
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        with open(os.path.join(checkpoint_dir, SQL_TOKENS_FILENAME), "w") as f:
+            json.dump({"base_vocab_size": self.base_vocab_size, "words": self.words}, f)
+
+    @classmethod
+    def load(cls, checkpoint_dir, base_tokenizer):
+        with open(os.path.join(checkpoint_dir, SQL_TOKENS_FILENAME)) as f:
+            saved = json.load(f)
+        return cls(base_tokenizer, saved["words"], saved["base_vocab_size"])
+
+
+def load_target_tokenizer(checkpoint_dir, base_tokenizer):
+    '''
+    Tokenizer to decode a checkpoint's outputs with: its SqlTargetTokenizer if
+    it was trained with one, otherwise the base tokenizer.
+    '''
+    if os.path.exists(os.path.join(checkpoint_dir, SQL_TOKENS_FILENAME)):
+        return SqlTargetTokenizer.load(checkpoint_dir, base_tokenizer)
+    return base_tokenizer
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Target length (and decode latency) with the compact SQL vocabulary')
+    parser.add_argument('--min_count', type=int, default=2)
+    parser.add_argument('--compare', nargs=2, metavar=("BASE_EXPERIMENT", "SQL_VOCAB_EXPERIMENT"), default=None,
+                        help="Also time dev generation for two checkpoints trained without/with --sql_target_vocab")
+    parser.add_argument('--test_batch_size', type=int, default=16)
+    return parser.parse_args()
+
+
+def time_dev_generation(experiment_name, batch_size):
+    from load_data import get_dataloader
+    from t5_utils import load_pretrained_fast, generate_ids, DEVICE
+    from utils import compute_records, compute_record_F1, read_queries
+
+    checkpoint_dir = f"checkpoints/{experiment_name}"
+    base_tokenizer = T5TokenizerFast.from_pretrained(checkpoint_dir)
+    tokenizer = load_target_tokenizer(checkpoint_dir, base_tokenizer)
+    model = load_pretrained_fast(checkpoint_dir)
+    loader = get_dataloader(batch_size, "dev")
+
+    all_sql, steps = [], 0
+    start = time.perf_counter()
+    with torch.no_grad():
+        for enc_in, enc_mask, _, _, _ in tqdm(loader, desc=experiment_name, ncols=100):
+            enc_in, enc_mask = enc_in.to(DEVICE), enc_mask.to(DEVICE)
+            gen = generate_ids(model, enc_in, enc_mask, 256)
+            steps += gen.size(1) - 1
+            all_sql.extend(x.strip() for x in tokenizer.batch_decode(gen, skip_special_tokens=True))
+    secs = time.perf_counter() - start
+
+    records, _ = compute_records(all_sql)
+    gt_records, _ = compute_records(read_queries("data/dev.sql"), screen=False)
+    return secs, steps / len(loader), compute_record_F1(gt_records, records)
+
+
+def main():
+    from load_data import load_lines
+
+    args = get_args()
+    base_tokenizer = T5TokenizerFast.from_pretrained("google-t5/t5-small")
+    base_vocab_size = 32128  # t5-small embedding rows (the tokenizer itself has 32100 entries)
+    train_sql = load_lines("data/train.sql")
+    tokenizer = SqlTargetTokenizer.learn(train_sql, base_tokenizer, base_vocab_size, args.min_count)
+    print(f"Learned {len(tokenizer.words)} SQL words from train.sql (min count {args.min_count})")
+
+    for split in ["train", "dev"]:
+        sql_lines = train_sql if split == "train" else load_lines("data/dev.sql")
+        base_lens = [len(base_tokenizer(sql)["input_ids"]) for sql in sql_lines]
+        compact_lens = [len(tokenizer.encode(sql)) + 1 for sql in sql_lines]
+        round_trip = sum(tokenizer.decode(tokenizer.encode(sql)) == " ".join(sql.split())
+                         for sql in sql_lines) / len(sql_lines)
+        base_mean, compact_mean = sum(base_lens) / len(base_lens), sum(compact_lens) / len(compact_lens)
+        print(f"{split}: mean target length {base_mean:.1f} -> {compact_mean:.1f} tokens "
+              f"({(1 - compact_mean / base_mean) * 100:.1f}% shorter) | max {max(base_lens)} -> {max(compact_lens)} "
+              f"| exact round trip {round_trip * 100:.1f}%")
+
+    if args.compare is not None:
+        results = {name: time_dev_generation(name, args.test_batch_size) for name in args.compare}
+        for name, (secs, steps, f1) in results.items():
+            print(f"{name}: dev generation {secs:.1f}s | {steps:.1f} decoder steps per batch | F1 {f1:.4f}")
+        (base_secs, _, base_f1), (sql_secs, _, sql_f1) = results.values()
+        print(f"Decode speedup: {base_secs / sql_secs:.2f}x | F1 change {sql_f1 - base_f1:+.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+import os
+import csv
+import time
+import queue
+import argparse
+import itertools
+import statistics
+from argparse import Namespace
+
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+
+from utils import set_random_seeds, load_ground_truth
+from load_data import T5Dataset, SharedT5Dataset, ResumableSampler, pack_dataset, normal_collate_fn
+from t5_utils import snapshot_state_dict, model_from_state_dict
+from train_t5 import (initialize_model, build_optimizer_and_scheduler, freeze_encoder, unfreeze_encoder,
+                      train_epoch, subsample_eval)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep over train_t5 settings')
+    parser.add_argument('--sweep_name', type=str, default='sweep')
+
+    # Search space (grid)
+    parser.add_argument('--learning_rates', type=float, nargs='+', default=[1e-4, 3e-4, 1e-3])
+    parser.add_argument('--freeze_encoder_epochs', type=int, nargs='+', default=[0, 5])
+    parser.add_argument('--scheduler_types', type=str, nargs='+', default=["cosine"],
+                        choices=["none", "cosine", "linear"])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[16])
+
+    # Fixed training settings
+    parser.add_argument('--weight_decay', type=float, default=0)
+    parser.add_argument('--max_n_epochs', type=int, default=10)
+    parser.add_argument('--patience_epochs', type=int, default=3)
+    parser.add_argument('--test_batch_size', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=42)
+
+    # Scheduling and resource limits
+    parser.add_argument('--max_parallel', type=int, default=2, help="Trials running at the same time")
+    parser.add_argument('--threads_per_trial', type=int, default=None,
+                        help="torch threads per trial (defaults to cores / max_parallel)")
+    parser.add_argument('--max_trial_minutes', type=float, default=None, help="Wall-clock limit per trial")
+    parser.add_argument('--max_trial_memory_gb', type=float, default=None, help="Address-space limit per trial")
+    parser.add_argument('--prune_grace_epochs', type=int, default=2,
+                        help="Epochs before a trial can be stopped by the median rule")
+    parser.add_argument('--prune_min_trials', type=int, default=3,
+                        help="Reports needed at an epoch before the median rule applies")
+    return parser.parse_args()
+
+
+def build_trials(args):
+    grid = itertools.product(args.learning_rates, args.freeze_encoder_epochs, args.scheduler_types, args.batch_sizes)
+    trials = []
+    for trial_id, (lr, freeze, sched, bs) in enumerate(grid):
+        trials.append({
+            "trial_id": trial_id,
+            "learning_rate": lr,
+            "freeze_encoder_epochs": freeze,
+            "scheduler_type": sched,
+            "batch_size": bs,
+        })
+    return trials
+
+
+def prepare_shared(args):
+    '''
+    Everything a trial needs that does not depend on its hyperparameters:
+    tokenized train/dev data and the base weights, all in shared memory, plus
+    the ground-truth dev records.
+    '''
+    start = time.perf_counter()
+    shared = {
+        "train": pack_dataset(T5Dataset("data", "train")),
+        "dev": pack_dataset(T5Dataset("data", "dev")),
+    }
+    model = initialize_model(args)
+    shared["config"] = model.config
+    shared["weights"] = {k: v.share_memory_() for k, v in snapshot_state_dict(model).items()}
+    _, shared["gt_records"] = load_ground_truth("data/dev.sql", "records/ground_truth_dev.pkl")
+    print(f"Prepared shared data and weights in {time.perf_counter() - start:.1f}s")
+    return shared
+
+
+class TrialStopped(Exception):
+    pass
+
+
+def run_trial(trial, args, shared, threads, reports, stop):
+    '''
+    Train one configuration and report dev record F1 after every epoch.
+    Runs in its own process. When the parent sets the stop event, the trial
+    returns after its current optimizer step (or evaluation) instead of being
+    killed, so it never dies halfway through writing to the reports queue.
+    '''
+    if args.max_trial_memory_gb is not None:
+        import resource
+        limit = int(args.max_trial_memory_gb * 2 ** 30)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    torch.set_num_threads(threads)
+    set_random_seeds(args.seed)
+
+    trial_args = Namespace(**{**vars(args), **trial})
+    weights = {k: v.clone() for k, v in shared["weights"].items()}
+    model = model_from_state_dict(shared["config"], weights)
+
+    train_set = SharedT5Dataset(shared["train"])
+    train_loader = DataLoader(train_set, batch_size=trial_args.batch_size,
+                              sampler=ResumableSampler(train_set, args.seed), collate_fn=normal_collate_fn,
+                              generator=torch.Generator().manual_seed(args.seed))
+    dev_loader = DataLoader(SharedT5Dataset(shared["dev"]), batch_size=args.test_batch_size,
+                            collate_fn=normal_collate_fn)
+    optimizer, scheduler = build_optimizer_and_scheduler(trial_args, model, len(train_loader))
+
+    if trial_args.freeze_encoder_epochs > 0:
+        freeze_encoder(model)
+
+    def on_step(step, total_loss):
+        if stop.is_set():
+            raise TrialStopped
+
+    best_f1, patience = -1, 0
+    for epoch in range(args.max_n_epochs):
+        if epoch == trial_args.freeze_encoder_epochs:
+            unfreeze_encoder(model)
+        train_loader.sampler.set_epoch(epoch)
+        try:
+            train_loss = train_epoch(model, train_loader, optimizer, scheduler, on_step=on_step)
+        except TrialStopped:
+            return
+        f1 = subsample_eval(model, dev_loader, shared["gt_records"])
+        if stop.is_set():
+            return
+        reports.put(("epoch", trial["trial_id"], epoch, train_loss, f1))
+
+        if f1 > best_f1:
+            best_f1, patience = f1, 0
+        else:
+            patience += 1
+        if patience >= args.patience_epochs:
+            break
+
+    reports.put(("done", trial["trial_id"]))
+
+
+def should_prune(trial_id, epoch, f1, history, args):
+    '''
+    Median stopping rule: stop a trial whose dev F1 at this epoch is below the
+    median of what the other trials reached at the same epoch.
+    '''
+    if epoch + 1 < args.prune_grace_epochs:
+        return False
+    others = [h[epoch] for tid, h in history.items() if tid != trial_id and epoch in h]
+    if len(others) < args.prune_min_trials - 1:
+        return False
+    return f1 < statistics.median(others)
+
+
+def print_results(results, path):
+    columns = ["trial_id", "learning_rate", "freeze_encoder_epochs", "scheduler_type", "batch_size",
+               "status", "epochs", "best_f1", "minutes"]
+    rows = sorted(results, key=lambda r: r["best_f1"], reverse=True)
+
+    print(" | ".join(f"{c:>10}" for c in columns))
+    for row in rows:
+        cells = [f"{row[c]:.4f}" if isinstance(row[c], float) else str(row[c]) for c in columns]
+        print(" | ".join(f"{c:>10}" for c in cells))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", newline="") as f:
+        csv_writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
+    print(f"Results saved to {path}")
+
+
+def main():
+    args = get_args()
+    trials = build_trials(args)
+    threads = args.threads_per_trial or max(1, len(os.sched_getaffinity(0)) // args.max_parallel)
+    print(f"{len(trials)} trials, {args.max_parallel} at a time with {threads} threads each")
+
+    shared = prepare_shared(args)
+    # fork shares the already-loaded tokenizer and modules; shared tensors work either way
+    ctx = mp.get_context("fork" if "fork" in mp.get_all_start_methods() else "spawn")
+    reports = ctx.Queue()
+
+    pending = list(trials)
+    running = {}  # trial_id -> (process, start time, stop event)
+    stopping = []  # processes asked to stop that have not exited yet
+    history = {t["trial_id"]: {} for t in trials}
+    results = {t["trial_id"]: {**t, "status": "queued", "epochs": 0, "best_f1": -1.0, "minutes": 0.0}
+               for t in trials}
+
+    def finish(trial_id, status):
+        # The worker exits at its next check; it is joined once it has, while reports keep being drained
+        proc, start, stop = running.pop(trial_id)
+        stop.set()
+        stopping.append(proc)
+        results[trial_id]["status"] = status
+        results[trial_id]["minutes"] = (time.perf_counter() - start) / 60
+        print(f"Trial {trial_id}: {status} (best F1 {results[trial_id]['best_f1']:.4f})")
+
+    while pending or running or stopping:
+        for proc in [p for p in stopping if not p.is_alive()]:
+            proc.join()
+            stopping.remove(proc)
+
+        # Trials that are still stopping keep their resources until they exit
+        while pending and len(running) + len(stopping) < args.max_parallel:
+            trial = pending.pop(0)
+            stop = ctx.Event()
+            proc = ctx.Process(target=run_trial, args=(trial, args, shared, threads, reports, stop))
+            proc.start()
+            running[trial["trial_id"]] = (proc, time.perf_counter(), stop)
+            results[trial["trial_id"]]["status"] = "running"
+
+        try:
+            msg = reports.get(timeout=1 if stopping else 5)
+        except queue.Empty:
+            msg = None
+
+        if msg is not None and msg[1] in running:
+            if msg[0] == "epoch":
+                _, trial_id, epoch, train_loss, f1 = msg
+                history[trial_id][epoch] = f1
+                results[trial_id]["epochs"] = epoch + 1
+                results[trial_id]["best_f1"] = max(results[trial_id]["best_f1"], f1)
+                print(f"Trial {trial_id} epoch {epoch}: train loss {train_loss:.4f} | dev F1 {f1:.4f}")
+                if should_prune(trial_id, epoch, f1, history, args):
+                    finish(trial_id, "pruned")
+            else:
+                finish(msg[1], "completed")
+
+        for trial_id, (proc, start, _) in list(running.items()):
+            if args.max_trial_minutes is not None and time.perf_counter() - start > 60 * args.max_trial_minutes:
+                finish(trial_id, "timed out")
+            elif not proc.is_alive() and proc.exitcode != 0:
+                finish(trial_id, f"failed ({proc.exitcode})")
+
+    print_results(list(results.values()), f"results/{args.sweep_name}.csv")
+
+
+if __name__ == "__main__":
+    main()
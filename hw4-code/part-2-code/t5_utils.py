@@ -1,14 +1,24 @@
 # t5_utils.py
 
 import os
+import glob
+import json
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
+import safetensors.torch
 import torch
+import torch.nn as nn
+import torch.distributed as dist
 import transformers
 from transformers import T5ForConditionalGeneration, T5Config
 from transformers.pytorch_utils import ALL_LAYERNORM_LAYERS
 import wandb
 
+from profiling import PROFILER
+
 DEVICE = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+SQL_VOCAB_FILENAME = "sql_vocab.json"
 
 
 def setup_wandb(args):
@@ -22,6 +32,58 @@ def setup_wandb(args):
     )
 
 
+def _parse_cpulist(cpulist):
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if "-" in part:
+            lo, hi = part.split("-")
+            cpus.extend(range(int(lo), int(hi) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def bind_to_numa_node(local_rank, local_world_size):
+    '''
+    Pin this process to the cores of one NUMA node. Without enough NUMA nodes
+    (or no NUMA information), the available cores are split into equal
+    contiguous chunks instead. Returns the number of cores bound.
+    '''
+    available = sorted(os.sched_getaffinity(0))
+    node_dirs = sorted(glob.glob("/sys/devices/system/node/node[0-9]*"),
+                       key=lambda d: int(d.rsplit("node", 1)[1]))
+    if len(node_dirs) >= local_world_size:
+        with open(os.path.join(node_dirs[local_rank], "cpulist")) as f:
+            cpus = [c for c in _parse_cpulist(f.read()) if c in available]
+    else:
+        chunk = max(1, len(available) // local_world_size)
+        cpus = available[local_rank * chunk:(local_rank + 1) * chunk]
+    os.sched_setaffinity(0, cpus or available)
+    return len(cpus or available)
+
+
+def setup_distributed(args):
+    '''
+    Join the gloo process group set up by torchrun when --ddp is given and size
+    the intra-op thread pool so that processes do not oversubscribe the cores.
+    Returns (rank, world_size); (0, 1) for single-process runs.
+    '''
+    if not getattr(args, "ddp", False):
+        return 0, 1
+
+    dist.init_process_group("gloo")
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    local_rank = int(os.environ.get("LOCAL_RANK", rank))
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+
+    if args.bind_numa:
+        cores = bind_to_numa_node(local_rank, local_world_size)
+    else:
+        cores = max(1, len(os.sched_getaffinity(0)) // local_world_size)
+    torch.set_num_threads(args.threads_per_proc or cores)
+    return rank, world_size
+
+
 def initialize_model(args):
     '''
     Helper function to initialize the model. You should be either finetuning
@@ -50,25 +112,382 @@ def mkdir(dirpath):
             pass
 
 
-def save_model(checkpoint_dir, model, best):
-    # Save model checkpoint to be able to load the model later
+def snapshot_state_dict(model):
+    '''
+    Detached CPU copy of the model weights, safe to serialize on another thread
+    while training continues. Tied parameters (T5 shares its embedding with the
+    encoder, decoder and lm_head) are stored once.
+    '''
+    tensors = {}
+    seen = set()
+    for name, tensor in model.state_dict().items():
+        if tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        tensors[name] = tensor.detach().to("cpu", copy=True).contiguous()
+    return tensors
+
+
+def write_checkpoint(ckpt_path, tensors, config):
+    # Write to a temporary file first so a crash never leaves a torn checkpoint
+    tmp_path = ckpt_path + ".tmp"
+    safetensors.torch.save_file(tensors, tmp_path, metadata={"format": "pt"})
+    os.replace(tmp_path, ckpt_path)
+    config.save_pretrained(os.path.dirname(ckpt_path))
+
+
+class AsyncCheckpointWriter:
+    '''
+    Runs checkpoint writes on a background thread. At most one write is in
+    flight; submitting a new one first waits for the previous to finish.
+    '''
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def submit(self, fn, *args):
+        self.wait()
+        self.pending = self.executor.submit(fn, *args)
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+def save_model(checkpoint_dir, model, best, writer=None):
+    # Save model checkpoint to be able to load the model later. With a writer,
+    # only the CPU snapshot happens on the calling thread.
     mkdir(checkpoint_dir)
-    filename = "best_model.pt" if best else "last_model.pt"
+    filename = "best_model.safetensors" if best else "last_model.safetensors"
     ckpt_path = os.path.join(checkpoint_dir, filename)
-    torch.save(model.state_dict(), ckpt_path)
+    tensors = snapshot_state_dict(model)
+    if writer is None:
+        write_checkpoint(ckpt_path, tensors, model.config)
+    else:
+        writer.submit(write_checkpoint, ckpt_path, tensors, model.config)
+
+
+def _to_cpu(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def _write_training_state(path, state):
+    tmp_path = path + ".tmp"
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_training_state(path, model, optimizer, scheduler, writer=None, **progress):
+    '''
+    Save everything needed to resume training exactly: weights, optimizer
+    moments, scheduler step and the caller's progress counters (epoch, step,
+    early stopping state, RNG state, ...). The file is replaced atomically.
+    '''
+    state = {
+        "model": snapshot_state_dict(model),
+        "optimizer": _to_cpu(optimizer.state_dict()),
+        "scheduler": scheduler.state_dict() if scheduler is not None else None,
+        "progress": _to_cpu(progress),
+    }
+    if writer is None:
+        _write_training_state(path, state)
+    else:
+        writer.submit(_write_training_state, path, state)
+
+
+def load_training_state(path, model, optimizer, scheduler):
+    '''
+    Restore a state written by save_training_state into the given objects and
+    return the saved progress counters.
+    '''
+    state = torch.load(path, map_location="cpu", weights_only=False)
+    model.load_state_dict(state["model"], strict=False)
+    model.tie_weights()
+    optimizer.load_state_dict(state["optimizer"])
+    if scheduler is not None and state["scheduler"] is not None:
+        scheduler.load_state_dict(state["scheduler"])
+    return state["progress"]
+
+
+def build_target_vocab(target_ids, config):
+    '''
+    Sorted tensor of every token id that occurs in the given decoder targets,
+    plus the pad (decoder start), eos and unk tokens.
+    '''
+    vocab = {config.pad_token_id, config.eos_token_id, config.decoder_start_token_id}
+    if getattr(config, "unk_token_id", None) is not None:
+        vocab.add(config.unk_token_id)
+    for ids in target_ids:
+        vocab.update(ids.tolist())
+    return torch.tensor(sorted(vocab), dtype=torch.long)
+
+
+class RestrictedLMHead(nn.Module):
+    '''
+    Output projection that only computes logits for a subset of the
+    vocabulary: logits[..., j] scores token vocab_ids[j], so both the matmul
+    and the logits shrink from the full 32k vocabulary to the subset. Ids
+    predicted from these logits go through to_full_ids, labels through
+    to_sub_labels (restrict_lm_head does this for model(labels=...)); target
+    tokens outside the subset are left out of the loss.
+
+    model.generate expects full-vocabulary logits, so generate_sql and
+    greedy_decode decode restricted models themselves. full_width_logits
+    makes the head scatter into a full-size tensor for the remaining
+    model.generate callers (e.g. beam search).
+    '''
+
+    def __init__(self, lm_head, vocab_ids):
+        super().__init__()
+        # Shares the (tied) full projection weight, so training updates it in place
+        self.weight = lm_head.weight
+        self.out_features = lm_head.weight.size(0)
+        self.full_width = False
+        self.set_vocab(vocab_ids)
+
+    def set_vocab(self, vocab_ids):
+        device = self.weight.device
+        self.register_buffer("vocab_ids", vocab_ids.to(device), persistent=False)
+        sub_index = torch.full((self.out_features,), -100, dtype=torch.long, device=device)
+        sub_index[self.vocab_ids] = torch.arange(len(vocab_ids), device=device)
+        self.register_buffer("sub_index", sub_index, persistent=False)
+
+    def to_full_ids(self, sub_ids):
+        return self.vocab_ids[sub_ids]
+
+    def to_sub_labels(self, labels):
+        # -100 (ignored by the loss) stays -100, and so do tokens the subset cannot produce
+        return torch.where(labels >= 0, self.sub_index[labels.clamp(min=0)], labels)
+
+    def forward(self, hidden):
+        sub_logits = hidden @ self.weight.index_select(0, self.vocab_ids).t()
+        if not self.full_width:
+            return sub_logits
+        logits = sub_logits.new_full((*sub_logits.shape[:-1], self.out_features), torch.finfo(sub_logits.dtype).min)
+        return logits.index_copy(-1, self.vocab_ids, sub_logits)
+
+
+def _restricted_labels_hook(model, args, kwargs):
+    # Decoder inputs are built from the original labels before they are mapped to subset positions
+    head = model.lm_head
+    labels = kwargs.get("labels")
+    if labels is None or not isinstance(head, RestrictedLMHead) or head.full_width:
+        return None
+    if kwargs.get("decoder_input_ids") is None and kwargs.get("decoder_inputs_embeds") is None:
+        kwargs["decoder_input_ids"] = model._shift_right(labels)
+    kwargs["labels"] = head.to_sub_labels(labels)
+    return args, kwargs
+
+
+def restrict_lm_head(model, vocab_ids):
+    # The wrapper holds no extra parameters, so checkpoints keep the plain T5 layout
+    if isinstance(model.lm_head, RestrictedLMHead):
+        model.lm_head.set_vocab(vocab_ids)
+    else:
+        model.lm_head = RestrictedLMHead(model.lm_head, vocab_ids)
+    if not getattr(model, "_restricted_labels_hooked", False):
+        model.register_forward_pre_hook(_restricted_labels_hook, with_kwargs=True)
+        model._restricted_labels_hooked = True
+    return model
+
+
+def is_restricted(model):
+    return isinstance(model.lm_head, RestrictedLMHead)
+
+
+def full_vocab_ids(model, ids):
+    # Token ids for an argmax over the model's logits
+    return model.lm_head.to_full_ids(ids) if is_restricted(model) and not model.lm_head.full_width else ids
+
+
+@contextmanager
+def full_width_logits(model):
+    '''Full-vocabulary logits from a restricted head, for model.generate.'''
+    if not is_restricted(model):
+        yield model
+        return
+    model.lm_head.full_width = True
+    try:
+        yield model
+    finally:
+        model.lm_head.full_width = False
+
+
+def save_target_vocab(checkpoint_dir, vocab_ids):
+    mkdir(checkpoint_dir)
+    with open(os.path.join(checkpoint_dir, SQL_VOCAB_FILENAME), "w") as f:
+        json.dump(vocab_ids.tolist(), f)
+
+
+def load_target_vocab(checkpoint_dir):
+    path = os.path.join(checkpoint_dir, SQL_VOCAB_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return torch.tensor(json.load(f), dtype=torch.long)
+
+
+def load_pretrained_fast(checkpoint_dir, best=True):
+    '''
+    Load a checkpoint written by save_model. The model is built on the meta
+    device and its parameters are bound directly to the memory-mapped
+    safetensors storage, so no time is spent on a random initialization that
+    is immediately overwritten. Checkpoints in the Hugging Face layout
+    (save_pretrained) fall back to from_pretrained.
+    '''
+    filename = "best_model.safetensors" if best else "last_model.safetensors"
+    ckpt_path = os.path.join(checkpoint_dir, filename)
+    if not os.path.exists(ckpt_path):
+        model = T5ForConditionalGeneration.from_pretrained(checkpoint_dir)
+    else:
+        config = T5Config.from_pretrained(checkpoint_dir)
+        state_dict = safetensors.torch.load_file(ckpt_path)
+        model = model_from_state_dict(config, state_dict)
+
+    # Models trained with a restricted output vocabulary decode with it too
+    vocab_ids = load_target_vocab(checkpoint_dir)
+    if vocab_ids is not None:
+        restrict_lm_head(model, vocab_ids)
+    return model.to(DEVICE).eval()
+
+
+def model_from_state_dict(config, state_dict):
+    '''
+    Build a T5 model on the meta device and bind the given tensors as its
+    parameters without copying them or running the weight initialization.
+    '''
+    with torch.device("meta"):
+        model = T5ForConditionalGeneration(config)
+    _, unexpected = model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+
+    missing = [n for n, t in list(model.named_parameters()) + list(model.named_buffers()) if t.is_meta]
+    if missing or unexpected:
+        raise RuntimeError(f"State dict does not match the model: missing {missing}, unexpected {unexpected}")
+    for param in model.parameters():
+        param.requires_grad_(True)
+    return model
 
 
 def load_model_from_checkpoint(args, best):
     # Load model from a checkpoint
-    filename = "best_model.pt" if best else "last_model.pt"
-    ckpt_path = os.path.join(args.checkpoint_dir, filename)
+    return load_pretrained_fast(args.checkpoint_dir, best)
 
-    # Recreate the same architecture as during training
-    model = initialize_model(args)
-    state_dict = torch.load(ckpt_path, map_location=DEVICE)
-    model.load_state_dict(state_dict)
-    model = model.to(DEVICE)
-    return model
+
+def generate_ids(model, enc_in, enc_mask, max_new_tokens, decode_fn=None):
+    '''
+    Greedy decoding. decode_fn(model, enc_in, enc_mask, max_new_tokens) can
+    replace the default (e.g. fast_forward.fast_forward_decode); models with a
+    restricted head use greedy_decode, which handles their narrow logits.
+    '''
+    if decode_fn is not None:
+        return decode_fn(model, enc_in, enc_mask, max_new_tokens)
+    if is_restricted(model):
+        return greedy_decode(model, enc_in, enc_mask, max_new_tokens)
+    return model.generate(input_ids=enc_in, attention_mask=enc_mask, max_new_tokens=max_new_tokens)
+
+
+def generate_sql(model, tokenizer, enc_in, enc_mask, max_new_tokens, cache=None, decode_fn=None):
+    '''
+    Decode a padded batch of encoder inputs into SQL strings. When a
+    GenerationCache is given, inputs it has already seen are answered from
+    the cache and only the remaining rows are generated. decode_fn is passed
+    on to generate_ids.
+    '''
+    if cache is None:
+        with PROFILER.span("generate", rows=len(enc_in)):
+            gen = generate_ids(model, enc_in, enc_mask, max_new_tokens, decode_fn)
+        PROFILER.count("generate.rows", len(enc_in))
+        return [x.strip() for x in tokenizer.batch_decode(gen, skip_special_tokens=True)]
+
+    keys = [cache.key_for_ids(ids[mask.bool()]) for ids, mask in zip(enc_in, enc_mask)]
+    results = []
+    pending = {}
+    for i, key in enumerate(keys):
+        if key in pending:
+            # Duplicate of a row already being generated in this batch
+            cache.hits += 1
+            results.append(None)
+            continue
+        res = cache.get(key)
+        results.append(res)
+        if res is None:
+            pending[key] = i
+
+    generated = {}
+    if pending:
+        rows = torch.tensor(list(pending.values()), device=enc_in.device)
+        sub_mask = enc_mask[rows]
+        max_len = int(sub_mask.sum(dim=1).max())
+        with PROFILER.span("generate", rows=len(rows)):
+            gen = generate_ids(model, enc_in[rows, :max_len], sub_mask[:, :max_len], max_new_tokens, decode_fn)
+        decoded = [x.strip() for x in tokenizer.batch_decode(gen, skip_special_tokens=True)]
+        for key, sql in zip(pending, decoded):
+            cache.put(key, sql)
+            generated[key] = sql
+
+    PROFILER.count("generate.rows", len(pending))
+    PROFILER.count("generate.cached_rows", len(keys) - len(pending))
+    return [res if res is not None else generated[key] for key, res in zip(keys, results)]
+
+
+def t5_decoder_step(model, decoder_input_ids, encoder_hidden, enc_mask, past_key_values=None):
+    # One cached decoder forward pass; returns logits for every input position
+    out = model(
+        encoder_outputs=(encoder_hidden,),
+        attention_mask=enc_mask,
+        decoder_input_ids=decoder_input_ids,
+        past_key_values=past_key_values,
+        use_cache=True,
+    )
+    return out.logits, out.past_key_values
+
+
+def greedy_decode(model, enc_in, enc_mask, max_new_tokens, encode_fn=None, step_fn=None, finished=None):
+    '''
+    Plain greedy decoding loop equivalent to model.generate(max_new_tokens=...)
+    with default settings. encode_fn(enc_in, enc_mask) -> encoder hidden states
+    and step_fn(decoder_input_ids, encoder_hidden, enc_mask, past) -> (logits, past)
+    can be swapped for compiled or otherwise specialized implementations.
+    finished optionally marks rows that are done from the start (e.g. padding
+    rows), which only produce pad tokens and do not keep the loop running.
+    '''
+    config = model.config
+    if encode_fn is None:
+        encode_fn = lambda ids, mask: model.encoder(input_ids=ids, attention_mask=mask).last_hidden_state
+    if step_fn is None:
+        step_fn = lambda ids, hidden, mask, past: t5_decoder_step(model, ids, hidden, mask, past)
+
+    encoder_hidden = encode_fn(enc_in, enc_mask)
+    batch_size = enc_in.size(0)
+    dec = torch.full((batch_size, 1), config.decoder_start_token_id, dtype=torch.long, device=enc_in.device)
+    if finished is None:
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=enc_in.device)
+    finished = finished.clone()
+    past = None
+
+    for _ in range(max_new_tokens):
+        logits, past = step_fn(dec[:, -1:], encoder_hidden, enc_mask, past)
+        next_tokens = full_vocab_ids(model, logits[:, -1].argmax(dim=-1))
+        next_tokens = torch.where(finished, torch.full_like(next_tokens, config.pad_token_id), next_tokens)
+        dec = torch.cat([dec, next_tokens.unsqueeze(1)], dim=1)
+        finished |= next_tokens == config.eos_token_id
+        if finished.all():
+            break
+
+    return dec
 
 
 def initialize_optimizer_and_scheduler(args, model, epoch_length):
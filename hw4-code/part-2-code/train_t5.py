@@ -3,17 +3,30 @@ import argparse
 from tqdm import tqdm
 import torch
 import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 import wandb
 
-from transformers import T5ForConditionalGeneration, T5TokenizerFast, AdamW, get_linear_schedule_with_warmup
-from utils import compute_metrics, save_queries_and_records
-from load_data import load_t5_data
+from transformers import T5ForConditionalGeneration, T5TokenizerFast, AdamW
+from transformers import get_linear_schedule_with_warmup, get_cosine_schedule_with_warmup, get_constant_schedule
+from utils import save_queries_and_records, set_random_seeds, get_rng_state, set_rng_state
+from utils import compute_records, compute_record_F1, load_ground_truth, score_predictions, write_queries_and_records
+from torch.utils.data import DataLoader, Subset
+from load_data import load_t5_data, load_lines, PAD_IDX
+from t5_utils import generate_sql, save_model, AsyncCheckpointWriter, save_training_state, load_training_state
+from t5_utils import setup_distributed, build_target_vocab, restrict_lm_head, save_target_vocab, full_vocab_ids
+from generation_cache import GenerationCache, model_fingerprint, generation_settings
+from sql_tokenizer import SqlTargetTokenizer
+from eval_scheduler import EvalScheduler, stratified_subsample_indices
+from profiling import PROFILER
+from fast_forward import load_fast_forward_decoder
 
 DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 TOKENIZER = T5TokenizerFast.from_pretrained("t5-small")
 TOKENIZER.pad_token = TOKENIZER.eos_token  # IMPORTANT
 MAX_NEW_TOKENS = 256  # SQL is long
+TRAINING_STATE_FILENAME = "training_state.pt"
 
 def get_args():
     '''
@@ -34,7 +47,7 @@ def get_args():
     parser.add_argument('--optimizer_type', type=str, default="AdamW", choices=["AdamW"],
                         help="What optimizer to use")
     parser.add_argument('--weight_decay', type=float, default=0)
-    parser.add_argument('--scheduler_type', type=str, default="cosine", choices=["none", "cosine", "linear"],
+    parser.add_argument('--scheduler_type', type=str, default="linear", choices=["none", "cosine", "linear"],
                         help="Whether to use a LR scheduler and what type to use if so")
     parser.add_argument('--num_warmup_epochs', type=int, default=0)
     parser.add_argument('--max_n_epochs', type=int, default=25,
@@ -42,14 +55,65 @@ def get_args():
     parser.add_argument('--patience_epochs', type=int, default=5,
                         help="How many epochs to wait before early stopping")
 
+    # Evaluation scheduling
+    parser.add_argument('--eval_schedule', type=str, default="full", choices=["full", "adaptive"],
+                        help="'full' generates and executes the whole dev set every epoch; 'adaptive' only "
+                             "does so when cheap proxies suggest a new best (or every --full_eval_every epochs)")
+    parser.add_argument('--full_eval_every', type=int, default=5)
+    parser.add_argument('--eval_subsample', type=float, default=0.1,
+                        help="Fraction of dev used for the cheap per-epoch generate-and-execute check")
+
+    # Resumable training
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue from checkpoints/<experiment_name>/training_state.pt if it exists")
+    parser.add_argument('--save_every_steps', type=int, default=100,
+                        help="Write the full training state every N optimizer steps (and at every epoch end)")
+
+    # Multi-process CPU training (launch with torchrun --nproc_per_node=<sockets> train_t5.py --ddp)
+    parser.add_argument('--ddp', action='store_true',
+                        help="Distributed data-parallel training over the gloo backend")
+    parser.add_argument('--threads_per_proc', type=int, default=None,
+                        help="Intra-op threads per process (defaults to the cores available to it)")
+    parser.add_argument('--bind_numa', action='store_true',
+                        help="Pin each local process to one NUMA node (or an equal share of the cores)")
+
+    # Output vocabulary
+    parser.add_argument('--restrict_vocab', action='store_true',
+                        help="Only score the token ids that occur in the train.sql targets (plus special tokens) "
+                             "in the output projection, for both training and generation")
+
+    parser.add_argument('--sql_target_vocab', action='store_true',
+                        help="Tokenize the SQL targets with a compact vocabulary in which frequent keywords and "
+                             "schema identifiers from train.sql are single added tokens")
+    parser.add_argument('--sql_vocab_min_count', type=int, default=2,
+                        help="Minimum train.sql frequency for a word to get its own token")
+
+    # Decoding
+    parser.add_argument('--fast_forward', action='store_true',
+                        help="Decode dev/test with trie fast-forwarding over SQL words from train.sql "
+                             "(same outputs as greedy decoding)")
+
     # Wandb + experiment name
     parser.add_argument('--use_wandb', action='store_true')
     parser.add_argument('--experiment_name', type=str, default='ft_experiment')
 
+    # Profiling
+    parser.add_argument('--profile', action='store_true',
+                        help="Time tokenization, training steps, generation, SQL execution and metrics")
+    parser.add_argument('--profile_dir', type=str, default='profiles',
+                        help="Where the Chrome trace (<experiment_name>_trace.json) is written")
+
     # Data
     parser.add_argument('--batch_size', type=int, default=16)
     parser.add_argument('--test_batch_size', type=int, default=16)
 
+    # Generation cache
+    parser.add_argument('--gen_cache_size', type=int, default=4096,
+                        help="Max entries in the generation memo cache (0 disables it)")
+    parser.add_argument('--gen_cache_path', type=str, default=None,
+                        help="Optional file to persist the generation cache across runs")
+
     args = parser.parse_args()
     return args
 
@@ -59,6 +123,18 @@ def initialize_model(args):
     model.config.pad_token_id = TOKENIZER.pad_token_id
     return model
 
+def build_optimizer_and_scheduler(args, model, steps_per_epoch):
+    optimizer = AdamW(model.parameters(), lr=args.learning_rate, weight_decay=args.weight_decay)
+    total_steps = steps_per_epoch * args.max_n_epochs
+    num_warmup_steps = int(0.05 * total_steps)
+    if args.scheduler_type == "linear":
+        scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps, total_steps)
+    elif args.scheduler_type == "cosine":
+        scheduler = get_cosine_schedule_with_warmup(optimizer, num_warmup_steps, total_steps)
+    else:
+        scheduler = get_constant_schedule(optimizer)
+    return optimizer, scheduler
+
 def freeze_encoder(model):
     for name, param in model.named_parameters():
         if "encoder" in name:
@@ -69,35 +145,59 @@ def unfreeze_encoder(model):
         if "encoder" in name:
             param.requires_grad = True
 
-def train_epoch(model, loader, optimizer, scheduler):
+def train_epoch(model, loader, optimizer, scheduler, start_step=0, total_loss=0, on_step=None):
+    '''
+    Train for one epoch. When resuming mid-epoch, the loader only yields the
+    remaining batches and start_step/total_loss carry the progress so far.
+    on_step(step, total_loss) is called after every optimizer step.
+    '''
     model.train()
-    total_loss = 0
+    step = start_step
 
-    for enc_in, enc_mask, dec_in, dec_tgt, _ in tqdm(loader):
+    for enc_in, enc_mask, dec_in, dec_tgt, _ in tqdm(loader, initial=start_step, total=start_step + len(loader)):
         enc_in, enc_mask, dec_tgt = (
             enc_in.to(DEVICE),
             enc_mask.to(DEVICE),
             dec_tgt.to(DEVICE),
         )
-        optimizer.zero_grad()
-
-        outputs = model(
-            input_ids=enc_in,
-            attention_mask=enc_mask,
-            labels=dec_tgt
-        )
-
-        loss = outputs.loss
-        loss.backward()
-
-        optimizer.step()
-        scheduler.step()
-
-        total_loss += loss.item()
-
-    return total_loss / len(loader)
-
-def eval_epoch(model, loader, gt_sql, model_sql, gt_rec, model_rec):
+        with PROFILER.span("train.step", step=step):
+            optimizer.zero_grad()
+
+            with PROFILER.span("train.forward"):
+                outputs = model(
+                    input_ids=enc_in,
+                    attention_mask=enc_mask,
+                    labels=dec_tgt
+                )
+
+            loss = outputs.loss
+            with PROFILER.span("train.backward"):
+                loss.backward()
+
+            with PROFILER.span("train.optimizer"):
+                optimizer.step()
+                scheduler.step()
+
+            total_loss += loss.item()
+        if PROFILER.enabled:
+            # Reading the count synchronizes with the device, so it is skipped when off
+            PROFILER.count("train.tokens", int(enc_mask.sum()))
+        step += 1
+        if on_step is not None:
+            on_step(step, total_loss)
+
+    return total_loss / max(step, 1)
+
+def eval_epoch(model, loader, gt_sql, model_sql, gt_rec, model_rec, cache=None, tokenizer=TOKENIZER, writer=None,
+               eval_loss=None, decode_fn=None):
+    '''
+    Dev loss and generate-and-execute metrics, scored in memory against the
+    cached ground truth. The predictions are written to model_sql/model_rec
+    (skipped when they are None), on the writer's thread if one is given.
+    A dev loss already computed for this model (e.g. by proxy_eval_epoch) can
+    be passed as eval_loss to skip the teacher-forced forward passes.
+    decode_fn is passed on to generate_sql.
+    '''
     model.eval()
     total_loss = 0
     all_sql = []
@@ -110,131 +210,334 @@ def eval_epoch(model, loader, gt_sql, model_sql, gt_rec, model_rec):
                 dec_tgt.to(DEVICE)
             )
 
-            out = model(
-                input_ids=enc_in,
-                attention_mask=enc_mask,
-                labels=dec_tgt
-            )
+            if eval_loss is None:
+                out = model(
+                    input_ids=enc_in,
+                    attention_mask=enc_mask,
+                    labels=dec_tgt
+                )
+                total_loss += out.loss.item()
+
+            all_sql.extend(generate_sql(model, tokenizer, enc_in, enc_mask, MAX_NEW_TOKENS, cache, decode_fn))
+
+    if eval_loss is None:
+        eval_loss = total_loss / len(loader)
+    records, errors = compute_records(all_sql)
+    with PROFILER.span("eval.metrics"):
+        gt_qs, gt_records = load_ground_truth(gt_sql, gt_rec)
+        sql_em, record_em, record_f1 = score_predictions(gt_qs, gt_records, all_sql, records)
+    error_rate = sum(1 for e in errors if e) / len(errors)
+
+    if model_sql is not None and model_rec is not None:
+        if writer is None:
+            write_queries_and_records(all_sql, records, errors, model_sql, model_rec)
+        else:
+            writer.submit(write_queries_and_records, all_sql, records, errors, model_sql, model_rec)
+
+    return eval_loss, record_f1, record_em, sql_em, error_rate
 
+def proxy_eval_epoch(model, loader):
+    '''
+    Teacher-forced dev metrics from a single forward pass per batch: loss,
+    token accuracy and sequence-level exact match.
+    '''
+    model.eval()
+    total_loss = 0
+    correct_tokens, total_tokens = 0, 0
+    correct_seqs, total_seqs = 0, 0
+
+    with torch.no_grad():
+        for enc_in, enc_mask, dec_in, dec_tgt, _ in tqdm(loader):
+            enc_in, enc_mask, dec_tgt = enc_in.to(DEVICE), enc_mask.to(DEVICE), dec_tgt.to(DEVICE)
+            out = model(input_ids=enc_in, attention_mask=enc_mask, labels=dec_tgt)
             total_loss += out.loss.item()
 
-            gen = model.generate(
-                input_ids=enc_in,
-                attention_mask=enc_mask,
-                max_new_tokens=MAX_NEW_TOKENS
-            )
-            decoded = TOKENIZER.batch_decode(gen, skip_special_tokens=True)
-            all_sql.extend([x.strip() for x in decoded])
+            mask = dec_tgt != PAD_IDX
+            hits = (full_vocab_ids(model, out.logits.argmax(dim=-1)) == dec_tgt) & mask
+            correct_tokens += hits.sum().item()
+            total_tokens += mask.sum().item()
+            correct_seqs += (hits.sum(dim=1) == mask.sum(dim=1)).sum().item()
+            total_seqs += dec_tgt.size(0)
 
-    eval_loss = total_loss / len(loader)
-    save_queries_and_records(all_sql, model_sql, model_rec)
+    return total_loss / len(loader), correct_tokens / total_tokens, correct_seqs / total_seqs
 
-    sql_em, record_em, record_f1, errors = compute_metrics(gt_sql, model_sql, gt_rec, model_rec)
-    error_rate = sum(1 for e in errors if e) / len(errors)
 
-    return eval_loss, record_f1, record_em, sql_em, error_rate
+def subsample_eval(model, loader, gt_records, cache=None, tokenizer=TOKENIZER, decode_fn=None):
+    '''
+    Generate-and-execute record F1 on a fixed dev subsample.
+    '''
+    model.eval()
+    all_sql = []
+    with torch.no_grad():
+        for enc_in, enc_mask, _, _, _ in tqdm(loader):
+            enc_in, enc_mask = enc_in.to(DEVICE), enc_mask.to(DEVICE)
+            all_sql.extend(generate_sql(model, tokenizer, enc_in, enc_mask, MAX_NEW_TOKENS, cache, decode_fn))
+    records, _ = compute_records(all_sql)
+    return compute_record_F1(gt_records, records)
+
 
-# Modify your generate_and_save_test_results function to match the data structure
-def generate_and_save_test_results(test_loader, model, tokenizer):
+def generate_and_save_test_results(model, test_loader, model_sql, model_rec, cache=None, tokenizer=TOKENIZER,
+                                   decode_fn=None):
     model.eval()
     predicted_sqls = []
 
     with torch.no_grad():
-        for enc_in, enc_mask in tqdm(test_loader, desc="Generating SQL queries", ncols=100):  # Adjust unpacking here
+        for enc_in, enc_mask, _ in tqdm(test_loader, desc="Generating SQL queries", ncols=100):
             enc_in, enc_mask = enc_in.to(DEVICE), enc_mask.to(DEVICE)
+            predicted_sqls.extend(generate_sql(model, tokenizer, enc_in, enc_mask, MAX_NEW_TOKENS, cache, decode_fn))
 
-            outputs = model.generate(
-                input_ids=enc_in,
-                attention_mask=enc_mask,
-                max_length=256
-            )
-            decoded = tokenizer.batch_decode(outputs, skip_special_tokens=True)
-            predicted_sqls.extend([sql.strip() for sql in decoded])
+    os.makedirs(os.path.dirname(model_sql), exist_ok=True)
+    os.makedirs(os.path.dirname(model_rec), exist_ok=True)
+    save_queries_and_records(predicted_sqls, model_sql, model_rec)
 
-    # Save the SQL predictions
-    os.makedirs("results", exist_ok=True)
-    with open("results/t5_ft_test.sql", "w") as f:
-        for sql in predicted_sqls:
-            f.write(sql + "\n")
+    print(f"Test SQL queries saved to '{model_sql}'")
 
-    print("Test SQL queries saved to 'results/t5_ft_test.sql'")
 
 
+def scheduled_eval(args, model, epoch, dev_loader, sub_eval, eval_scheduler, patience, cache=None,
+                   tokenizer=TOKENIZER, writer=None, decode_fn=None):
+    '''
+    Cheap dev proxies every epoch, plus the full generate-and-execute
+    evaluation whenever the scheduler asks for it. Returns the full record F1,
+    or None when the full evaluation was skipped.
+    '''
+    signals = {}
+    proxy_loss = None
+    if args.eval_schedule == "adaptive":
+        proxy_loss, token_acc, tf_em = proxy_eval_epoch(model, dev_loader)
+        signals = {"token_acc": token_acc, "tf_em": tf_em}
+        msg = f"Dev proxy loss: {proxy_loss:.4f} | token acc: {token_acc:.4f} | TF EM: {tf_em:.4f}"
+        if sub_eval is not None:
+            signals["sub_f1"] = subsample_eval(model, *sub_eval, cache, tokenizer, decode_fn)
+            msg += f" | subsample F1: {signals['sub_f1']:.4f}"
+        print(msg)
+
+    # Never early-stop on proxy evidence alone
+    about_to_stop = patience + 1 >= args.patience_epochs
+    if not eval_scheduler.should_run_full(epoch, signals, about_to_stop):
+        print("Skipped full dev evaluation (no proxy improvement)")
+        return None
+
+    eval_scheduler.record_full(epoch)
+    eval_loss, f1, rec_em, sql_em, err = eval_epoch(
+        model, dev_loader,
+        "data/dev.sql",
+        f"results/{args.experiment_name}_dev.sql",
+        "records/ground_truth_dev.pkl",
+        f"records/{args.experiment_name}_dev.pkl",
+        cache,
+        tokenizer,
+        writer,
+        eval_loss=proxy_loss,  # same teacher-forced dev loss, already computed above
+        decode_fn=decode_fn,
+    )
+    print(f"Dev loss: {eval_loss:.4f} | F1: {f1:.4f} | EM: {rec_em:.4f} | SQL EM: {sql_em:.4f}")
+    return f1
+
+
+def export_profile(args, rank=0):
+    # One trace per process; rank 0 also prints the summary table
+    suffix = f"_rank{rank}" if rank else ""
+    path = os.path.join(args.profile_dir, f"{args.experiment_name}_trace{suffix}.json")
+    PROFILER.export_chrome_trace(path)
+    if rank == 0:
+        print(PROFILER.summary())
+        print(f"Chrome trace saved to '{path}' (open in chrome://tracing or ui.perfetto.dev)")
+
 
 def main():
     args = get_args()
+    rank, world_size = setup_distributed(args)
+    is_main = rank == 0
+    set_random_seeds(args.seed)
+    if args.profile:
+        PROFILER.enable()
 
     # wandb
-    if args.use_wandb:
+    if args.use_wandb and is_main:
         wandb.init(project="t5-sql", name=args.experiment_name)
 
+    model = initialize_model(args)
+
+    # SQL targets are decoded with the same tokenizer they were encoded with
+    target_tokenizer = None
+    decode_tokenizer = TOKENIZER
+    if args.sql_target_vocab:
+        target_tokenizer = SqlTargetTokenizer.learn(load_lines("data/train.sql"), TOKENIZER, model.config.vocab_size,
+                                                    args.sql_vocab_min_count)
+        target_tokenizer.extend_model_embeddings(model)
+        decode_tokenizer = target_tokenizer
+        print(f"Added {len(target_tokenizer.words)} SQL tokens to the target vocabulary")
+
     # Load data
     train_loader, dev_loader, test_loader = load_t5_data(
-        args.batch_size, args.test_batch_size
+        args.batch_size, args.test_batch_size, args.seed, rank, world_size, target_tokenizer
     )
 
-    model = initialize_model(args)
+    vocab_ids = None
+    if args.restrict_vocab:
+        vocab_ids = build_target_vocab(train_loader.dataset.decoder_targets, model.config)
+        restrict_lm_head(model, vocab_ids)
+        print(f"Restricted output vocabulary to {len(vocab_ids)} of {model.config.vocab_size} tokens")
 
-    if args.freeze_encoder_epochs > 0:
-        freeze_encoder(model)
-
-    optimizer = AdamW(model.parameters(), lr=args.learning_rate)
-    total_steps = len(train_loader) * args.max_n_epochs
-    scheduler = get_linear_schedule_with_warmup(
-        optimizer,
-        num_warmup_steps=int(0.05 * total_steps),
-        num_training_steps=total_steps,
-    )
+    optimizer, scheduler = build_optimizer_and_scheduler(args, model, len(train_loader))
 
     best_f1 = -1
     patience = 0
+    start_epoch, start_step, epoch_loss = 0, 0, 0.0
 
     checkpoint = f"checkpoints/{args.experiment_name}"
-    os.makedirs(checkpoint, exist_ok=True)
+    writer = AsyncCheckpointWriter()
+    # Dev predictions are persisted off the training thread as well
+    results_writer = AsyncCheckpointWriter()
+    if is_main:
+        os.makedirs(checkpoint, exist_ok=True)
+        TOKENIZER.save_pretrained(checkpoint)
+        if target_tokenizer is not None:
+            target_tokenizer.save(checkpoint)
+        if vocab_ids is not None:
+            save_target_vocab(checkpoint, vocab_ids)
+
+    eval_scheduler = EvalScheduler(args.eval_schedule, args.full_eval_every)
+
+    state_path = os.path.join(checkpoint, TRAINING_STATE_FILENAME)
+    if args.resume and os.path.exists(state_path):
+        progress = load_training_state(state_path, model, optimizer, scheduler)
+        if len(progress["rng"]) != world_size:
+            raise ValueError(f"Training state was saved with {len(progress['rng'])} processes, "
+                             f"cannot resume exactly with {world_size}")
+        start_epoch, start_step, epoch_loss = progress["epoch"], progress["step"], progress["epoch_loss"]
+        best_f1, patience = progress["best_f1"], progress["patience"]
+        set_rng_state(progress["rng"][rank])
+        eval_scheduler.load_state_dict(progress["eval_scheduler"])
+        print(f"Resumed from epoch {start_epoch}, step {start_step} (best F1 {best_f1:.4f})")
+        if patience >= args.patience_epochs:
+            print("Run had already early-stopped.")
+            start_epoch = args.max_n_epochs
+
+    if start_epoch < args.freeze_encoder_epochs:
+        freeze_encoder(model)
+    # DDP only synchronizes parameters that require grad when it is built
+    train_model = DistributedDataParallel(model) if world_size > 1 else model
+
+    sub_eval = None
+    if is_main and args.eval_schedule == "adaptive" and args.eval_subsample > 0:
+        dev_set = dev_loader.dataset
+        sub_idx = stratified_subsample_indices([len(t) for t in dev_set.decoder_targets],
+                                               args.eval_subsample, seed=args.seed)
+        sub_loader = DataLoader(Subset(dev_set, sub_idx), batch_size=args.test_batch_size,
+                                collate_fn=dev_loader.collate_fn)
+        _, gt_records = load_ground_truth("data/dev.sql", "records/ground_truth_dev.pkl")
+        sub_eval = (sub_loader, [gt_records[i] for i in sub_idx])
+
+    def save_state(epoch, step, epoch_loss):
+        # Every rank contributes its RNG state; only rank 0 writes
+        rng = [get_rng_state()]
+        if world_size > 1:
+            rng = [None] * world_size
+            dist.all_gather_object(rng, get_rng_state())
+        if is_main:
+            save_training_state(
+                state_path, model, optimizer, scheduler, writer,
+                epoch=epoch, step=step, epoch_loss=epoch_loss,
+                best_f1=best_f1, patience=patience, rng=rng,
+                eval_scheduler=eval_scheduler.state_dict(),
+            )
+
+    decode_fn = None
+    if args.fast_forward and is_main:
+        decode_fn = load_fast_forward_decoder(decode_tokenizer, train_loader.dataset.decoder_targets)
+
+    cache = None
+    if args.gen_cache_size > 0 and is_main:
+        cache = GenerationCache(TOKENIZER, args.gen_cache_size, args.gen_cache_path)
 
     # Train loop
-    for epoch in range(args.max_n_epochs):
+    steps_per_epoch = len(train_loader)
+    for epoch in range(start_epoch, args.max_n_epochs):
         print(f"\n=== Epoch {epoch} ===")
 
         if epoch == args.freeze_encoder_epochs:
             unfreeze_encoder(model)
+            if world_size > 1:
+                train_model = DistributedDataParallel(model)
             print("Unfroze encoder!")
 
-        train_loss = train_epoch(model, train_loader, optimizer, scheduler)
-        print(f"Train loss: {train_loss:.4f}")
+        if epoch != start_epoch:
+            start_step, epoch_loss = 0, 0.0
+        train_loader.sampler.set_epoch(epoch, start_step * args.batch_size)
 
-        # Evaluate
-        eval_loss, f1, rec_em, sql_em, err = eval_epoch(
-            model, dev_loader,
-            "data/dev.sql",
-            f"results/{args.experiment_name}_dev.sql",
-            "records/ground_truth_dev.pkl",
-            f"records/{args.experiment_name}_dev.pkl"
-        )
-        print(f"Dev loss: {eval_loss:.4f} | F1: {f1:.4f} | EM: {rec_em:.4f} | SQL EM: {sql_em:.4f}")
+        def on_step(step, total_loss):
+            if step == steps_per_epoch or (args.save_every_steps > 0 and step % args.save_every_steps == 0):
+                save_state(epoch, step, total_loss)
 
-        # Save best model
-        if f1 > best_f1:
-            best_f1 = f1
-            patience = 0
-            model.save_pretrained(checkpoint)
-            TOKENIZER.save_pretrained(checkpoint)
-            print("Saved new best model!")
+        with PROFILER.span("train.epoch", epoch=epoch):
+            train_loss = train_epoch(train_model, train_loader, optimizer, scheduler, start_step, epoch_loss,
+                                     on_step)
+        print(f"Train loss: {train_loss:.4f}")
 
-        else:
-            patience += 1
+        # Evaluate and checkpoint on rank 0 only
+        if is_main:
+            if cache is not None:
+                cache.set_fingerprint(model_fingerprint(model),
+                                      **generation_settings(model, MAX_NEW_TOKENS, decode_fn))
+            with PROFILER.span("eval", epoch=epoch):
+                f1 = scheduled_eval(args, model, epoch, dev_loader, sub_eval, eval_scheduler, patience, cache,
+                                    decode_tokenizer, results_writer, decode_fn)
+            if args.profile and args.use_wandb:
+                PROFILER.log_to_wandb(step=epoch)
+
+            # Save best model
+            if f1 is not None and f1 > best_f1:
+                best_f1 = f1
+                patience = 0
+                save_model(checkpoint, model, best=True, writer=writer)
+                print("Saved new best model!")
+
+            else:
+                patience += 1
+
+        if world_size > 1:
+            synced = [best_f1, patience]
+            dist.broadcast_object_list(synced, src=0)
+            best_f1, patience = synced
+
+        save_state(epoch + 1, 0, 0.0)
 
         if patience >= args.patience_epochs:
             print("Early stopping.")
             break
 
+    writer.close()
+    results_writer.close()
+    if not is_main:
+        if args.profile:
+            export_profile(args, rank)
+        dist.destroy_process_group()
+        return
+
     # After training is done, generate test results
+    if cache is not None:
+        cache.set_fingerprint(model_fingerprint(model), **generation_settings(model, MAX_NEW_TOKENS, decode_fn))
     generate_and_save_test_results(
         model,
         test_loader,
         "results/t5_ft_experiment_test.sql",
-        "records/t5_ft_experiment_test.pkl"
+        "records/t5_ft_experiment_test.pkl",
+        cache,
+        decode_tokenizer,
+        decode_fn,
     )
 
+    if cache is not None:
+        print(cache.report())
+        cache.save()
+
+    if args.profile:
+        export_profile(args, rank)
+
+    if world_size > 1:
+        dist.destroy_process_group()
+
 if __name__ == "__main__":
     main()
@@ -1,14 +1,28 @@
 import sqlite3
 import numpy as np
 import os
+import re
+import time
 import pickle
 import random
+import threading
+from collections import defaultdict
+from functools import lru_cache
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Any
 import torch
 
+from profiling import PROFILER
+
 DB_PATH = 'data/flight_database.db'
+SLOW_LANE_BUDGET_SECS = 10  # Time budget for queries screened as likely pathological
+SLOW_LANE_NICENESS = 10
+MAX_FULL_SCANS = 6
+PROGRESS_CHECK_INSTRUCTIONS = 10000  # SQLite VM instructions between deadline checks
+SQL_COMMENT_RE = re.compile(r"--[^\n]*|/\*.*?(?:\*/|$)", re.S)
+
+_thread_state = threading.local()
 
 
 def compute_metrics(gt_path: str, model_path: str, gt_query_records: str = None, model_query_records: str = None):
@@ -26,17 +40,41 @@ def compute_metrics(gt_path: str, model_path: str, gt_query_records: str = None,
         * model_query_records (str): If provided, it should be a path to a pickle file containing a list of records
                                      returned by the model-generated SQL queries.
     '''
-    gt_qs, gt_records, _ = load_queries_and_records(gt_path, gt_query_records)
+    gt_qs, gt_records = load_ground_truth(gt_path, gt_query_records)
     model_qs, model_records, model_error_msgs = load_queries_and_records(model_path, model_query_records)
 
+    sql_em, record_em, record_f1 = score_predictions(gt_qs, gt_records, model_qs, model_records)
+    return sql_em, record_em, record_f1, model_error_msgs
+
+
+def score_predictions(gt_qs: List[str], gt_records: List[Any], model_qs: List[str], model_records: List[Any]):
+    '''
+    The three evaluation metrics for in-memory predictions: SQL exact match,
+    record exact match and record F1.
+    '''
     sql_em = compute_sql_exact_match(gt_qs, model_qs)
     record_em = compute_record_exact_match(gt_records, model_records)
     record_f1 = compute_record_F1(gt_records, model_records)
+    return sql_em, record_em, record_f1
+
+
+def load_ground_truth(gt_path: str, gt_query_records: str = None):
+    '''
+    Ground-truth queries and records, loaded (or, without a records file,
+    executed) once per process and served from memory afterwards. A file that
+    changes on disk is reloaded.
+    '''
+    mtimes = tuple(os.path.getmtime(p) for p in (gt_path, gt_query_records) if p is not None)
+    return _load_ground_truth(gt_path, gt_query_records, mtimes)
 
-    return sql_em, record_em, record_f1, model_error_msgs
 
+@lru_cache(maxsize=8)
+def _load_ground_truth(gt_path, gt_query_records, mtimes):
+    gt_qs, gt_records, _ = load_queries_and_records(gt_path, gt_query_records, screen=False)
+    return gt_qs, gt_records
 
-def load_queries_and_records(sql_path: str, record_path: str):
+
+def load_queries_and_records(sql_path: str, record_path: str, screen: bool = True):
     '''
     Helper function for loading saved SQL queries and for computing the
     dataset records associated with said queries.
@@ -45,6 +83,8 @@ def load_queries_and_records(sql_path: str, record_path: str):
         * sql_path (str): Path to a .sql file containing SQL queries
         * record_path (str): If provided, a path to a .pkl file containing dataset
                              records associated with each SQL query in sql_path.
+        * screen (bool): Passed to compute_records when the records are computed;
+                         ground truth is executed unscreened.
     '''
     read_qs = read_queries(sql_path)
 
@@ -52,7 +92,7 @@ def load_queries_and_records(sql_path: str, record_path: str):
         with open(record_path, 'rb') as f:
             records, error_msgs = pickle.load(f)
     else:
-        records, error_msgs = compute_records(read_qs)
+        records, error_msgs = compute_records(read_qs, screen=screen)
 
     return read_qs, records, error_msgs
 
@@ -67,15 +107,26 @@ def save_queries_and_records(sql_queries: List[str], sql_path: str, record_path:
         * sql_path (str): Path to save SQL queries
         * record_path (str): Path to save database records associated with queries
     '''
+    records, error_msgs = compute_records(sql_queries)
+    write_queries_and_records(sql_queries, records, error_msgs, sql_path, record_path)
+
+
+def write_queries_and_records(sql_queries: List[str], records: List[Any], error_msgs: List[str],
+                              sql_path: str, record_path: str):
+    '''
+    Persist already executed queries in the layout save_queries_and_records
+    uses. Safe to run on a background thread: both files are replaced atomically.
+    '''
     # First save the queries
-    with open(sql_path, 'w') as f:
+    with open(sql_path + '.tmp', 'w') as f:
         for query in sql_queries:
             f.write(f'{query}\n')
+    os.replace(sql_path + '.tmp', sql_path)
 
-    # Next compute and save records
-    records, error_msgs = compute_records(sql_queries)    
-    with open(record_path, 'wb') as f:
+    # Next save the records
+    with open(record_path + '.tmp', 'wb') as f:
         pickle.dump((records, error_msgs), f)
+    os.replace(record_path + '.tmp', record_path)
 
 
 def read_queries(sql_path: str):
@@ -84,33 +135,67 @@ def read_queries(sql_path: str):
     return qs
 
 
-def compute_records(processed_qs: List[str]):
+def compute_records(processed_qs: List[str], screen: bool = True):
     '''
     Helper function for computing the records associated with each SQL query in the
     input list. You may change the number of threads or the timeout variable (in seconds)
     based on your computational constraints.
 
+    With screen=True every query is first checked with screen_query: queries that
+    cannot be prepared get their error message without being executed, and likely
+    pathological ones (cartesian joins, many full scans) run in a single low-priority
+    thread with a much shorter budget so they cannot hold up the regular workers.
+
     Input:
         * processed_qs (List[str]): The list of SQL queries to execute
+        * screen (bool): Whether to screen queries with EXPLAIN QUERY PLAN first
     '''
     num_threads = 10
     timeout_secs = 120
+    slow_lane_secs = SLOW_LANE_BUDGET_SECS
 
-    pool = ThreadPoolExecutor(num_threads)
-    futures = []
-    for i, query in enumerate(processed_qs):
-        futures.append(pool.submit(compute_record, i, query))
-        
     rec_dict = {}
-    try:
-        for x in tqdm(as_completed(futures, timeout=timeout_secs)):
-            query_id, rec, error_msg = x.result()
-            rec_dict[query_id] = (rec, error_msg)
-    except:
-        for future in futures:
-            if not future.done():
-                future.cancel()
-            
+    fast_lane, slow_lane = [], []
+    if screen:
+        with PROFILER.span("sql.screen", queries=len(processed_qs)):
+            conn = sqlite3.connect(DB_PATH)
+            for i, query in enumerate(processed_qs):
+                status, error_msg = screen_query(conn, query)
+                if status == "invalid":
+                    rec_dict[i] = ([], error_msg)
+                else:
+                    (slow_lane if status == "slow" else fast_lane).append((i, query))
+            conn.close()
+    else:
+        fast_lane = list(enumerate(processed_qs))
+
+    # Queries still running at their deadline are interrupted (and reported as timed out).
+    # Slow-lane queries run one after another: each gets its budget when it starts, within
+    # the timeout_secs of the whole call
+    with PROFILER.span("sql.execute", fast=len(fast_lane), slow=len(slow_lane)):
+        start = time.monotonic()
+        connections = []
+        pool = ThreadPoolExecutor(num_threads, initializer=open_thread_connection, initargs=(connections,))
+        slow_pool = ThreadPoolExecutor(1, initializer=open_thread_connection,
+                                       initargs=(connections, SLOW_LANE_NICENESS))
+        futures = [pool.submit(compute_record, i, query, start + timeout_secs) for i, query in fast_lane]
+        futures += [slow_pool.submit(compute_record_with_budget, i, query, slow_lane_secs, start + timeout_secs)
+                    for i, query in slow_lane]
+
+        try:
+            # Every query's deadline is at most start + timeout_secs, which bounds the whole call
+            for x in tqdm(as_completed(futures)):
+                query_id, rec, error_msg = x.result()
+                rec_dict[query_id] = (rec, error_msg)
+        except:
+            for future in futures:
+                if not future.done():
+                    future.cancel()
+        pool.shutdown()
+        slow_pool.shutdown()
+        for conn in connections:
+            conn.close()
+
     recs = []
     error_msgs = []
     for i in range(len(processed_qs)):
@@ -121,26 +206,108 @@ def compute_records(processed_qs: List[str]):
         else:
             recs.append([])
             error_msgs.append("Query timed out")
-            
+
+    PROFILER.count("sql.queries", len(processed_qs))
+    PROFILER.count("sql.slow_lane", len(slow_lane))
+    PROFILER.count("sql.errors", sum(1 for e in error_msgs if e))
     return recs, error_msgs
 
 
-def compute_record(query_id, query):
-    conn = sqlite3.connect(DB_PATH)
+def open_thread_connection(connections, niceness=0):
+    # One connection per worker thread, reused for every query it runs
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    _thread_state.conn = conn
+    connections.append(conn)
+    if niceness and hasattr(os, "setpriority"):
+        try:
+            # Linux schedules threads individually, so this only lowers this worker
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), niceness)
+        except OSError:
+            pass
+
+
+def compute_record(query_id, query, deadline=None):
+    conn = getattr(_thread_state, "conn", None)
+    own_conn = conn is None
+    if own_conn:
+        conn = sqlite3.connect(DB_PATH)
+    if deadline is not None:
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_CHECK_INSTRUCTIONS)
     cursor = conn.cursor()
 
     try:
-        cursor.execute(query)
-        rec = cursor.fetchall()
+        with PROFILER.span("sql.query", id=query_id):
+            cursor.execute(query)
+            rec = cursor.fetchall()
         error_msg = ""
     except Exception as e:
         rec = []
-        error_msg = f"{type(e).__name__}: {e}"
-
-    conn.close()
+        interrupted = deadline is not None and time.monotonic() > deadline
+        error_msg = "Query timed out" if interrupted else f"{type(e).__name__}: {e}"
+        if interrupted:
+            PROFILER.count("sql.timeouts")
+
+    cursor.close()
+    if own_conn:
+        conn.close()
+    else:
+        conn.set_progress_handler(None, 0)
     return query_id, rec, error_msg
 
 
+def compute_record_with_budget(query_id, query, budget_secs, deadline=None):
+    # The budget starts when a worker picks the query up, not while it waits in the queue,
+    # and never runs past the overall deadline if one is given
+    query_deadline = time.monotonic() + budget_secs
+    return compute_record(query_id, query, query_deadline if deadline is None else min(query_deadline, deadline))
+
+
+def screen_query(conn, query):
+    '''
+    Cheap pre-execution check of a query. Returns (status, message):
+        * ("invalid", error) if the statement is incomplete or cannot be prepared;
+          error is the message executing it would have produced
+        * ("slow", reason) if its query plan has unconstrained joins or many full scans
+        * ("ok", "") otherwise
+    '''
+    if not SQL_COMMENT_RE.sub("", query).strip(" \t\r\n;"):
+        # Nothing but comments: executes to no rows, while its EXPLAIN would be incomplete
+        return "ok", ""
+    # The newline ends a trailing line comment, which would otherwise swallow the ";"
+    if not sqlite3.complete_statement(query + "\n;"):
+        return "invalid", "OperationalError: incomplete input"
+
+    try:
+        # Preparing the EXPLAIN compiles the statement without running it, and
+        # fails with the same message executing it would (e.g. truncated SQL is
+        # "incomplete input")
+        plan = conn.execute("EXPLAIN QUERY PLAN " + query).fetchall()
+    except Exception as e:
+        return "invalid", f"{type(e).__name__}: {e}"
+
+    full_scans, unconstrained_joins = explain_plan_stats(plan)
+    if unconstrained_joins > 0:
+        return "slow", f"{unconstrained_joins} join(s) without a join predicate"
+    if full_scans > MAX_FULL_SCANS:
+        return "slow", f"{full_scans} full table scans"
+    return "ok", ""
+
+
+def explain_plan_stats(plan):
+    '''
+    Count full table scans in EXPLAIN QUERY PLAN rows (id, parent, notused, detail),
+    and the scans that are nested inside another scan of the same query level. The
+    latter are loops that no join predicate constrains, i.e. cartesian products.
+    '''
+    scans_per_level = defaultdict(int)
+    for _, parent, _, detail in plan:
+        if detail.startswith("SCAN ") and not detail.startswith("SCAN CONSTANT"):
+            scans_per_level[parent] += 1
+    full_scans = sum(scans_per_level.values())
+    unconstrained_joins = sum(n - 1 for n in scans_per_level.values())
+    return full_scans, unconstrained_joins
+
+
 def compute_sql_exact_match(gt_qs: List[str], model_qs: List[str]):
     '''
     Helper function to compute exact match between ground-truth
@@ -208,3 +375,26 @@ def set_random_seeds(seed_value=42):
     torch.cuda.manual_seed_all(seed_value)
     torch.backends.cudnn.deterministic = True
     torch.backends.cudnn.benchmark = False
+
+
+def get_rng_state():
+    '''
+    Snapshot of every random number generator used during training
+    '''
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state):
+    '''
+    Restore the generators captured by get_rng_state
+    '''
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
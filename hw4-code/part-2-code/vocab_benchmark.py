@@ -0,0 +1,146 @@
+import os
+import time
+import argparse
+from tqdm import tqdm
+
+import torch
+import torch.nn as nn
+from transformers import T5TokenizerFast
+
+from utils import compute_metrics, save_queries_and_records
+from load_data import get_dataloader
+from t5_utils import (generate_sql, greedy_decode, t5_decoder_step, load_pretrained_fast, build_target_vocab,
+                      restrict_lm_head, load_target_vocab)
+from sql_tokenizer import SqlTargetTokenizer, load_target_tokenizer
+
+DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+MAX_NEW_TOKENS = 256
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Full vs SQL-restricted output vocabulary for T5 decoding')
+    parser.add_argument('--experiment_name', type=str, default='ft_experiment',
+                        help="Loads the checkpoint from checkpoints/<experiment_name>")
+    parser.add_argument('--test_batch_size', type=int, default=16)
+    parser.add_argument('--timing_batches', type=int, default=5,
+                        help="Dev batches used for the per-step latency measurement")
+    parser.add_argument('--timing_steps', type=int, default=64,
+                        help="Decoder steps per timing batch")
+    parser.add_argument('--skip_eval', action='store_true',
+                        help="Only measure step latency (no dev generation and F1)")
+    return parser.parse_args()
+
+
+def set_lm_head(model, vocab_ids):
+    # vocab_ids=None restores a plain full-vocabulary projection over the tied weight
+    if vocab_ids is not None:
+        return restrict_lm_head(model, vocab_ids)
+    weight = model.shared.weight
+    head = nn.Linear(weight.size(1), weight.size(0), bias=False, device=weight.device, dtype=weight.dtype)
+    head.weight = weight
+    model.lm_head = head
+    return model
+
+
+def vocab_coverage(vocab_ids, target_ids):
+    '''
+    Fraction of target tokens, and of whole targets, that the restricted
+    vocabulary can produce.
+    '''
+    vocab = set(vocab_ids.tolist())
+    tokens = covered_tokens = covered_seqs = 0
+    for ids in target_ids:
+        hits = sum(t in vocab for t in ids.tolist())
+        tokens += len(ids)
+        covered_tokens += hits
+        covered_seqs += hits == len(ids)
+    return covered_tokens / tokens, covered_seqs / len(target_ids)
+
+
+def time_decoder_steps(model, loader, num_batches, num_steps):
+    '''
+    Mean wall-clock time of one cached decoder step (including the output
+    projection), excluding the encoder.
+    '''
+    elapsed, steps = 0.0, 0
+
+    def timed_step(ids, hidden, mask, past):
+        nonlocal elapsed, steps
+        start = time.perf_counter()
+        out = t5_decoder_step(model, ids, hidden, mask, past)
+        elapsed += time.perf_counter() - start
+        steps += 1
+        return out
+
+    model.eval()
+    with torch.no_grad():
+        for i, batch in enumerate(loader):
+            if i == num_batches:
+                break
+            enc_in, enc_mask = batch[0].to(DEVICE), batch[1].to(DEVICE)
+            greedy_decode(model, enc_in, enc_mask, num_steps, step_fn=timed_step)
+    return elapsed / steps
+
+
+def run_generation(model, tokenizer, loader, desc):
+    model.eval()
+    all_sql = []
+    start = time.perf_counter()
+    with torch.no_grad():
+        for batch in tqdm(loader, desc=desc, ncols=100):
+            enc_in, enc_mask = batch[0].to(DEVICE), batch[1].to(DEVICE)
+            all_sql.extend(generate_sql(model, tokenizer, enc_in, enc_mask, MAX_NEW_TOKENS))
+    return all_sql, time.perf_counter() - start
+
+
+def main():
+    args = get_args()
+    checkpoint_dir = f"checkpoints/{args.experiment_name}"
+    tokenizer = load_target_tokenizer(checkpoint_dir, T5TokenizerFast.from_pretrained(checkpoint_dir))
+    model = load_pretrained_fast(checkpoint_dir).to(DEVICE)
+
+    # Targets in the checkpoint's own vocabulary (compact SQL tokens if it was trained with them)
+    target_tokenizer = tokenizer if isinstance(tokenizer, SqlTargetTokenizer) else None
+    train_loader = get_dataloader(args.test_batch_size, "train", target_tokenizer=target_tokenizer)
+    dev_loader = get_dataloader(args.test_batch_size, "dev", target_tokenizer=target_tokenizer)
+    vocab_ids = load_target_vocab(checkpoint_dir)
+    if vocab_ids is None:
+        vocab_ids = build_target_vocab(train_loader.dataset.decoder_targets, model.config)
+    else:
+        print("Checkpoint was trained with a restricted output vocabulary")
+
+    token_cov, seq_cov = vocab_coverage(vocab_ids, dev_loader.dataset.decoder_targets)
+    print(f"Restricted vocabulary: {len(vocab_ids)} of {model.config.vocab_size} tokens "
+          f"({len(vocab_ids) / model.config.vocab_size * 100:.1f}%)")
+    print(f"Dev coverage: {token_cov * 100:.2f}% of target tokens, {seq_cov * 100:.2f}% of targets")
+
+    results = {}
+    for name, ids in [("full", None), ("restricted", vocab_ids)]:
+        set_lm_head(model, ids)
+        # One untimed batch so both heads start warm
+        time_decoder_steps(model, dev_loader, 1, 4)
+        step_ms = 1000 * time_decoder_steps(model, dev_loader, args.timing_batches, args.timing_steps)
+        results[name] = {"step_ms": step_ms}
+        print(f"{name}: {step_ms:.2f} ms per decoder step")
+
+        if not args.skip_eval:
+            sql, secs = run_generation(model, tokenizer, dev_loader, f"{name} dev")
+            model_sql = f"results/t5_{name}_vocab_{args.experiment_name}_dev.sql"
+            model_rec = f"records/t5_{name}_vocab_{args.experiment_name}_dev.pkl"
+            os.makedirs("results", exist_ok=True)
+            os.makedirs("records", exist_ok=True)
+            save_queries_and_records(sql, model_sql, model_rec)
+            _, record_em, record_f1, _ = compute_metrics("data/dev.sql", model_sql,
+                                                         "records/ground_truth_dev.pkl", model_rec)
+            results[name].update(secs=secs, record_f1=record_f1, record_em=record_em)
+            print(f"{name}: dev F1 {record_f1:.4f} | EM {record_em:.4f} | {len(sql) / secs:.2f} queries/s")
+
+    full, restricted = results["full"], results["restricted"]
+    print(f"Per-step speedup: {full['step_ms'] / restricted['step_ms']:.2f}x")
+    if not args.skip_eval:
+        print(f"End-to-end speedup: {full['secs'] / restricted['secs']:.2f}x | "
+              f"F1 change {restricted['record_f1'] - full['record_f1']:+.4f}")
+
+
+if __name__ == "__main__":
+    main()